@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+"""
+Times each stage of the detection hot path separately, on synthetic frames or on recorded ones
+replayed from a directory or video.
+
+Stages: frame acquisition, preprocessing, invoke(), post-processing, format_exif, JPEG encode
+and file write. The results, with throughput and p50/p95/p99 latency, are written as JSON. If
+a baseline is given, any stage whose p95 is slower than the baseline by more than the tolerance
+is reported and the exit code is 1.
+
+    python benchmark.py --frames 50 --output bench.json
+    python benchmark.py --replay /home/admin/usbshare1/2_copy --baseline baseline.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tomllib
+
+from capture_data import CaptureData
+from frame_source import FrameSourceExhausted
+from frame_source import ReplayFrameSource
+from image_saver import ImageSaver
+
+
+STAGES = [
+    "acquire",
+    "preprocess",
+    "invoke",
+    "postprocess",
+    "format_exif",
+    "encode",
+    "write",
+]
+
+
+class SyntheticFrameSource:
+    """
+    Noise frames of the configured sizes. Acquisition is just copying a pre-made frame, so it
+    measures the cost of moving a frame around rather than of making one.
+    """
+
+    def __init__(self, config, seed=0):
+        lores_width = config['tflite']['lores_width']
+        lores_height = config['tflite']['lores_height']
+        main_width = config['tflite']['main_width']
+        main_height = config['tflite']['main_height']
+
+        rng = np.random.default_rng(seed)
+        self._lores = rng.integers(0, 256, (lores_height * 3 // 2, lores_width), dtype=np.uint8)
+        self._main = rng.integers(0, 256, (main_height, main_width, 4), dtype=np.uint8)
+        self._lores_width = lores_width
+
+    def start(self):
+        pass
+
+    def stream_configuration(self, name):
+        return {"stride": self._lores_width}
+
+    def capture_buffer(self, name):
+        return self._lores.ravel().copy()
+
+    def capture_array(self, name):
+        return self._lores if name == "lores" else self._main
+
+
+def time_stage(timings, stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[stage].append(time.perf_counter() - start)
+    return result
+
+
+def summarize(timings):
+    """
+    Args:
+        timings (dict): Stage name to a list of durations in seconds
+
+    Returns:
+        dict: Stage name to count, throughput and latency percentiles in milliseconds
+    """
+    summary = {}
+
+    for stage, durations in timings.items():
+        if not durations:
+            continue
+
+        durations_ms = np.array(durations) * 1000.0
+        p50, p95, p99 = np.percentile(durations_ms, [50, 95, 99])
+        summary[stage] = {
+            "count": len(durations),
+            "mean_ms": float(durations_ms.mean()),
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "throughput_per_s": float(1000.0 / durations_ms.mean()),
+        }
+
+    return summary
+
+
+def compare_to_baseline(summary, baseline, tolerance):
+    """
+    Args:
+        summary (dict): Stage results from summarize()
+        baseline (dict): Stage results from an earlier run
+        tolerance (float): Allowed slowdown, e.g. 0.2 for 20%
+
+    Returns:
+        list: A message for each stage whose p95 got slower than allowed
+    """
+    regressions = []
+
+    for stage, result in summary.items():
+        if stage not in baseline:
+            continue
+
+        allowed = baseline[stage]["p95_ms"] * (1.0 + tolerance)
+        if result["p95_ms"] > allowed:
+            regressions.append(
+                f"{stage}: p95 {result['p95_ms']:.2f} ms > baseline {baseline[stage]['p95_ms']:.2f} ms "
+                f"+ {tolerance:.0%}"
+            )
+
+    return regressions
+
+
+def make_detector(config):
+    # Imported here so the save stages can be benchmarked where tflite isn't installed.
+    from tensor_flow_detect import TensorFlowDetect
+
+    return TensorFlowDetect(config['tflite'], config['capture']['flip'], False)
+
+
+def run(config, source, detector, num_frames, output_dir):
+    """
+    Push num_frames frames through every stage, timing each one. The preprocess, invoke and
+    postprocess stages are skipped if detector is None.
+
+    Returns:
+        dict: Stage name to list of durations in seconds
+    """
+    timings = {stage: [] for stage in STAGES}
+
+    image_saver = ImageSaver()
+    image_saver.set_config(config)
+
+    lores_height = config['tflite']['lores_height']
+    stride = source.stream_configuration("lores")["stride"]
+
+    source.start()
+
+    for i in range(num_frames):
+        try:
+            buffer = time_stage(timings, "acquire", source.capture_buffer, "lores")
+        except FrameSourceExhausted:
+            break
+
+        grey = buffer[: stride * lores_height].reshape(lores_height, stride)
+
+        capture_data = CaptureData()
+        capture_data.node_name = platform.node()
+        capture_data.camera_num = 0
+        capture_data.pir_fired = False
+        capture_data.object_detected = False
+
+        if detector is not None:
+            time_stage(timings, "preprocess", detector.preprocess, [grey])
+            time_stage(timings, "invoke", detector.run_inference)
+            boxes, scores, class_ids = time_stage(timings, "postprocess", detector.postprocess, 1)[0]
+
+            capture_data.set_detections(boxes, scores, class_ids)
+            capture_data.set_labels(detector.labels())
+            capture_data.object_detected = len(boxes) > 0
+
+        exif_bytes = time_stage(timings, "format_exif", image_saver.format_exif, capture_data)
+        jpeg = time_stage(
+            timings, "encode", image_saver.encode, source.capture_array("main"), exif_bytes
+        )
+        time_stage(timings, "write", image_saver.write_file, f"{output_dir}/bench-{i}.jpg", jpeg)
+
+    return timings
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        prog="Benchmark", description="Times each stage of the detection hot path."
+    )
+
+    parser.add_argument("-n", "--frames", type=int, default=50, help="Number of frames to run")
+    parser.add_argument("--replay", type=str, help="Directory of images or video file. Synthetic frames if not given")
+    parser.add_argument("--no-inference", action="store_true", help="Skip the preprocess, invoke and postprocess stages")
+    parser.add_argument("-o", "--output", type=str, help="Write the results JSON here as well as to stdout")
+    parser.add_argument("--output-dir", type=str, help="Directory for the written images. A temporary directory if not given")
+    parser.add_argument("-b", "--baseline", type=str, help="Results JSON to compare against")
+    parser.add_argument("-e", "--encoder", type=str, help="JPEG encoder to time instead of the configured one")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2, help="Allowed p95 slowdown against the baseline")
+
+    args = parser.parse_args()
+
+    with open("config.toml", "rb") as f:
+        config = tomllib.load(f)
+
+    # The saver writes synchronously so the encode and write stages can be timed
+    config['saver']['write_behind'] = False
+    if args.encoder:
+        config['saver']['encoder'] = args.encoder
+
+    # With lores_native the detector changes the configured lores size, so make it before the
+    # frame source
+    detector = None if args.no_inference else make_detector(config)
+
+    if args.replay:
+        config['replay']['path'] = args.replay
+        config['replay']['pacing'] = "fast"
+        source = ReplayFrameSource(config)
+    else:
+        source = SyntheticFrameSource(config)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_dir = args.output_dir or temp_dir
+        config['capture']['output_dir'] = f"{output_dir}/"
+
+        timings = run(config, source, detector, args.frames, output_dir)
+
+    results = {
+        "time": f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}",
+        "node": platform.node(),
+        "source": args.replay or "synthetic",
+        "encoder": config['saver']['encoder'],
+        "stages": summarize(timings),
+    }
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare_to_baseline(results["stages"], baseline["stages"], args.tolerance)
+        if regressions:
+            print("PERFORMANCE REGRESSION", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
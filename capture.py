@@ -5,15 +5,24 @@ import signal
 import sys
 
 import tomllib
-from picamera2 import Picamera2
-import stats_file
+
+import metrics_server
 import monitor_pir
+import stats_file
 from image_capture_loop import ImageCaptureLoop
 from image_saver import ImageSaver
 
 
-Picamera2.set_logging(logging.ERROR)
+try:
+    from picamera2 import Picamera2
+
+    Picamera2.set_logging(logging.ERROR)
+except ImportError:
+    # Not on a Pi. Only a replay frame source will work.
+    pass
+
 pir_thread = None
+image_capture_loop = None
 
 def command_line_handler(signum, frame):
     # res = input("Ctrl-c was pressed. Do you really want to exit? y/n ")
@@ -42,6 +51,7 @@ def load_config():
     parser.add_argument('--flip', action=argparse.BooleanOptionalAction)
     parser.add_argument("-l", "--logging", type=str, help="Set logging level", default="ERROR")
     parser.add_argument("--pir", action=argparse.BooleanOptionalAction, help="Check the PIR sensor")
+    parser.add_argument("--replay", type=str, help="Replay a directory of images or a video file instead of using the cameras")
 
     args = parser.parse_args()
 
@@ -65,6 +75,10 @@ def load_config():
     else:
         config["capture"]["flip"] = False
 
+    if args.replay:
+        config["capture"]["source"] = "replay"
+        config["replay"]["path"] = args.replay
+
     # Model specific overrides
     if args.opencv_preview:
         config["opencv"]["preview"] = True
@@ -78,6 +92,8 @@ def load_config():
 def stop():
     # stop_event.set()  # Signal the thread to stop
     # thread.join()
+    if image_capture_loop is not None:
+        image_capture_loop.stop()
     if config['pir']['check_pir']:
         pir_thread.stop()
     sys.exit(1)
@@ -98,5 +114,8 @@ if __name__ == "__main__":
 
     stats_file.start_stats_thread(config)
 
+    if config['metrics']['enable']:
+        metrics_server.start_metrics_server(config, pir_thread)
+
     signal.signal(signal.SIGINT, command_line_handler)
     image_capture_loop.start()
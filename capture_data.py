@@ -1,45 +1,237 @@
-import json
 import datetime
+import json
+import struct
+
 import numpy as np
 
+
+# One row per detection. Boxes are [left, bottom, right, top] as fractions of the frame size,
+# with y increasing downwards. track_id is -1 when the detection isn't tracked.
+DETECTION_DTYPE = np.dtype(
+    [("box", "<f4", (4,)), ("score", "<f4"), ("class_id", "<i4"), ("track_id", "<i4")]
+)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# to_bytes() layout: magic, version, capture time in microseconds since EPOCH, pir_fired,
+# object_detected, camera_num, then the lengths of the node name, labels and detections
+HEADER = struct.Struct("<4sBqbbhHII")
+MAGIC = b"CAPD"
+VERSION = 2
+
+
+def _to_tristate(value):
+    return -1 if value is None else int(value)
+
+
+def _from_tristate(value):
+    return None if value == -1 else bool(value)
+
+
+def _shortest_floats(values):
+    # The shortest decimal that reads back as the same float32, so 0.95 stays 0.95
+    return [float(np.format_float_positional(value, unique=True)) for value in values]
+
+
 class CaptureData:
+    """
+    Everything known about one captured frame.
+
+    The detections are a structured array of DETECTION_DTYPE. Class names are only looked up
+    when they are needed, from the labels given to set_labels(), so frames that are never saved
+    don't pay for them.
+    """
+
+    __slots__ = (
+        "capture_time",
+        "pir_fired",
+        "node_name",
+        "camera_num",
+        "object_detected",
+        "detections",
+        "_labels",
+    )
 
     def __init__(self) -> None:
         # These are public values. Set them as you go!
-             
+
         self.capture_time = datetime.datetime.now()
         self.pir_fired = None
         self.node_name = None
         self.camera_num = None
         self.object_detected = None
-        self.rectangles = []    # You need to append to these lists
-        self.scores = []        # You need to append to these lists
-        self.classes = []       # You need to append to these lists
+        self.detections = np.empty(0, dtype=DETECTION_DTYPE)
+        self._labels = {}
+
+    def set_detections(self, boxes, scores, class_ids, track_ids=None):
+        """
+        Args:
+            boxes (ndarray): (n, 4) boxes
+            scores (ndarray): (n,) scores
+            class_ids (ndarray): (n,) class ids
+            track_ids (list): (n,) ids from the object tracker, if it is on
+        """
+        detections = np.empty(len(scores), dtype=DETECTION_DTYPE)
+        detections["box"] = boxes
+        detections["score"] = scores
+        detections["class_id"] = class_ids
+        detections["track_id"] = -1 if track_ids is None else track_ids
+        self.detections = detections
+
+    def add_detection(self, box, score, class_id, track_id=-1):
+        detection = np.array([(box, score, class_id, track_id)], dtype=DETECTION_DTYPE)
+        self.detections = np.concatenate((self.detections, detection))
+
+    def set_labels(self, labels):
+        """
+        Args:
+            labels (dict): Class id to name, e.g. the detector's labels. Not copied.
+        """
+        self._labels = labels
 
-    # TODO: Figure out how to get this to work. Need to read up on it.
-    # 
-    # def __setattr__(self, name, value):
-    #     if name == "capture_time" and isinstance(value, datetime.datetime):
-    #         value = value.strftime("%Y-%m-%d %H:%M:%S")
-    #     super().__setattr__(name, value)
+    @property
+    def rectangles(self):
+        return self.detections["box"].tolist()
+
+    @property
+    def scores(self):
+        return _shortest_floats(self.detections["score"])
+
+    @property
+    def track_ids(self):
+        return self.detections["track_id"].tolist()
+
+    @property
+    def classes(self):
+        return [self._labels[class_id] for class_id in self.detections["class_id"].tolist()]
 
     def capture_time_str(self):
         return self.capture_time.strftime("%Y-%m-%d_%H-%M-%S")
-    
+
+    def capture_time_file_str(self):
+        # With microseconds, so frames captured in the same second don't overwrite each other
+        return self.capture_time.strftime("%Y-%m-%d_%H-%M-%S-%f")
+
+    def to_dict(self):
+        return {
+            "capture_time": self.capture_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "pir_fired": self.pir_fired,
+            "node_name": self.node_name,
+            "camera_num": self.camera_num,
+            "object_detected": self.object_detected,
+            "rectangles": [_shortest_floats(box) for box in self.detections["box"]],
+            "scores": self.scores,
+            "classes": self.classes,
+            "track_ids": self.track_ids,
+        }
+
     def to_json(self):
-        def convert(obj):
-            retval = None
-            if isinstance(obj, np.ndarray):
-                retval = str(obj.tolist())
-            if isinstance(obj, datetime.datetime):
-                retval = obj.strftime("%Y-%m-%d %H:%M:%S")
-            if isinstance(obj, np.float32):
-                retval = obj.item()
-            return retval
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, json_str):
+        """
+        Args:
+            json_str (string): From to_json(), e.g. an image's EXIF user comment
+
+        Returns:
+            CaptureData: The capture data
+        """
+        return cls.from_dict(json.loads(json_str))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Args:
+            data (dict): From to_dict()
+
+        Returns:
+            CaptureData: The capture data. The dict only has class names, so each name gets an
+            id in the order it first appears.
+        """
+        capture_data = cls()
+        capture_data.capture_time = datetime.datetime.fromisoformat(data["capture_time"])
+        capture_data.pir_fired = data.get("pir_fired")
+        capture_data.node_name = data.get("node_name")
+        capture_data.camera_num = data.get("camera_num")
+        capture_data.object_detected = data.get("object_detected")
+
+        class_ids = {}
+        for name in data.get("classes", []):
+            class_ids.setdefault(name, len(class_ids))
+        capture_data._labels = {class_id: name for name, class_id in class_ids.items()}
+
+        rectangles = data.get("rectangles", [])
+        capture_data.set_detections(
+            np.array(rectangles, dtype=np.float32).reshape(len(rectangles), 4),
+            data.get("scores", []),
+            [class_ids[name] for name in data.get("classes", [])],
+            data.get("track_ids"),
+        )
+
+        return capture_data
+
+    def to_bytes(self):
+        """
+        A compact binary form that from_bytes() turns back into an identical CaptureData. Only
+        the labels of the detected classes are kept.
+
+        Returns:
+            bytes: The serialized capture data
+        """
+        node_name = self.node_name.encode() if self.node_name is not None else b""
+        labels = json.dumps(
+            {class_id: self._labels[class_id] for class_id in set(self.detections["class_id"].tolist())}
+        ).encode()
+        detections = self.detections.tobytes()
+
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            (self.capture_time - EPOCH) // datetime.timedelta(microseconds=1),
+            _to_tristate(self.pir_fired),
+            _to_tristate(self.object_detected),
+            -1 if self.camera_num is None else self.camera_num,
+            len(node_name) if self.node_name is not None else 0xFFFF,
+            len(labels),
+            len(self.detections),
+        )
+
+        return b"".join((header, node_name, labels, detections))
 
-        str = json.dumps(self.__dict__, default=convert)
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Args:
+            data (bytes): From to_bytes()
+
+        Returns:
+            CaptureData: The capture data
+        """
+        magic, version, micros, pir_fired, object_detected, camera_num, node_len, labels_len, count = (
+            HEADER.unpack_from(data)
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not serialized capture data: {magic!r} version {version}")
+
+        capture_data = cls()
+        capture_data.capture_time = EPOCH + datetime.timedelta(microseconds=micros)
+        capture_data.pir_fired = _from_tristate(pir_fired)
+        capture_data.object_detected = _from_tristate(object_detected)
+        capture_data.camera_num = None if camera_num == -1 else camera_num
 
-        return str
+        offset = HEADER.size
+        if node_len != 0xFFFF:
+            capture_data.node_name = data[offset : offset + node_len].decode()
+            offset += node_len
+
+        labels = json.loads(data[offset : offset + labels_len])
+        capture_data._labels = {int(class_id): name for class_id, name in labels.items()}
+        offset += labels_len
+
+        capture_data.detections = np.frombuffer(data, dtype=DETECTION_DTYPE, count=count, offset=offset).copy()
+
+        return capture_data
 
     def to_short_string(self):
         pir_status = "PIR" if self.pir_fired else "No PIR"
@@ -47,8 +239,21 @@ class CaptureData:
         classes = str(self.classes) # ", ".join(self.classes)
         return f"{pir_status} - {object_status} - Classes: {classes}"
     
-    def to_coco(self):
+    def to_coco(self, image_id, file_name, width, height, first_annotation_id, category_ids):
         """
+            The image and its annotations, as entries for a COCO dataset.
+
+            Args:
+                image_id (int): Id for the image
+                file_name (string): The image's file name
+                width (int): Width of the saved image in pixels
+                height (int): Height of the saved image in pixels
+                first_annotation_id (int): Id for the first annotation. The rest follow on.
+                category_ids (dict): Class name to COCO category id. Must cover every class.
+
+            Returns:
+                tuple: The "images" entry and a list of "annotations" entries
+
             Here's an example of a minimal bounding box JSON in COCO format for a single image:
 
             ```json
@@ -111,5 +316,33 @@ class CaptureData:
             [3] https://github.com/matterport/Mask_RCNN/issues/1433
             [4] https://towardsdatascience.com/how-to-work-with-object-detection-datasets-in-coco-format-9bf4fb5848a4?gi=13ccc27bf284
             
-        """        
-        pass
+        """
+        image = {
+            "id": image_id,
+            "width": width,
+            "height": height,
+            "file_name": file_name,
+            "date_captured": self.capture_time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+        annotations = []
+        for i, (box, score, class_name) in enumerate(zip(self.detections["box"], self.scores, self.classes)):
+            left, bottom, right, top = box.tolist()
+            x_min = min(left, right) * width
+            y_min = min(top, bottom) * height
+            box_width = abs(right - left) * width
+            box_height = abs(bottom - top) * height
+
+            annotations.append(
+                {
+                    "id": first_annotation_id + i,
+                    "image_id": image_id,
+                    "category_id": category_ids[class_name],
+                    "bbox": [round(x_min, 2), round(y_min, 2), round(box_width, 2), round(box_height, 2)],
+                    "area": round(box_width * box_height, 2),
+                    "iscrowd": 0,
+                    "score": score,
+                }
+            )
+
+        return image, annotations
@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+
+"""
+A SQLite index of every saved image, so captures can be found without opening the JPEGs.
+
+The saver hands each written image to CaptureIndex.add(), which only queues it. A background
+thread writes the queue to the database in batches, one transaction per batch, with the
+database in WAL mode so queries don't block the writer.
+
+    python capture_index.py --class fox --since "2024-09-14" --until "2024-09-21"
+    python capture_index.py --scan /home/admin/usbshare1/images/
+
+--scan backfills the index from the EXIF of images saved before it existed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+import piexif
+import piexif.helper
+import tomllib
+from PIL import Image
+
+import metrics
+from capture_data import CaptureData
+
+
+# Tells the writer thread to exit
+_STOP = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    capture_time TEXT NOT NULL,
+    node TEXT,
+    camera INTEGER,
+    pir INTEGER,
+    object_detected INTEGER,
+    file_path TEXT NOT NULL UNIQUE,
+    file_size INTEGER,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (capture_time);
+
+CREATE TABLE IF NOT EXISTS detections (
+    capture_id INTEGER NOT NULL REFERENCES captures (id) ON DELETE CASCADE,
+    class TEXT NOT NULL,
+    score REAL NOT NULL,
+    box_left REAL,
+    box_bottom REAL,
+    box_right REAL,
+    box_top REAL
+);
+CREATE INDEX IF NOT EXISTS detections_class ON detections (class, capture_id);
+"""
+
+
+def connect(db_path, check_same_thread=True):
+    connection = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def make_record(file_path, file_size, width, height, capture_data):
+    """
+    Returns:
+        tuple: The captures row and a list of detections rows, which are missing the capture id
+    """
+    capture = (
+        capture_data.capture_time.isoformat(sep=" "),
+        capture_data.node_name,
+        capture_data.camera_num,
+        capture_data.pir_fired,
+        capture_data.object_detected,
+        file_path,
+        file_size,
+        width,
+        height,
+    )
+    detections = [
+        (class_name, score, *box)
+        for class_name, score, box in zip(
+            capture_data.classes, capture_data.scores, capture_data.rectangles
+        )
+    ]
+    return capture, detections
+
+
+def insert_records(connection, records):
+    """
+    Write a batch of records from make_record() in one transaction. A file that is already
+    indexed is replaced.
+    """
+    with connection:
+        for capture, detections in records:
+            connection.execute("DELETE FROM captures WHERE file_path = ?", (capture[5],))
+            cursor = connection.execute(
+                "INSERT INTO captures (capture_time, node, camera, pir, object_detected, file_path, "
+                "file_size, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                capture,
+            )
+            connection.executemany(
+                "INSERT INTO detections (capture_id, class, score, box_left, box_bottom, box_right, box_top) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(cursor.lastrowid, *detection) for detection in detections],
+            )
+
+
+class CaptureIndex:
+    """
+    Records each saved image in the index from a background writer.
+
+    Args:
+        config (dict): The whole configuration. Uses [index].
+
+    Raises:
+        sqlite3.Error: The database can't be opened
+    """
+
+    def __init__(self, config):
+        self._db_path = config['index']['path']
+        self._batch_size = config['index']['batch_size']
+        self._flush_interval = config['index']['flush_interval']
+
+        # Opened here so a bad path fails at startup instead of silently killing the writer.
+        # Only the writer thread uses it from then on.
+        self._connection = connect(self._db_path, check_same_thread=False)
+
+        self._queue = queue.Queue(maxsize=config['index']['queue_depth'])
+        self._thread = threading.Thread(target=self._writer, name="index", daemon=True)
+        self._thread.start()
+
+    def add(self, file_path, file_size, width, height, capture_data):
+        """
+        Queue a saved image. Never blocks: if the writer has fallen that far behind, the record
+        is dropped and counted.
+        """
+        try:
+            self._queue.put_nowait(make_record(file_path, file_size, width, height, capture_data))
+        except queue.Full:
+            metrics.count("index_dropped")
+
+    def close(self):
+        """
+        Write whatever is queued and stop the writer.
+        """
+        if self._thread is not None:
+            # A writer that has died would never take _STOP off a full queue
+            if self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+            self._thread = None
+
+    def _writer(self):
+        connection = self._connection
+
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+
+                # Wait up to flush_interval for more, to write them in one transaction
+                deadline = time.monotonic() + self._flush_interval
+                records = []
+                while item is not _STOP:
+                    records.append(item)
+                    if len(records) >= self._batch_size:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+
+                stopping = item is _STOP
+
+                if records:
+                    try:
+                        with metrics.timer("index_write"):
+                            insert_records(connection, records)
+                        metrics.count("indexed", len(records))
+                    except sqlite3.Error as e:
+                        logging.error(f"An error occurred writing to the capture index: {e}")
+                        metrics.count("index_failures", len(records))
+        except Exception as e:
+            logging.error(f"The capture index writer stopped: {e}")
+        finally:
+            connection.close()
+
+
+def query(connection, **conditions):
+    """
+    Find captures. See iter_captures() for the conditions.
+
+    Returns:
+        list: A dict for each capture, oldest first, with its id and detections
+    """
+    return list(iter_captures(connection, **conditions))
+
+
+def iter_captures(
+    connection,
+    class_name=None,
+    since=None,
+    until=None,
+    after_id=None,
+    node=None,
+    camera=None,
+    min_score=None,
+):
+    """
+    Find captures, one at a time so any number of them can be walked through. Every argument
+    is optional and they are combined with AND.
+
+    Args:
+        connection (sqlite3.Connection): From connect()
+        class_name (string): Only captures with a detection of this class
+        since (string): Only captures at or after this time, e.g. "2024-09-14" or
+            "2024-09-14 06:00"
+        until (string): Only captures before this time
+        after_id (int): Only captures indexed after the one with this id. Ids only go up,
+            so unlike capture times they make a cursor that misses nothing indexed late.
+        node (string): Only captures from this node
+        camera (int): Only captures from this camera
+        min_score (float): With class_name, only detections scoring at least this
+
+    Yields:
+        dict: Each capture, oldest first, with its id and detections
+    """
+    conditions = []
+    parameters = []
+
+    if since is not None:
+        conditions.append("c.capture_time >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("c.capture_time < ?")
+        parameters.append(until)
+    if after_id is not None:
+        conditions.append("c.id > ?")
+        parameters.append(after_id)
+    if node is not None:
+        conditions.append("c.node = ?")
+        parameters.append(node)
+    if camera is not None:
+        conditions.append("c.camera = ?")
+        parameters.append(camera)
+    if class_name is not None:
+        subquery = "SELECT capture_id FROM detections WHERE class = ?"
+        parameters.append(class_name)
+        if min_score is not None:
+            subquery += " AND score >= ?"
+            parameters.append(min_score)
+        conditions.append(f"c.id IN ({subquery})")
+
+    sql = "SELECT c.* FROM captures c"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY c.capture_time"
+
+    connection.row_factory = sqlite3.Row
+
+    for row in connection.execute(sql, parameters):
+        capture = dict(row)
+        capture["detections"] = [
+            {
+                "class": detection["class"],
+                "score": detection["score"],
+                "box": [
+                    detection["box_left"],
+                    detection["box_bottom"],
+                    detection["box_right"],
+                    detection["box_top"],
+                ],
+            }
+            for detection in connection.execute(
+                "SELECT * FROM detections WHERE capture_id = ?", (capture["id"],)
+            )
+        ]
+        yield capture
+
+
+def scan(connection, directory):
+    """
+    Index the images already in a directory from their EXIF user comments.
+
+    Returns:
+        int: The number of images indexed
+    """
+    records = []
+    for entry in os.scandir(directory):
+        if not entry.name.lower().endswith(".jpg"):
+            continue
+
+        try:
+            exif = piexif.load(entry.path)
+            capture_data = CaptureData.from_json(
+                piexif.helper.UserComment.load(exif["Exif"][piexif.ExifIFD.UserComment])
+            )
+            with Image.open(entry.path) as image:
+                width, height = image.size
+        except Exception as e:
+            logging.warning(f"Skipping {entry.path}: {e}")
+            continue
+
+        records.append(make_record(entry.path, entry.stat().st_size, width, height, capture_data))
+
+    insert_records(connection, records)
+    return len(records)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(prog="Capture Index", description="Query the index of saved images.")
+
+    parser.add_argument("--db", type=str, help="Index database. [index] path if not given")
+    parser.add_argument("-c", "--class", dest="class_name", type=str, help="Only captures with this class")
+    parser.add_argument("--since", type=str, help='Only captures at or after this time, e.g. "2024-09-14 06:00"')
+    parser.add_argument("--until", type=str, help="Only captures before this time")
+    parser.add_argument("--node", type=str, help="Only captures from this node")
+    parser.add_argument("--camera", type=int, help="Only captures from this camera")
+    parser.add_argument("--min-score", type=float, help="With --class, only detections scoring at least this")
+    parser.add_argument("--json", action="store_true", help="Print each capture as a JSON line instead of its path")
+    parser.add_argument("--scan", type=str, help="Index the images already saved in this directory, then exit")
+
+    args = parser.parse_args()
+
+    db_path = args.db
+    if db_path is None:
+        with open("config.toml", "rb") as f:
+            db_path = tomllib.load(f)['index']['path']
+
+    connection = connect(db_path)
+
+    if args.scan:
+        print(f"Indexed {scan(connection, args.scan)} images")
+        sys.exit(0)
+
+    captures = query(
+        connection,
+        class_name=args.class_name,
+        since=args.since,
+        until=args.until,
+        node=args.node,
+        camera=args.camera,
+        min_score=args.min_score,
+    )
+
+    for capture in captures:
+        print(json.dumps(capture) if args.json else capture["file_path"])
+
+    print(f"{len(captures)} captures", file=sys.stderr)
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+"""
+Exports the saved captures as a COCO dataset, a bit more each time it runs.
+
+Only captures added since the last export are read: from the capture index if there is one,
+otherwise from the EXIF of the images in the output directory. Their images and annotations are
+appended to a new JSON Lines part file, and the state file remembers how far the export got and
+which ids and categories have been handed out. The dataset JSON is then written by streaming
+every part, so memory use doesn't grow with the size of the dataset.
+
+How far the export got is never a capture time. The saver's workers and the cameras finish
+captures out of order, so a capture can be indexed or written after a later one was exported.
+From the index the cursor is the capture id, which only goes up. From a directory it is the
+modification time and name of the last image exported, and images modified in the last few
+seconds are left for the next run, so an image still being written can't end up behind the
+cursor. Only the EXIF UserComment of the images is read, so metadata saved to a sidecar file
+instead is not exported.
+
+    python coco_export.py --output /home/admin/usbshare1/coco/
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import piexif
+import piexif.helper
+import tomllib
+from PIL import Image
+
+import capture_index
+from capture_data import CaptureData
+
+
+STATE_FILE = "export_state.json"
+PARTS_DIR = "parts"
+DATASET_FILE = "dataset.json"
+
+# Images modified more recently than this may still be being written. Also covers the 2 second
+# timestamps of FAT file systems.
+SETTLE_SECONDS = 3
+
+
+def load_state(output_dir):
+    state = {
+        "last_capture_id": 0,
+        "last_file_mtime": 0,
+        "last_file_name": "",
+        "next_image_id": 1,
+        "next_annotation_id": 1,
+        "categories": {},
+        "parts": [],
+    }
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as f:
+            state.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return state
+
+
+def save_state(output_dir, state):
+    # Write then rename, so an interrupted export leaves the previous state intact
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def captures_from_index(db_path, state):
+    """
+    Yields:
+        tuple: (file_path, width, height, capture_data) for each capture indexed since the last
+        export
+    """
+    connection = capture_index.connect(db_path)
+
+    for capture in capture_index.iter_captures(connection, after_id=state["last_capture_id"]):
+        capture_data = CaptureData.from_dict(
+            {
+                "capture_time": capture["capture_time"],
+                "pir_fired": capture["pir"],
+                "node_name": capture["node"],
+                "camera_num": capture["camera"],
+                "object_detected": capture["object_detected"],
+                "rectangles": [detection["box"] for detection in capture["detections"]],
+                "scores": [detection["score"] for detection in capture["detections"]],
+                "classes": [detection["class"] for detection in capture["detections"]],
+            }
+        )
+        state["last_capture_id"] = max(state["last_capture_id"], capture["id"])
+        yield capture["file_path"], capture["width"], capture["height"], capture_data
+
+    connection.close()
+
+
+def captures_from_directory(image_dir, state):
+    """
+    Yields:
+        tuple: (file_path, width, height, capture_data) for each image modified since the last
+        export, oldest first
+    """
+    settled = time.time() - SETTLE_SECONDS
+    last_file = (state["last_file_mtime"], state["last_file_name"])
+
+    entries = []
+    for entry in os.scandir(image_dir):
+        if not entry.name.lower().endswith(".jpg"):
+            continue
+
+        mtime = entry.stat().st_mtime
+        if last_file < (mtime, entry.name) and mtime < settled:
+            entries.append((mtime, entry.name, entry.path))
+
+    for mtime, name, path in sorted(entries):
+        state["last_file_mtime"], state["last_file_name"] = mtime, name
+
+        try:
+            exif = piexif.load(path)
+            capture_data = CaptureData.from_json(
+                piexif.helper.UserComment.load(exif["Exif"][piexif.ExifIFD.UserComment])
+            )
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception as e:
+            logging.warning(f"Skipping {path}: {e}")
+            continue
+
+        yield path, width, height, capture_data
+
+
+def export_part(output_dir, captures, state):
+    """
+    Append the captures to a new part file.
+
+    Returns:
+        int: The number of images added
+    """
+    os.makedirs(os.path.join(output_dir, PARTS_DIR), exist_ok=True)
+    part_name = os.path.join(PARTS_DIR, f"part-{len(state['parts']):05d}.jsonl")
+
+    count = 0
+    with open(os.path.join(output_dir, part_name), "w") as f:
+        for file_path, width, height, capture_data in captures:
+            for class_name in capture_data.classes:
+                state["categories"].setdefault(class_name, len(state["categories"]) + 1)
+
+            image, annotations = capture_data.to_coco(
+                state["next_image_id"],
+                os.path.basename(file_path),
+                width,
+                height,
+                state["next_annotation_id"],
+                state["categories"],
+            )
+            f.write(json.dumps({"image": image, "annotations": annotations}) + "\n")
+
+            state["next_image_id"] += 1
+            state["next_annotation_id"] += len(annotations)
+            count += 1
+
+    if count:
+        state["parts"].append(part_name)
+    else:
+        os.remove(os.path.join(output_dir, part_name))
+
+    return count
+
+
+def iter_parts(output_dir, state):
+    for part_name in state["parts"]:
+        with open(os.path.join(output_dir, part_name)) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def write_dataset(output_dir, state):
+    """
+    Stream every part into the dataset JSON: one pass for the images and one for the
+    annotations.
+    """
+    path = os.path.join(output_dir, DATASET_FILE)
+
+    with open(f"{path}.tmp", "w") as f:
+        f.write('{"images": [')
+        for i, entry in enumerate(iter_parts(output_dir, state)):
+            f.write(("," if i else "") + "\n" + json.dumps(entry["image"]))
+
+        f.write('\n], "annotations": [')
+        first = True
+        for entry in iter_parts(output_dir, state):
+            for annotation in entry["annotations"]:
+                f.write(("" if first else ",") + "\n" + json.dumps(annotation))
+                first = False
+
+        categories = [{"id": category_id, "name": name} for name, category_id in state["categories"].items()]
+        f.write(f'\n], "categories": {json.dumps(categories)}}}\n')
+
+    os.replace(f"{path}.tmp", path)
+
+
+def export(output_dir, image_dir=None, db_path=None):
+    """
+    Add the captures since the last export and rewrite the dataset.
+
+    Args:
+        output_dir (string): Where the dataset, its parts and the state file go
+        image_dir (string): Read the images here. Only used without db_path.
+        db_path (string): Read the capture index
+
+    Returns:
+        int: The number of images added
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state = load_state(output_dir)
+
+    if db_path is not None:
+        captures = captures_from_index(db_path, state)
+    else:
+        captures = captures_from_directory(image_dir, state)
+
+    count = export_part(output_dir, captures, state)
+
+    write_dataset(output_dir, state)
+    save_state(output_dir, state)
+
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(prog="COCO Export", description="Export the saved captures as a COCO dataset.")
+
+    parser.add_argument("-o", "--output", type=str, required=True, help="Directory for the dataset and export state")
+    parser.add_argument(
+        "--images",
+        type=str,
+        help="Image directory. [capture] output_dir if not given. Only the EXIF metadata is read, not sidecar files",
+    )
+    parser.add_argument("--db", type=str, help="Capture index. [index] path if the index is enabled")
+    parser.add_argument("--no-index", action="store_true", help="Read the images even if there is a capture index")
+
+    args = parser.parse_args()
+
+    with open("config.toml", "rb") as f:
+        config = tomllib.load(f)
+
+    db_path = args.db
+    if db_path is None and config['index']['enable'] and os.path.exists(config['index']['path']):
+        db_path = config['index']['path']
+    if args.no_index:
+        db_path = None
+
+    count = export(args.output, args.images or config['capture']['output_dir'], db_path)
+    print(f"Added {count} images to {os.path.join(args.output, DATASET_FILE)}", file=sys.stderr)
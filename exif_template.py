@@ -0,0 +1,106 @@
+import struct
+
+import piexif
+import piexif.helper
+
+
+# TIFF field types
+ASCII = 2
+LONG = 4
+UNDEFINED = 7
+
+IFD_ENTRY = struct.Struct(">HHII")
+
+
+class ExifTemplate:
+    """
+    Builds the EXIF block for a saved image without going through piexif.dump.
+
+    Every image has the same layout: Make, Model and a pointer to the Exif IFD in the 0th IFD,
+    and DateTimeOriginal and UserComment in the Exif IFD. The header, both IFDs and the Make
+    string are laid out once here. Each frame only patches the three variable length entries
+    and appends their values. piexif.load reads back the same fields piexif.dump would have
+    written, at a fraction of the cost.
+
+    Args:
+        make (string): The camera make. The same for every image.
+    """
+
+    # Offsets from the start of the TIFF header. The 0th IFD has 3 entries, the Exif IFD 2.
+    ZEROTH_IFD = 8
+    EXIF_IFD = ZEROTH_IFD + 2 + 3 * IFD_ENTRY.size + 4
+    DATA = EXIF_IFD + 2 + 2 * IFD_ENTRY.size + 4
+
+    # Where the per-frame entries are in the template
+    MODEL_ENTRY = ZEROTH_IFD + 2 + IFD_ENTRY.size
+    DATE_ENTRY = EXIF_IFD + 2
+    COMMENT_ENTRY = EXIF_IFD + 2 + IFD_ENTRY.size
+
+    # DateTimeOriginal is always 19 characters and a NUL
+    DATE_LENGTH = 20
+
+    def __init__(self, make):
+        make_value = self._pad(make.encode() + b"\x00")
+        self._date_offset = self.DATA + len(make_value)
+        self._model_offset = self._date_offset + self.DATE_LENGTH
+
+        tiff = bytearray(self.DATA)
+        tiff[0:8] = b"MM\x00\x2a" + struct.pack(">I", self.ZEROTH_IFD)
+
+        struct.pack_into(">H", tiff, self.ZEROTH_IFD, 3)
+        self._pack_entry(tiff, self.ZEROTH_IFD + 2, piexif.ImageIFD.Make, ASCII, make.encode() + b"\x00", self.DATA)
+        self._pack_entry(tiff, self.MODEL_ENTRY + IFD_ENTRY.size, piexif.ImageIFD.ExifTag, LONG, 1, self.EXIF_IFD)
+
+        struct.pack_into(">H", tiff, self.EXIF_IFD, 2)
+
+        self._header = b"Exif\x00\x00" + bytes(tiff) + make_value
+
+    def format(self, model, date_time, user_comment):
+        """
+        Args:
+            model (bytes): The Model string
+            date_time (string): DateTimeOriginal, 19 characters
+            user_comment (string): The UserComment text
+
+        Returns:
+            bytes: The EXIF block, ready for PIL's save(exif=...) or piexif.insert
+        """
+        model_value = model + b"\x00"
+        date_value = date_time.encode() + b"\x00"
+        comment_value = piexif.helper.UserComment.dump(user_comment)
+
+        if len(date_value) != self.DATE_LENGTH:
+            raise ValueError(f"DateTimeOriginal must be 19 characters, not {date_time!r}")
+
+        padded_model = self._pad(model_value)
+        comment_offset = self._model_offset + len(padded_model)
+
+        exif = bytearray(self._header)
+        base = 6  # Offsets are from the start of the TIFF header, after "Exif\0\0"
+        self._pack_entry(exif, base + self.MODEL_ENTRY, piexif.ImageIFD.Model, ASCII, model_value, self._model_offset)
+        self._pack_entry(exif, base + self.DATE_ENTRY, piexif.ExifIFD.DateTimeOriginal, ASCII, date_value, self._date_offset)
+        self._pack_entry(exif, base + self.COMMENT_ENTRY, piexif.ExifIFD.UserComment, UNDEFINED, comment_value, comment_offset)
+
+        exif += date_value
+        exif += padded_model
+        exif += comment_value
+        return bytes(exif)
+
+    @staticmethod
+    def _pack_entry(buffer, position, tag, field_type, value, offset):
+        """
+        Write an IFD entry. value is the bytes of an ASCII or UNDEFINED field, or the count of a
+        LONG field whose value is offset. Values of 4 bytes or less go in the entry itself.
+        """
+        if field_type == LONG:
+            IFD_ENTRY.pack_into(buffer, position, tag, field_type, value, offset)
+        elif len(value) <= 4:
+            IFD_ENTRY.pack_into(buffer, position, tag, field_type, len(value), 0)
+            buffer[position + 8 : position + 8 + len(value)] = value
+        else:
+            IFD_ENTRY.pack_into(buffer, position, tag, field_type, len(value), offset)
+
+    @staticmethod
+    def _pad(value):
+        # TIFF values start on a word boundary
+        return value + b"\x00" if len(value) % 2 else value
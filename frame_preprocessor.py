@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+
+
+class FramePreprocessor:
+    """
+    Turns lores Y planes into model input, writing straight into the interpreter's input tensor.
+
+    The Y plane is used as a view into the stride-wide camera buffer, resized into a preallocated
+    scratch buffer (or not at all if the lores stream is already the model's size), and then
+    broadcast into all three RGB channels of the input tensor in one write. Nothing is allocated
+    per frame.
+
+    Args:
+        interpreter (InterpreterManager): The interpreter whose input tensor is filled
+        lores_width (int): Width of the lores image, which may be less than the stride
+        lores_height (int): Height of the lores image
+    """
+
+    def __init__(self, interpreter, lores_width, lores_height):
+        self._interpreter = interpreter
+        self._lores_width = lores_width
+        self._lores_height = lores_height
+
+        height = interpreter.input_height
+        width = interpreter.input_width
+
+        self._resized = np.empty((height, width), dtype=np.uint8)
+        self._normalized = np.empty((height, width), dtype=np.float32)
+
+    def fill_input(self, frames):
+        """
+        Preprocess the frames into the input tensor, one per batch entry. The interpreter must
+        already be sized for len(frames).
+
+        Args:
+            frames (list): Lores grey images, (height, stride) or (height, width)
+        """
+        # The view must not outlive this call: the interpreter refuses to invoke while a
+        # reference to its internal buffers exists.
+        input_tensor = self._interpreter.input_tensor()
+
+        for i, grey in enumerate(frames):
+            self._fill(input_tensor[i], grey)
+
+    def _fill(self, target, grey):
+        image = grey[: self._lores_height, : self._lores_width]
+
+        if image.shape == self._resized.shape:
+            resized = image
+        else:
+            resized = cv2.resize(image, self._resized.shape[::-1], dst=self._resized)
+
+        if self._interpreter.floating_model:
+            # (pixel - 127.5) / 127.5
+            np.subtract(resized, 127.5, out=self._normalized)
+            self._normalized /= 127.5
+            resized = self._normalized
+
+        # Grey to RGB by broadcasting the one channel into all three
+        target[...] = resized[:, :, np.newaxis]
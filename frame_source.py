@@ -0,0 +1,298 @@
+import abc
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import cv2
+
+
+try:
+    from picamera2 import MappedArray
+except ImportError:
+    # Not on a Pi. Only replay frame sources can be used.
+    MappedArray = None
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class FrameSourceExhausted(Exception):
+    """A replay source has no more frames."""
+
+
+class FrameSource(abc.ABC):
+    """
+    Where the capture loop gets its frames from.
+
+    This mirrors the parts of Picamera2 that the loop, detector and saver use, so a source can be
+    a live camera or something that only pretends to be one. The lores stream is YUV420 and the
+    main stream is XBGR8888, i.e. [R, G, B, 255] pixels, the same as the camera gives us.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @abc.abstractmethod
+    def stream_configuration(self, name):
+        pass
+
+    @abc.abstractmethod
+    def capture_buffer(self, name):
+        pass
+
+    @abc.abstractmethod
+    def capture_array(self, name):
+        pass
+
+    @abc.abstractmethod
+    def capture_request(self):
+        """
+        Returns:
+            FrameRequest: Every stream of one frame. Must be released.
+        """
+
+
+class FrameRequest(abc.ABC):
+    """
+    All the streams of a single frame, so the lores image that is analyzed and the main image
+    that is saved are the same moment. A camera request holds one of the camera's buffers until
+    it is released, so release it as soon as possible.
+    """
+
+    @abc.abstractmethod
+    def lores_buffer(self):
+        """
+        A context manager that yields the lores stream without copying it. Only valid inside the
+        with block.
+        """
+
+    @abc.abstractmethod
+    def make_array(self, name):
+        """
+        Returns:
+            ndarray: A copy of the stream that stays valid after release()
+        """
+
+    def release(self):
+        pass
+
+
+class Picamera2Request(FrameRequest):
+    def __init__(self, request):
+        self._request = request
+
+    @contextmanager
+    def lores_buffer(self):
+        with MappedArray(self._request, "lores") as mapped:
+            yield mapped.array
+
+    def make_array(self, name):
+        return self._request.make_array(name)
+
+    def release(self):
+        self._request.release()
+
+
+class ReplayRequest(FrameRequest):
+    def __init__(self, lores, main):
+        self._lores = lores
+        self._main = main
+
+    @contextmanager
+    def lores_buffer(self):
+        yield self._lores
+
+    def make_array(self, name):
+        # Each replayed frame gets new arrays, so there is nothing to copy
+        return self._lores if name == "lores" else self._main
+
+
+class Picamera2FrameSource(FrameSource):
+    """
+    A live camera.
+
+    Args:
+        picam2 (Picamera2): A configured camera, e.g. from TensorFlowDetect.start_camera
+    """
+
+    def __init__(self, picam2):
+        self._picam2 = picam2
+
+    def start(self):
+        self._picam2.start()
+
+    def stop(self):
+        self._picam2.stop()
+
+    def stream_configuration(self, name):
+        return self._picam2.stream_configuration(name)
+
+    def capture_buffer(self, name):
+        return self._picam2.capture_buffer(name)
+
+    def capture_array(self, name):
+        return self._picam2.capture_array(name)
+
+    def capture_request(self):
+        return Picamera2Request(self._picam2.capture_request())
+
+
+class ReplayFrameSource(FrameSource):
+    """
+    Replays a directory of saved images or a video file as if it were a camera.
+
+    Each capture_buffer or capture_request call moves on to the next frame. capture_array returns
+    the streams of the current frame. In realtime
+    pacing, frames are handed out no faster than fps, like a camera. In fast pacing they are
+    handed out as soon as they are asked for.
+
+    Args:
+        config (dict): The whole configuration. Uses [replay] and the stream sizes from [tflite].
+    """
+
+    def __init__(self, config):
+        self._path = config['replay']['path']
+        self._realtime = config['replay']['pacing'] == "realtime"
+        self._fps = config['replay']['fps']
+        self._loop = config['replay']['loop']
+
+        self._lores_size = (config['tflite']['lores_width'], config['tflite']['lores_height'])
+        self._main_size = (config['tflite']['main_width'], config['tflite']['main_height'])
+
+        self._files = None
+        self._video = None
+        self._next_file = 0
+        self._next_frame_time = None
+
+        self._lores = None
+        self._main = None
+
+    def start(self):
+        if os.path.isdir(self._path):
+            self._files = sorted(
+                entry.path
+                for entry in os.scandir(self._path)
+                if entry.name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            logging.info(f"Replaying {len(self._files)} images from {self._path}")
+        else:
+            self._video = cv2.VideoCapture(self._path)
+            if not self._video.isOpened():
+                raise FileNotFoundError(f"Can't open replay video {self._path}")
+            if not self._fps:
+                self._fps = self._video.get(cv2.CAP_PROP_FPS)
+            logging.info(f"Replaying video {self._path} at {self._fps} fps")
+
+        self._next_frame_time = time.monotonic()
+
+    def stop(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+    def stream_configuration(self, name):
+        width, height = self._lores_size if name == "lores" else self._main_size
+        if name == "lores":
+            return {"size": (width, height), "stride": width, "format": "YUV420"}
+        return {"size": (width, height), "stride": width * 4, "format": "XBGR8888"}
+
+    def capture_buffer(self, name):
+        self._wait_for_frame()
+        self._load(self._read_next())
+
+        if name == "lores":
+            return self._lores.ravel()
+        return self._main.ravel()
+
+    def capture_array(self, name):
+        if self._lores is None:
+            self._load(self._read_next())
+
+        if name == "lores":
+            return self._lores
+        return self._main
+
+    def capture_request(self):
+        self._wait_for_frame()
+        self._load(self._read_next())
+
+        return ReplayRequest(self._lores, self._main)
+
+    def _wait_for_frame(self):
+        if not self._realtime or not self._fps:
+            return
+
+        delay = self._next_frame_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame_time = max(self._next_frame_time, time.monotonic()) + 1.0 / self._fps
+
+    def _read_next(self):
+        """
+        Returns:
+            ndarray: The next BGR image, starting again at the beginning if looping
+        """
+        image = self._read_image() if self._files is not None else self._read_video()
+
+        if image is None and self._loop:
+            self._rewind()
+            image = self._read_image() if self._files is not None else self._read_video()
+
+        if image is None:
+            raise FrameSourceExhausted(self._path)
+
+        return image
+
+    def _read_image(self):
+        while self._next_file < len(self._files):
+            file_path = self._files[self._next_file]
+            self._next_file += 1
+
+            image = cv2.imread(file_path)
+            if image is not None:
+                return image
+            logging.warning(f"Skipping unreadable replay image {file_path}")
+
+        return None
+
+    def _read_video(self):
+        ok, image = self._video.read()
+        return image if ok else None
+
+    def _rewind(self):
+        if self._files is not None:
+            self._next_file = 0
+        else:
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def _load(self, image):
+        """
+        Make the lores and main streams from a BGR image.
+        """
+        lores = cv2.resize(image, self._lores_size, interpolation=cv2.INTER_AREA)
+        self._lores = cv2.cvtColor(lores, cv2.COLOR_BGR2YUV_I420)
+
+        if (image.shape[1], image.shape[0]) != self._main_size:
+            image = cv2.resize(image, self._main_size)
+        self._main = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
+
+
+def open_frame_source(config, algorithm, camera_num):
+    """
+    Create the frame source for a camera number, based on [capture] source.
+
+    Args:
+        config (dict): The whole configuration
+        algorithm (TensorFlowDetect): Configures and starts live cameras
+        camera_num (int): The camera to open
+
+    Returns:
+        FrameSource: The source. Call start() before capturing.
+    """
+    if config['capture']['source'] == "replay":
+        return ReplayFrameSource(config)
+
+    return Picamera2FrameSource(algorithm.start_camera(camera_num))
@@ -0,0 +1,89 @@
+import logging
+
+import metrics
+
+
+ACTIVE = "active"
+IDLE = "idle"
+
+
+class IdleMode:
+    """
+    Suspends inference on PIR equipped nodes until the PIR says there may be something to see.
+
+    In idle mode frames are still captured, so PIR and timed saves happen, but the detector only
+    runs every sanity_interval seconds, or never if that is 0. A PIR trigger switches to active
+    mode, where every frame goes to the detector, until hold_time seconds after the PIR was last
+    seen. Transitions are counted and the time spent in each mode is added to the
+    idle_mode_active_seconds and idle_mode_idle_seconds counters.
+
+    Args:
+        config (dict): The whole configuration. Uses [idle_mode] and [pir] check_pir.
+    """
+
+    def __init__(self, config):
+        self._enable = config['idle_mode']['enable'] and config['pir']['check_pir']
+        self._hold_time = config['idle_mode']['hold_time']
+        self._sanity_interval = config['idle_mode']['sanity_interval']
+
+        # Start active, so the scene is checked straight away
+        self._mode = ACTIVE
+        self._last_pir = None
+        self._mode_since = None
+        self._last_inference = {}
+
+    def mode(self):
+        return self._mode
+
+    def should_detect(self, camera_num, now, pir):
+        """
+        Decide whether this frame may go on to the motion gate and detector.
+
+        Args:
+            camera_num (int): Camera the frame came from. Each has its own sanity schedule.
+            now (datetime): Capture time of the frame
+            pir (bool): The PIR state when the frame was captured
+
+        Returns:
+            bool: False if inference is suspended for this frame
+        """
+        if not self._enable:
+            return True
+
+        if self._mode_since is None:
+            self._mode_since = now
+            self._last_pir = now
+
+        if pir:
+            self._last_pir = now
+
+        mode = ACTIVE if (now - self._last_pir).total_seconds() < self._hold_time else IDLE
+        if mode != self._mode:
+            self._switch(mode, now)
+        else:
+            self._account(now)
+
+        if mode == ACTIVE:
+            self._last_inference[camera_num] = now
+            return True
+
+        last = self._last_inference.get(camera_num)
+        if self._sanity_interval and (last is None or (now - last).total_seconds() >= self._sanity_interval):
+            self._last_inference[camera_num] = now
+            metrics.count("idle_mode_sanity_checks")
+            return True
+
+        return False
+
+    def _switch(self, mode, now):
+        self._account(now)
+        logging.info(f"Switching to {mode} mode")
+
+        self._mode = mode
+        metrics.count(f"idle_mode_to_{mode}")
+        metrics.set_gauge("idle_mode", int(mode == IDLE))
+
+    def _account(self, now):
+        # Add the time since the last frame to the current mode
+        metrics.count(f"idle_mode_{self._mode}_seconds", (now - self._mode_since).total_seconds())
+        self._mode_since = now
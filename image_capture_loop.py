@@ -1,45 +1,100 @@
+import contextlib
 import datetime
 import logging
-import traceback
-from time import sleep
 import platform
+import queue
+import threading
+import time
+import traceback
 
-from libcamera import Transform
-from picamera2 import Picamera2
-from picamera2 import Preview
+import metrics
+from capture_data import CaptureData
+from frame_source import FrameSourceExhausted
+from frame_source import open_frame_source
+from idle_mode import IdleMode
+from image_saver import BURST
+from image_saver import DETECTION
+from image_saver import PIR
+from image_saver import TIMED
+from image_saver import ImageSaver
+from loop_scheduler import LoopScheduler
+from motion_gate import MotionGate
+from object_tracker import ObjectTracker
+from pre_event_buffer import PreEventBuffer
+from tensor_flow_detect import TensorFlowDetect
 
-import numpy as np
 
+# Other detection algorithms to try
 # from adaptive_threshold import AdaptiveThreshold
 # from histogram_difference import HistogramDifference
-from image_saver import ImageSaver
 # from opencv_object_detection import OpenCVObjectDetection
-from tensor_flow_detect import TensorFlowDetect
 
-from capture_data import CaptureData
+# Passed down the pipeline on shutdown. Each stage forwards it once its queue has been drained.
+_STOP = object()
+
 
 class ImageCaptureLoop:
     """This class is the overall motion detector loop.
 
        Supported opencv_object_detection. Adding tensor_flow_detect.
+
+    Args:
+        config (dict): The whole configuration
+        pir_thread (MonitorPIR): Reports the PIR state, if there is one
+        algorithm: The detector. A TensorFlowDetect if not given.
     """
 
-    def __init__(self, config, pir_thread = None):
+    def __init__(self, config, pir_thread = None, algorithm=None):
+        self._config = config
 
         # self._algorithm = HistogramDifference(config)
         # self._algorithm = AdaptiveThreshold(config)
         # self._algorithm = OpenCVObjectDetection(config)
-        self._algorithm = TensorFlowDetect(config['tflite'], config['capture']['flip'], config['preview']['enable'])
+        if algorithm is None:
+            algorithm = TensorFlowDetect(config['tflite'], config['capture']['flip'], config['preview']['enable'])
+        self._algorithm = algorithm
 
+        # All cameras share the one detector, so only one model is held in memory.
+        self._camera_nums = list(config['capture']['cameras'])
         self._camera_list = self.__set_up_cameras(
-            config['capture']['cameras'], config['preview']['enable']
+            self._camera_nums, config['preview']['enable']
         )
 
         self._image_saver = ImageSaver()
         self._save_every_seconds = config['capture']['save_anyways_hours'] * 3600
 
         self._pir_thread = pir_thread
-        self._delay = config['capture']['delay']
+        self._schedulers = {camera_num: LoopScheduler(config, camera_num) for camera_num in self._camera_nums}
+
+        # Bounded queues between the capture -> detect -> persist stages
+        self._detect_queue = queue.Queue(maxsize=config['pipeline']['detect_queue_depth'])
+        self._persist_queue = queue.Queue(maxsize=config['pipeline']['persist_queue_depth'])
+        self._join_timeout = config['pipeline']['join_timeout']
+
+        self._stop_event = threading.Event()
+        self._burst_events = {camera_num: threading.Event() for camera_num in self._camera_nums}
+
+        # Set to end a capture stage's wait early: on a PIR edge, or to stop
+        self._wake_events = {camera_num: threading.Event() for camera_num in self._camera_nums}
+        if pir_thread is not None:
+            for wake in self._wake_events.values():
+                pir_thread.add_wake_event(wake)
+
+        # Only touched by the detect stage
+        self._max_batch = config['tflite']['max_batch']
+        self._idle_mode = IdleMode(config)
+        self._motion_gate = MotionGate(config)
+        self._tracker = ObjectTracker(config)
+        self._pre_event = PreEventBuffer(config)
+        self._node_name = platform.node()
+        self._time_of_last_save = {
+            camera_num: datetime.datetime(datetime.MINYEAR, 1, 1, tzinfo=None)
+            for camera_num in self._camera_nums
+        }
+        self._burst = {camera_num: False for camera_num in self._camera_nums}
+        self._burst_cnt = {camera_num: 0 for camera_num in self._camera_nums}
+        self._threads = []
+        self._stopped = False
 
     def start(self):
         """
@@ -51,118 +106,366 @@ class ImageCaptureLoop:
 
         self.loop()
 
+    def stop(self):
+        """
+        Stops the capture stage, waits for the frames already queued to be detected and saved,
+        then stops the cameras. Only the first call does anything, so it is safe to call from
+        the signal handler as well as at the end of loop().
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+
+        self._stop_event.set()
+        for wake in self._wake_events.values():
+            wake.set()
+
+        for thread in self._threads:
+            thread.join(timeout=self._join_timeout)
+            if thread.is_alive():
+                logging.warning(f"Pipeline stage {thread.name} did not stop")
+
+        self._pre_event.close()
+        self._image_saver.close(timeout=self._join_timeout)
+
+        for camera_num, camera in zip(self._camera_nums, self._camera_list):
+            try:
+                camera.stop()
+            except Exception as e:
+                logging.error(f"An error occurred stopping camera {camera_num}: {e}")
+
     def loop(self):
         """
-        Repeated loop. Each iteration capture images from all cameras and then processes it.
+        Runs the capture, detect and persist stages on their own threads and waits until stopped.
 
-        The loop also checks the PIR to determine if images should be captured.
+        The stages are joined by bounded queues, so a slow save applies back pressure instead of
+        using unbounded memory, but it no longer holds up detection of the next frame. On stop,
+        the capture stage sends _STOP down the pipeline and each stage drains its queue before
+        passing it on. There is one capture stage per camera, all feeding the same detect stage.
+        """
+        self._threads = [
+            threading.Thread(
+                target=self._capture_stage,
+                args=(camera_num, camera),
+                name=f"capture-{camera_num}",
+                daemon=True,
+            )
+            for camera_num, camera in zip(self._camera_nums, self._camera_list)
+        ]
+        self._threads += [
+            threading.Thread(target=self._detect_stage, name="detect", daemon=True),
+            threading.Thread(target=self._persist_stage, name="persist", daemon=True),
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+        # Wait with a timeout so the main thread still gets to run signal handlers.
+        while not self._stop_event.is_set():
+            self._stop_event.wait(1)
+
+        self.stop()
+
+    def _capture_stage(self, camera_num, camera):
         """
-        time_of_last_save = datetime.datetime(datetime.MINYEAR, 1, 1, tzinfo=None)
+        Captures a frame from one camera and reads the PIR, then hands them to the detect stage.
 
-        logger = logging.getLogger()
+        The frame is a single request holding both streams, so the saved image is the frame that
+        was analyzed. The detect stage releases it.
 
-        burst = False
-        burst_cnt = 0
+        Waits until the camera's scheduler says the next frame is due unless a burst is in
+        progress, in which case frames are captured back-to-back. A PIR edge cuts the wait short.
+        """
+        last_capture = None
+        scheduler = self._schedulers[camera_num]
+        wake = self._wake_events[camera_num]
+        woken = False
 
-        while True:
+        while not self._stop_event.is_set():
             try:
                 if self._pir_thread is not None:
                     pir = self._pir_thread.pir_detected()
                 else:
                     pir = False
 
+                if pir:
+                    scheduler.notify_activity()
+
                 # GET THE IMAGE
-                # TensorFlow uses capture_buffer.  OpenCV uses capture_array.
-                # "The capture_buffer method will give you the raw camera data for each frame (a JPEG"
-                # bitstream from an MJPEG camera, or an uncompressed YUYV image from a YUYV camera)"
-                # "capture_array() returns a numpy array representing the image"
-                # Both of these have a plural version.
-
-                grey = self._algorithm.get_image_from_camera(self._camera_list[0])  # TODO: Either allow more than one in the code, or remove it as a config option
-                
-                # FORMER OPENCV CODE:
-                # capture_arrays = []
-                # for picam in self._camera_list:
-                #     lores_array = picam.capture_array("lores")
-                #     main_array = picam.capture_array("main")
-                #     capture_arrays.append(
-                #         [lores_array, main_array]
-                #     )  # capture_arrays is an array where each element is also an array. The first item in the element is the lores array. The second is the main.
-
-
-                capture_data = CaptureData()
-                capture_data.capture_time = datetime.datetime.now()
-                capture_data.pir_fired = pir
-                capture_data.node_name = platform.node()
-                capture_data.camera_num = 0  # TODO: Fix this
-                capture_data.object_detected = False
+                # One capture_request() gives every stream of the same frame. The lores stream is
+                # mapped for inference without copying, and main is only copied if it is saved.
+                request = camera.capture_request()
+
+                now = time.monotonic()
+                if last_capture is not None:
+                    metrics.record("loop_period", now - last_capture)
+                last_capture = now
+                metrics.count("frames")
+
+                if woken and pir and self._pir_thread.last_trigger() is not None:
+                    metrics.record("pir_to_capture", now - self._pir_thread.last_trigger())
+
+                self._detect_queue.put((camera_num, camera, request, datetime.datetime.now(), pir))
+
+            except FrameSourceExhausted:
+                logging.info(f"Camera {camera_num} has no more frames")
+                break
+
+            except Exception as e:
+                logging.error(f"An error occurred in the capture stage for camera {camera_num}: {e}")
+                traceback.print_exc()
+
+            if self._burst_events[camera_num].is_set():
+                woken = False
+                scheduler.restart()
+            else:
+                woken = wake.wait(scheduler.next_wait())
+                wake.clear()
+                if woken:
+                    scheduler.restart()
+
+        self._detect_queue.put(_STOP)
+
+    def _detect_stage(self):
+        """
+        Runs inference on the frames and decides whether to save each one. Frames to be saved
+        are handed to the persist stage along with their CaptureData.
+
+        Whatever frames are waiting, e.g. one from each camera, are run through the model as
+        one batch of up to max_batch frames. Frames the motion gate holds back skip inference
+        but still go through the save decision, so PIR and timed saves still happen.
+        """
+        # Every capture stage sends its own _STOP
+        running_cameras = len(self._camera_nums)
+
+        while running_cameras > 0:
+            items = self._next_batch()
+            frames = [item for item in items if item is not _STOP]
+            running_cameras -= len(items) - len(frames)
+
+            if not frames:
+                continue
+
+            try:
+                self._detect_frames(frames)
+            finally:
+                for frame in frames:
+                    frame[2].release()
+
+        self._persist_queue.put(_STOP)
+
+    def _detect_frames(self, frames):
+        """
+        Run one batch of frames through the motion gate and detector, then decide on each save.
+        The lores streams are only mapped for the duration of this call.
+        """
+        with contextlib.ExitStack() as stack:
+            try:
+                greys = [
+                    stack.enter_context(self._algorithm.image_from_request(camera, request))
+                    for camera_num, camera, request, capture_time, pir in frames
+                ]
+
+                to_detect = [self._gate_frame(frame, grey) for frame, grey in zip(frames, greys)]
+
+                metrics.count("skipped_frames", to_detect.count(False))
 
                 # RUN INFERENCE AND PERFORM OBJECT DETECTION
-                rectangles, scores, classes = self._algorithm.detect_objects(grey)
+                grey_frames = [grey for grey, detect in zip(greys, to_detect) if detect]
+                detected = iter([])
+                if grey_frames:
+                    with metrics.timer("inference"):
+                        detected = iter(self._algorithm.detect_objects_batch(grey_frames))
+                results = [
+                    next(detected) if detect else self._algorithm.empty_result() for detect in to_detect
+                ]
+            except Exception as e:
+                logging.error(f"An error occurred running inference: {e}")
+                traceback.print_exc()
+                return
 
-                capture_data.rectangles = rectangles
-                capture_data.classes = classes
-                capture_data.scores = scores   
+        for frame, result, detected in zip(frames, results, to_detect):
+            try:
+                self._handle_detection(frame, result, detected)
+            except Exception as e:
+                logging.error(f"An error occurred in the detect stage: {e}")
+                traceback.print_exc()
+
+    def _gate_frame(self, frame, grey):
+        """
+        Returns:
+            bool: True if the frame should go to the detector
+        """
+        camera_num, camera, request, capture_time, pir = frame
 
+        # The idle mode check comes first. An idle frame still goes into the motion gate's
+        # background, so the background is current when the PIR wakes the node.
+        if not self._idle_mode.should_detect(camera_num, capture_time, pir):
+            self._motion_gate.learn(camera_num, grey)
+            return False
 
-                if len(rectangles) > 0:
-                    capture_data.object_detected = True
+        return self._motion_gate.should_detect(camera_num, grey, capture_time, force=pir)
 
-                logger.debug(
-                    f"Checked images at: {capture_data.capture_time_str()} Object detected: {capture_data.object_detected}"
-                )
+    def _next_batch(self):
+        """
+        Wait for a frame, then take whatever else is already queued, up to max_batch.
+        """
+        items = [self._detect_queue.get()]
+
+        while len(items) < self._max_batch:
+            try:
+                items.append(self._detect_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return items
+
+    def _handle_detection(self, frame, result, detected):
+        """
+        Decide whether to save one frame. Save times and bursts are tracked separately for
+        each camera.
+
+        With the tracker on, a detection only triggers a save when it is a new object, one that
+        came back into view, or one that is due a periodic refresh. detected is False for frames
+        that skipped inference, which leave the tracks alone.
+        """
+        logger = logging.getLogger()
+
+        camera_num, camera, request, capture_time, pir = frame
+        boxes, scores, class_ids = result
+
+        object_detected = len(boxes) > 0
+
+        metrics.count("detections", len(boxes))
+
+        if object_detected:
+            metrics.set_gauge("last_detection_time", capture_time.timestamp())
+            self._schedulers[camera_num].notify_activity()
+
+        logger.debug(
+            f"Checked images at: {capture_time:%Y-%m-%d_%H-%M-%S} Object detected: {object_detected}"
+        )
+
+        track_ids = None
+        object_triggered = object_detected
+        if self._tracker.enabled and detected:
+            track_ids, reasons = self._tracker.update(camera_num, boxes, class_ids, capture_time)
+            object_triggered = any(reason is not None for reason in reasons)
+
+        triggered = object_triggered or pir
+
+        save = (
+            triggered
+            or (
+                (capture_time - self._time_of_last_save[camera_num]).total_seconds()
+                > self._save_every_seconds
+            )
+            or self._burst[camera_num]
+        )
 
-                if (
-                    capture_data.object_detected
-                    or pir
-                    or (
-                        (capture_data.capture_time - time_of_last_save).total_seconds()
-                        > self._save_every_seconds
+        # Only frames the tracker actually kept from being saved, not those saved for another reason
+        if object_detected and not object_triggered and not save:
+            metrics.count("tracked_frames_not_saved")
+
+        if save:
+            # The frames after the one that started a burst are burst saves, even while the PIR
+            # is still high, so they are never skipped as duplicates
+            if object_triggered:
+                save_reason = DETECTION
+            elif self._burst[camera_num]:
+                save_reason = BURST
+            elif pir:
+                save_reason = PIR
+            else:
+                save_reason = TIMED
+
+            if triggered and not self._burst[camera_num]:
+                # A new event. Save the frames from just before it first.
+                for jpeg, pre_capture_data in self._pre_event.drain(camera_num):
+                    self._persist_queue.put(
+                        (self._image_saver.save_encoded, (jpeg, pre_capture_data))
                     )
-                    or burst
-                ):
-                    # SAVE THE IMAGE
-                    self._image_saver.save_array(
-                    self._camera_list[0].capture_array("lores"),
-                    self._camera_list[0].capture_array("main"),
-                    capture_data)
-
-                    # FORMER OPENCV_CODE
-                    # for i in range(len(capture_arrays)):
-                    #     self._image_saver.save_array(
-                    #         capture_arrays[i][0],
-                    #         capture_arrays[i][1],
-                    #         capture_time,
-                    #         any_motion_detected,
-                    #         pir,
-                    #         i,
-                    #         self._algorithm.get_object_detection_data(algorithm_data),
-                    #     )
-
-                    time_of_last_save = capture_data.capture_time
-
-                    if not burst:
-                        burst = True
-                        burst_cnt = 3
-                    else:
-                        burst_cnt -= 1
-                        if burst_cnt == 0:
-                            burst = False
-
-                logger.debug(f"Burst: {burst} Burst count: {burst_cnt}")
 
-            except Exception as e:
-                    logging.error(f"An error occurred in the image capture loop: {e}")
-                    traceback.print_exc()
-                    continue
+            # Copy the streams out of the request that was analyzed, so it can be released.
+            # Encoding and writing happen on the persist stage.
+            self._persist_queue.put(
+                (
+                    self._image_saver.save_array,
+                    (
+                        request.make_array("lores"),
+                        request.make_array("main"),
+                        self._make_capture_data(frame, result, track_ids),
+                        save_reason,
+                    ),
+                )
+            )
+
+            self._time_of_last_save[camera_num] = capture_time
+
+            if not self._burst[camera_num]:
+                self._burst[camera_num] = True
+                self._burst_cnt[camera_num] = 3
+            else:
+                self._burst_cnt[camera_num] -= 1
+                if self._burst_cnt[camera_num] == 0:
+                    self._burst[camera_num] = False
+
+        elif self._pre_event.enabled and self._pre_event.wants_frame():
+            self._pre_event.add(
+                camera_num, request.make_array("main"), self._make_capture_data(frame, result, track_ids)
+            )
+
+        if self._burst[camera_num]:
+            self._burst_events[camera_num].set()
+        else:
+            self._burst_events[camera_num].clear()
+
+        logger.debug(f"Camera {camera_num} Burst: {self._burst[camera_num]} Burst count: {self._burst_cnt[camera_num]}")
+
+    def _make_capture_data(self, frame, result, track_ids=None):
+        """
+        Only called for frames that are kept, so the rest never allocate one.
+        """
+        camera_num, camera, request, capture_time, pir = frame
+        boxes, scores, class_ids = result
+
+        capture_data = CaptureData()
+        capture_data.capture_time = capture_time
+        capture_data.pir_fired = pir
+        capture_data.node_name = self._node_name
+        capture_data.camera_num = camera_num
+        capture_data.object_detected = len(boxes) > 0
+        capture_data.set_detections(boxes, scores, class_ids, track_ids)
+        capture_data.set_labels(self._algorithm.labels())
+
+        return capture_data
 
-            if not burst:
-                sleep(self._delay)
+    def _persist_stage(self):
+        """
+        Builds the EXIF, encodes and writes each image handed over by the detect stage. Each
+        item is an ImageSaver method and its arguments.
+        """
+        while True:
+            item = self._persist_queue.get()
+            if item is _STOP:
+                # Everything has drained, e.g. a replay ran out of frames. Let loop() finish.
+                self._stop_event.set()
+                return
+
+            save, args = item
+
+            try:
+                save(*args)
+            except Exception as e:
+                logging.error(f"An error occurred in the persist stage: {e}")
+                traceback.print_exc()
 
     def __set_up_cameras(self, cameras, enable_preview):
         """
         Configures the camera, preview window and encoder.
 
+        Each camera is a FrameSource: a live Picamera2, or a replay of saved images or video.
+
         :param cameras: a list of camera numbers to start.
         :param enable_preview: enables preview window
         """
@@ -171,9 +474,9 @@ class ImageCaptureLoop:
 
         for camera_num in cameras:
 
-            picam = self._algorithm.start_camera(camera_num)
+            camera = open_frame_source(self._config, self._algorithm, camera_num)
 
-            camera_list.append(picam)
+            camera_list.append(camera)
 
         return camera_list
 
@@ -211,12 +514,3 @@ class ImageCaptureLoop:
         #         width=self._config["preview"]["width"],
         #         height=self._config["preview"]["height"],
         #     )
-
-
-    # TODO: Call this when appropriate. Figure out how we're handling the camera array.
-    def cleanup(self):
-        """
-        Cleans up the camera and preview window.
-        """
-        self._picam2.stop()
-        self._algorithm.cleanup()
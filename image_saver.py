@@ -1,13 +1,21 @@
+import collections
+import io
 import logging
 import platform
+import queue
+import threading
 
+import cv2
+import numpy as np
 import piexif
-import piexif.helper
-
 from PIL import Image
 from PIL.ExifTags import TAGS
 
+import metrics
 from capture_data import CaptureData
+from capture_index import CaptureIndex
+from exif_template import ExifTemplate
+from jpeg_encoder import make_encoder
 
 
 def get_exif_tag_id(tag_name):
@@ -17,6 +25,22 @@ def get_exif_tag_id(tag_name):
     return None
 
 
+def dhash(grey):
+    """
+    Difference hash: shrink to 9x8 and compare each pixel with its right hand neighbour. Frames
+    that look the same have hashes that differ in only a few bits.
+
+    Args:
+        grey (ndarray): A greyscale image, e.g. the Y plane of the lores stream
+
+    Returns:
+        int: The 64 bit hash
+    """
+    small = cv2.resize(grey, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(bytes(np.packbits(bits)), "big")
+
+
 def singleton(cls):
     instances = {}  # Dictionary to store the single instance
 
@@ -28,47 +52,143 @@ def singleton(cls):
     return get_instance
 
 
+# Tells a write-behind worker to exit
+_STOP = object()
+
+# Why a frame is saved. Only TIMED and PIR saves are checked for duplicates.
+DETECTION = "detection"
+BURST = "burst"
+PIR = "pir"
+TIMED = "timed"
+
+
 @singleton
 class ImageSaver:
+    """
+    Formats and writes the images. Either synchronously on the caller's thread, or write-behind:
+    save_array queues the frame and a small pool of worker threads encodes and writes it. JPEG
+    encoding and file I/O release the GIL, so the workers overlap with detection.
+    """
+
     def __init__(self):
         self.__directory = None
         self._logger = logging.getLogger()
 
+        self._queue = None
+        self._workers = []
+        self._index = None
+
+        # Counters. Guarded by _lock, and _idle is notified whenever pending drops to zero.
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queued = 0
+        self._written = 0
+        self._failed = 0
+
+        # Hashes of the most recent saves of each camera, oldest first
+        self._recent_hashes = {}
+
     def set_config(self, config):
         self._config = config
+        self._encoder = make_encoder(config['saver'])
+        self._exif_template = ExifTemplate("Camera Module 3")
 
-    def format_exif(self, capture_data):
-        logger = logging.getLogger()
+        metadata = config['saver']['metadata']
+        if metadata not in ("exif", "sidecar", "both"):
+            raise ValueError(f"[saver] metadata must be exif, sidecar or both, not {metadata}")
+        self._exif = metadata in ("exif", "both")
+        self._sidecar = metadata in ("sidecar", "both")
 
-        user_comment = capture_data.to_json()
-        logger.info(f"User Comment: {user_comment}")
+        if config['index']['enable'] and self._index is None:
+            self._index = CaptureIndex(config)
 
-        formatted_comment = piexif.helper.UserComment.dump(str(user_comment))
+        if config['saver']['write_behind'] and not self._workers:
+            self._start_workers(config['saver']['workers'], config['saver']['queue_depth'])
 
-        formatted_model = capture_data.to_short_string().encode()
+    def _start_workers(self, num_workers, queue_depth):
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"saver-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
 
-        time_str = capture_data.capture_time_str()
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
 
-        zeroth_ifd = {
-            piexif.ImageIFD.Make: "Camera Module 3",
-            piexif.ImageIFD.Model: formatted_model,
-        }
-        exif_ifd = {
-            piexif.ExifIFD.DateTimeOriginal: time_str,  # FIXME: Should this be a string?
-            piexif.ExifIFD.UserComment: formatted_comment,
-        }
-        gps_ifd = {}
-        first_ifd = {}
+            write, args = item
+            self._write_and_count(write, *args)
 
-        exif_dict = {
-            "0th": zeroth_ifd,
-            "Exif": exif_ifd,
-            "GPS": gps_ifd,
-            "1st": first_ifd,
-        }
-        exif_bytes = piexif.dump(exif_dict)
+    def write_behind(self):
+        return bool(self._workers)
 
-        return exif_bytes
+    def stats(self):
+        """
+        Returns:
+            dict: queued, written and failed save counts, plus how many are still pending.
+        """
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "written": self._written,
+                "failed": self._failed,
+                "pending": self._queued - self._written - self._failed,
+            }
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued image has been written or has failed.
+
+        Args:
+            timeout (float): Seconds to wait. None waits forever.
+
+        Returns:
+            bool: True if nothing is pending.
+        """
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: self._queued == self._written + self._failed, timeout
+            )
+
+    def close(self, timeout=None):
+        """
+        Flush the queue and stop the write-behind workers. Later saves are written synchronously
+        until set_config starts the workers again.
+        """
+        self.flush(timeout)
+
+        workers = self._workers
+        self._workers = []
+        for _ in workers:
+            self._queue.put(_STOP)
+        for worker in workers:
+            worker.join(timeout)
+
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def format_exif(self, capture_data):
+        user_comment = capture_data.to_json()
+        self._logger.debug(f"User Comment: {user_comment}")
+
+        # FIXME: Should DateTimeOriginal be in the EXIF "%Y:%m:%d %H:%M:%S" format?
+        return self._exif_template.format(
+            capture_data.to_short_string().encode(),
+            capture_data.capture_time_str(),
+            user_comment,
+        )
+
+    def format_sidecar(self, capture_data):
+        """
+        Returns:
+            bytes: The capture data as JSON, for a .json file next to the image
+        """
+        return capture_data.to_json().encode()
 
     def format_file_name(self, node, capture_time_str, camera_num, motion_detected, pir, stream_name):
         file_name = (
@@ -87,8 +207,10 @@ class ImageSaver:
         lores_array,
         main_array,
         capture_data,
+        reason=DETECTION,
     ):
-        """Save an array. Either intermediate or final.
+        """Save an array. Either intermediate or final. In write-behind mode this only queues
+        the arrays, blocking if the queue is full, and the caller must not modify them afterwards.
 
         Args:
             lowres_array (_type_): The Array received from picamera2 get array
@@ -99,27 +221,150 @@ class ImageSaver:
             camera_num (string): What stream is this? "lores" or "main"
             image_tag (char): Where does this come from in the processing chain? 'd' = detection image, 'i' = intermediate image, 't' = timed image
             algorithm_data (ditectionary): dictionary of data from the algorithm.
+            reason (string): Why the frame is saved: DETECTION, BURST, PIR or TIMED
         """
-        try:
-            if self._config["capture"]["save_images"]:
-                exif_bytes = self.format_exif(capture_data)
-
-                # image = Image.fromarray(lores_array).convert("RGB")
-                # file_name = self.format_file_name(
-                #     platform.node(), capture_time, str(camera_num), motion_detected, pir, "lores"
-                # )
-                # image.save(file_name, exif=exif_bytes)
-
-                image = Image.fromarray(main_array).convert("RGB")
-                file_name = self.format_file_name(
-                    platform.node(),
-                    capture_data.capture_time_str(),
-                    str(capture_data.camera_num),
-                    capture_data.object_detected,
-                    capture_data.pir_fired,
-                    "Main",  # Make it a capital M so it sorts before the lores stream
-                )
-                image.save(file_name, exif=exif_bytes)
+        if self._is_duplicate(lores_array, capture_data, reason):
+            return
+
+        self._submit(self._write, lores_array, main_array, capture_data)
+
+    def _is_duplicate(self, lores_array, capture_data, reason):
+        """
+        Check a save against the camera's recently saved frames and remember its hash. Only
+        timed and PIR-only saves are ever skipped, never a detection or the burst after one.
+
+        Returns:
+            bool: True if the frame is a near duplicate and shouldn't be saved
+        """
+        if not self._config['saver']['dedup'] or lores_array is None:
+            return False
+
+        # The Y plane of the YUV420 lores stream, without any stride padding
+        lores_height = lores_array.shape[0] * 2 // 3
+        frame_hash = dhash(lores_array[:lores_height, : self._config['tflite']['lores_width']])
+
+        recent = self._recent_hashes.setdefault(capture_data.camera_num, collections.OrderedDict())
+
+        if reason in (TIMED, PIR):
+            for saved_hash in recent:
+                if bin(frame_hash ^ saved_hash).count("1") <= self._config['saver']['dedup_distance']:
+                    recent.move_to_end(saved_hash)
+                    metrics.count("duplicate_skips")
+                    self._logger.info(
+                        f"Skipping camera {capture_data.camera_num} image at "
+                        f"{capture_data.capture_time_str()}: {reason} save same as a recent save"
+                    )
+                    return True
+
+        recent[frame_hash] = None
+        recent.move_to_end(frame_hash)
+        while len(recent) > self._config['saver']['dedup_history']:
+            recent.popitem(last=False)
+
+        return False
+
+    def save_encoded(self, jpeg_bytes, capture_data, stream_name="Pre"):
+        """Save an image that is already a JPEG, e.g. a pre-event frame. The EXIF is added
+        without decoding the image.
+
+        Args:
+            jpeg_bytes (bytes): The encoded image
+            capture_data (CaptureData): Data for this frame
+            stream_name (string): Goes into the file name
+        """
+        self._submit(self._write_encoded, jpeg_bytes, capture_data, stream_name)
+
+    def _submit(self, write, *args):
+        if not self._config["capture"]["save_images"]:
+            return
+
+        with self._lock:
+            self._queued += 1
+
+        if self._workers:
+            self._queue.put((write, args))
+        else:
+            self._write_and_count(write, *args)
 
+    def _write_and_count(self, write, *args):
+        try:
+            with metrics.timer("save"):
+                write(*args)
+            metrics.count("saves")
+            succeeded = True
         except Exception as e:
             self._logger.error(f"An error occurred saving the image: {e}")
+            metrics.count("save_failures")
+            succeeded = False
+
+        with self._idle:
+            if succeeded:
+                self._written += 1
+            else:
+                self._failed += 1
+            self._idle.notify_all()
+
+    def _write(self, lores_array, main_array, capture_data):
+        exif_bytes = self.format_exif(capture_data) if self._exif else None
+
+        # image = Image.fromarray(lores_array).convert("RGB")
+        # file_name = self.format_file_name(
+        #     platform.node(), capture_time, str(camera_num), motion_detected, pir, "lores"
+        # )
+        # image.save(file_name, exif=exif_bytes)
+
+        file_name = self.format_file_name(
+            platform.node(),
+            capture_data.capture_time_file_str(),
+            str(capture_data.camera_num),
+            capture_data.object_detected,
+            capture_data.pir_fired,
+            "Main",  # Make it a capital M so it sorts before the lores stream
+        )
+        jpeg_bytes = self.encode(main_array, exif_bytes)
+        self.write_file(file_name, jpeg_bytes)
+        self._write_sidecar(file_name, capture_data)
+
+        if self._index is not None:
+            downscale = self._config['saver']['downscale']
+            height, width = main_array.shape[:2]
+            self._index.add(file_name, len(jpeg_bytes), width // downscale, height // downscale, capture_data)
+
+    def _write_encoded(self, jpeg_bytes, capture_data, stream_name):
+        file_name = self.format_file_name(
+            platform.node(),
+            capture_data.capture_time_file_str(),
+            str(capture_data.camera_num),
+            capture_data.object_detected,
+            capture_data.pir_fired,
+            stream_name,
+        )
+
+        if self._exif:
+            output = io.BytesIO()
+            piexif.insert(self.format_exif(capture_data), jpeg_bytes, output)
+            jpeg_bytes = output.getvalue()
+
+        self.write_file(file_name, jpeg_bytes)
+        self._write_sidecar(file_name, capture_data)
+
+        if self._index is not None:
+            # Only reads the JPEG header
+            width, height = Image.open(io.BytesIO(jpeg_bytes)).size
+            self._index.add(file_name, len(jpeg_bytes), width, height, capture_data)
+
+    def _write_sidecar(self, file_name, capture_data):
+        if self._sidecar:
+            self.write_file(f"{file_name[:-len('.jpg')]}.json", self.format_sidecar(capture_data))
+
+    def encode(self, main_array, exif_bytes):
+        """
+        Returns:
+            bytes: The main array as a JPEG with the EXIF attached, using the [saver] encoder,
+            quality, subsampling and downscale
+        """
+        return self._encoder.encode(main_array, exif_bytes)
+
+    def write_file(self, file_name, data):
+        with open(file_name, "wb") as f:
+            f.write(data)
@@ -0,0 +1,153 @@
+import logging
+
+import numpy as np
+
+
+try:
+    import tflite_runtime.interpreter as tflite
+except ImportError:
+    # Not on a Pi. Only an interpreter passed in, e.g. by a test, can be used.
+    tflite = None
+
+
+class InterpreterManager:
+    """
+    Owns a single TFLite interpreter for the life of the process.
+
+    Loading the model, allocating tensors and planning the ops is expensive, so it is done once
+    here instead of on every frame. The input and output details are cached, and a few warm-up
+    invocations are run so the first real frame doesn't pay for lazy initialization.
+
+    Args:
+        model_file_path (string): Path to the .tflite model
+        config (dict): The [tflite] section of the configuration
+        interpreter: An interpreter to use instead of loading one from the model file
+    """
+
+    def __init__(self, model_file_path, config, interpreter=None):
+        self._model_file_path = model_file_path
+        self._num_threads = config['num_threads']
+        self._delegate = config['delegate']
+        self._delegate_options = config['delegate_options']
+        self._warmup_runs = config['warmup_runs']
+
+        self._interpreter = interpreter
+        self._input_details = None
+        self._output_details = None
+        self.batch_size = 1
+
+        self.load()
+
+    def load(self):
+        """
+        Create the interpreter, allocate its tensors and cache everything we need per frame.
+        """
+        logger = logging.getLogger()
+
+        if self._interpreter is None:
+            if tflite is None:
+                raise RuntimeError("tflite_runtime isn't installed")
+
+            delegates = []
+            if self._delegate:
+                # An empty delegate uses the CPU kernels, which already includes XNNPACK in the
+                # standard tflite_runtime wheels. Otherwise this is the path to a delegate library.
+                delegates.append(tflite.load_delegate(self._delegate, self._delegate_options))
+
+            self._interpreter = tflite.Interpreter(
+                model_path=self._model_file_path,
+                num_threads=self._num_threads,
+                experimental_delegates=delegates or None,
+            )
+
+        self._interpreter.allocate_tensors()
+        self._cache_details()
+
+        logger.info(
+            f"Loaded {self._model_file_path} threads: {self._num_threads} "
+            f"delegate: {self._delegate or 'none'} input: {self.input_shape()}"
+        )
+
+        self.warm_up()
+
+    def _cache_details(self):
+        self._input_details = self._interpreter.get_input_details()
+        self._output_details = self._interpreter.get_output_details()
+
+        self.input_index = self._input_details[0]["index"]
+        self.input_height = self._input_details[0]["shape"][1]
+        self.input_width = self._input_details[0]["shape"][2]
+        self.input_dtype = self._input_details[0]["dtype"]
+        self.floating_model = self.input_dtype == np.float32
+
+        # SSD MobileNet post-processing outputs: boxes, classes, scores, count
+        self.output_indices = [detail["index"] for detail in self._output_details]
+
+    def warm_up(self):
+        """
+        Invoke the model on a blank frame a few times so that the first real frame doesn't see
+        the one-off costs.
+        """
+        for _ in range(self._warmup_runs):
+            self._invoke_blank()
+
+    def _invoke_blank(self):
+        self._interpreter.set_tensor(self.input_index, np.zeros(self.input_shape(), dtype=self.input_dtype))
+        self._interpreter.invoke()
+
+    def set_batch_size(self, batch_size):
+        """
+        Resize the input tensor to hold batch_size frames. Tensors are only reallocated when the
+        size actually changes.
+
+        A model can allocate a larger batch and still fail to run it. TFLite_Detection_PostProcess
+        only raises from invoke(), for example. So a new size is tried on a blank batch before it
+        is kept.
+
+        Raises:
+            RuntimeError, ValueError: The model can't run a batch of this size. The interpreter
+            is left at the previous size.
+        """
+        if batch_size == self.batch_size:
+            return
+
+        try:
+            self._resize(batch_size)
+            self._invoke_blank()
+        except (RuntimeError, ValueError):
+            # Put the interpreter back the way it was so it is still usable
+            self._resize(self.batch_size)
+            raise
+
+        self.batch_size = batch_size
+
+    def _resize(self, batch_size):
+        self._interpreter.resize_tensor_input(
+            self.input_index, [batch_size, self.input_height, self.input_width, 3]
+        )
+        self._interpreter.allocate_tensors()
+        self._cache_details()
+
+    def input_shape(self):
+        return tuple(self._input_details[0]["shape"])
+
+    def input_tensor(self):
+        """
+        Returns:
+            ndarray: A writable view of the input tensor. Don't keep it across invoke() or a
+            batch size change.
+        """
+        return self._interpreter.tensor(self.input_index)()
+
+    def set_input(self, input_data):
+        self._interpreter.set_tensor(self.input_index, input_data)
+
+    def invoke(self):
+        self._interpreter.invoke()
+
+    def get_outputs(self):
+        """
+        Returns:
+            list: One array per output tensor, in the model's output order.
+        """
+        return [self._interpreter.get_tensor(index) for index in self.output_indices]
@@ -0,0 +1,164 @@
+import abc
+import io
+import logging
+
+import cv2
+import piexif
+from PIL import Image
+
+
+try:
+    from turbojpeg import TJPF_RGB
+    from turbojpeg import TJPF_RGBX
+    from turbojpeg import TJSAMP_420
+    from turbojpeg import TJSAMP_422
+    from turbojpeg import TJSAMP_444
+    from turbojpeg import TurboJPEG
+except ImportError:
+    # PyTurboJPEG isn't installed. The "turbojpeg" encoder falls back to PIL.
+    TurboJPEG = None
+
+SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+
+class JpegEncoder(abc.ABC):
+    """
+    Encodes frames as JPEG. Takes the camera's XBGR8888 main array, i.e. [R, G, B, 255] pixels,
+    or a plain RGB array, without converting it first.
+
+    Args:
+        config (dict): The [saver] section. Uses quality, subsampling and downscale.
+    """
+
+    name = None
+
+    def __init__(self, config):
+        self._quality = config['quality']
+        self._subsampling = config['subsampling']
+        self._downscale = config['downscale']
+
+        if self._subsampling not in SUBSAMPLING:
+            raise ValueError(f"subsampling must be one of {SUBSAMPLING}, not {self._subsampling}")
+
+    def encode(self, array, exif_bytes=None):
+        """
+        Args:
+            array (ndarray): (height, width, 4) RGBX or (height, width, 3) RGB pixels
+            exif_bytes (bytes): EXIF to attach, or None
+
+        Returns:
+            bytes: The JPEG
+        """
+        if self._downscale > 1:
+            height, width = array.shape[:2]
+            array = cv2.resize(
+                array,
+                (width // self._downscale, height // self._downscale),
+                interpolation=cv2.INTER_AREA,
+            )
+
+        jpeg = self._encode(array)
+
+        if exif_bytes:
+            output = io.BytesIO()
+            piexif.insert(exif_bytes, jpeg, output)
+            jpeg = output.getvalue()
+
+        return jpeg
+
+    @abc.abstractmethod
+    def _encode(self, array):
+        """
+        Returns:
+            bytes: The JPEG of the array, without EXIF
+        """
+
+
+class PILEncoder(JpegEncoder):
+    name = "pil"
+
+    def _encode(self, array):
+        height, width, channels = array.shape
+        raw_mode = "RGBX" if channels == 4 else "RGB"
+
+        # Reads the 4 byte pixels in place instead of converting a copy of the frame to RGB
+        image = Image.frombuffer("RGB", (width, height), array, "raw", raw_mode, array.strides[0], 1)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self._quality, subsampling=self._subsampling)
+        return output.getvalue()
+
+
+class OpenCVEncoder(JpegEncoder):
+    name = "opencv"
+
+    SAMPLING_FACTORS = {
+        "4:4:4": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+        "4:2:2": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+        "4:2:0": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+    }
+
+    def _encode(self, array):
+        # imencode wants BGR
+        conversion = cv2.COLOR_RGBA2BGR if array.shape[2] == 4 else cv2.COLOR_RGB2BGR
+        params = [
+            cv2.IMWRITE_JPEG_QUALITY, self._quality,
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR, self.SAMPLING_FACTORS[self._subsampling],
+        ]
+
+        ok, jpeg = cv2.imencode(".jpg", cv2.cvtColor(array, conversion), params)
+        if not ok:
+            raise RuntimeError("OpenCV couldn't encode the image")
+        return jpeg.tobytes()
+
+
+class TurboJPEGEncoder(JpegEncoder):
+    name = "turbojpeg"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._turbo = TurboJPEG()
+        self._sampling = {"4:4:4": TJSAMP_444, "4:2:2": TJSAMP_422, "4:2:0": TJSAMP_420}[
+            self._subsampling
+        ]
+
+    def _encode(self, array):
+        return self._turbo.encode(
+            array,
+            quality=self._quality,
+            pixel_format=TJPF_RGBX if array.shape[2] == 4 else TJPF_RGB,
+            jpeg_subsample=self._sampling,
+        )
+
+
+ENCODERS = {encoder.name: encoder for encoder in (PILEncoder, OpenCVEncoder, TurboJPEGEncoder)}
+
+
+def make_encoder(config):
+    """
+    Create the encoder named by [saver] encoder.
+
+    Args:
+        config (dict): The [saver] section
+
+    Returns:
+        JpegEncoder: The encoder. PIL if turbojpeg was asked for but isn't installed.
+    """
+    name = config['encoder']
+
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown JPEG encoder {name}. Use one of {list(ENCODERS)}")
+
+    if name == "turbojpeg":
+        if TurboJPEG is None:
+            logging.warning("PyTurboJPEG isn't installed. Using the PIL JPEG encoder.")
+            name = "pil"
+        else:
+            try:
+                return TurboJPEGEncoder(config)
+            except (OSError, RuntimeError) as e:
+                # The Python package is there but libturbojpeg isn't
+                logging.warning(f"Can't load libturbojpeg: {e}. Using the PIL JPEG encoder.")
+                name = "pil"
+
+    return ENCODERS[name](config)
@@ -0,0 +1,122 @@
+import logging
+import time
+
+import metrics
+from thermal import cpu_temperature
+
+
+class LoopScheduler:
+    """
+    Paces one camera's capture stage by deadline rather than by a fixed sleep.
+
+    Each frame is due one period after the previous one was due, so the time spent capturing
+    and queueing the frame comes out of the wait instead of being added to it. A frame that is
+    late isn't made up for with a rush of frames; the schedule starts again from now.
+
+    The period depends on what is happening:
+        active  Activity (a detection or the PIR) in the last active_window seconds: active_fps
+        normal  fps
+        idle    No activity for idle_after seconds: idle_fps
+
+    Above the soft temperature limit the rate is scaled down, reaching thermal_min_fps at the
+    hard limit, so a hot enclosure slows capture before the SoC throttles itself.
+
+    Args:
+        config (dict): The whole configuration. Uses [scheduler].
+        camera_num (int): The camera paced, which names its target_fps gauge
+        temperature (callable): Returns the CPU temperature in Celsius, or None if unknown
+    """
+
+    def __init__(self, config, camera_num, temperature=cpu_temperature):
+        scheduler = config['scheduler']
+        self._fps_gauge = f"target_fps_{camera_num}"
+        self._fps = scheduler['fps']
+        self._active_fps = scheduler['active_fps']
+        self._active_window = scheduler['active_window']
+        self._idle_fps = scheduler['idle_fps']
+        self._idle_after = scheduler['idle_after']
+        self._soft_limit = scheduler['thermal_soft_limit']
+        self._hard_limit = scheduler['thermal_hard_limit']
+        self._thermal_min_fps = scheduler['thermal_min_fps']
+        self._thermal_interval = scheduler['thermal_check_interval']
+
+        self._temperature = temperature
+        self._cpu_temp = None
+        self._next_thermal_check = 0.0
+
+        self._last_activity = time.monotonic()
+        self._deadline = None
+
+    def notify_activity(self, now=None):
+        """
+        Something happened. Capture at the active rate for the next active_window seconds.
+        Safe to call from another thread.
+        """
+        self._last_activity = time.monotonic() if now is None else now
+
+    def restart(self):
+        """
+        Frames were captured off schedule, e.g. in a burst. The next one starts a new schedule.
+        """
+        self._deadline = None
+
+    def mode(self, now):
+        since_activity = now - self._last_activity
+        if since_activity < self._active_window:
+            return "active"
+        if since_activity >= self._idle_after:
+            return "idle"
+        return "normal"
+
+    def target_fps(self, now):
+        """
+        Returns:
+            float: Frames per second for the current mode and temperature. 0 means unpaced.
+        """
+        fps = {"active": self._active_fps, "normal": self._fps, "idle": self._idle_fps}[self.mode(now)]
+
+        cpu_temp = self._read_temperature(now)
+        if fps and cpu_temp is not None and cpu_temp > self._soft_limit:
+            # Scale down linearly from fps at the soft limit to the minimum at the hard limit
+            fraction = min(1.0, (cpu_temp - self._soft_limit) / (self._hard_limit - self._soft_limit))
+            fps = min(fps, fps - (fps - self._thermal_min_fps) * fraction)
+
+        return fps
+
+    def next_wait(self, now=None):
+        """
+        Call once a frame has been captured.
+
+        Returns:
+            float: Seconds to wait before capturing the next frame
+        """
+        now = time.monotonic() if now is None else now
+
+        fps = self.target_fps(now)
+        metrics.set_gauge(self._fps_gauge, fps)
+
+        if not fps:
+            self._deadline = None
+            return 0.0
+
+        if self._deadline is None:
+            self._deadline = now
+
+        self._deadline += 1.0 / fps
+
+        if self._deadline < now:
+            metrics.count("loop_overruns")
+            self._deadline = now
+
+        return self._deadline - now
+
+    def _read_temperature(self, now):
+        # Reading the sensor isn't free, so only do it every thermal_check_interval seconds
+        if now >= self._next_thermal_check:
+            self._cpu_temp = self._temperature()
+            self._next_thermal_check = now + self._thermal_interval
+
+            if self._cpu_temp is not None and self._cpu_temp > self._soft_limit:
+                logging.debug(f"CPU at {self._cpu_temp:.1f}C. Slowing capture down.")
+
+        return self._cpu_temp
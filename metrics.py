@@ -0,0 +1,154 @@
+"""
+Named timers and counters for the capture pipeline.
+
+Timers go into fixed-size log-scale histograms, so recording a value costs a bisect and memory
+never grows. Histograms and counters are windowed: stats_file takes a snapshot every interval and
+starts a new window, so the percentiles show what happened recently rather than a lifetime
+average. Counters and timers also keep running totals, which a new window doesn't clear, for
+monitoring that expects counts only to go up. Gauges hold the last value set.
+
+    with metrics.timer("inference"):
+        ...
+    metrics.count("saves")
+    metrics.set_gauge("last_detection_time", time.time())
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Bucket upper bounds in seconds: 10 per decade from 1us to 100s. Anything slower goes in a
+# final overflow bucket.
+BUCKET_BOUNDS = [10 ** (exponent / 10) for exponent in range(-60, 21)]
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+
+
+class LatencyHistogram:
+    """
+    Fixed memory histogram of durations. reset() starts a new window but keeps total_count and
+    total_sum, the count and sum of every duration ever recorded.
+    """
+
+    def __init__(self):
+        self.total_count = 0
+        self.total_sum = 0.0
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.total_count += 1
+        self.total_sum += seconds
+
+    def percentile(self, percent):
+        """
+        Returns:
+            float: Upper bound, in seconds, of the bucket holding the percentile. The max seen
+            if it falls in the overflow bucket, or 0 if nothing was recorded.
+        """
+        if self.count == 0:
+            return 0.0
+
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                return min(BUCKET_BOUNDS[i], self.max) if i < len(BUCKET_BOUNDS) else self.max
+
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "total_count": self.total_count,
+            "total_sum": self.total_sum,
+        }
+
+
+def record(name, seconds):
+    """
+    Add a duration to the named timer.
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+
+@contextmanager
+def timer(name):
+    """
+    Time the body of a with block into the named timer.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def count(name, n=1):
+    """
+    Add n to the named counter.
+    """
+    with _lock:
+        counter = _counters.get(name)
+        if counter is None:
+            counter = _counters[name] = {"window": 0, "total": 0}
+        counter["window"] += n
+        counter["total"] += n
+
+
+def set_gauge(name, value):
+    """
+    Set the named gauge to value.
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot(reset=False):
+    """
+    Args:
+        reset (bool): Start a new window once the snapshot is taken
+
+    Returns:
+        dict: "timers" maps names to count, mean, p50, p95, p99 and max in seconds for the
+        current window, and total_count and total_sum since startup. "counters" maps names to
+        their window and total counts. "gauges" maps names to their values.
+    """
+    with _lock:
+        result = {
+            "timers": {name: histogram.summary() for name, histogram in _histograms.items()},
+            "counters": {name: dict(counter) for name, counter in _counters.items()},
+            "gauges": dict(_gauges),
+        }
+
+        if reset:
+            for histogram in _histograms.values():
+                histogram.reset()
+            for counter in _counters.values():
+                counter["window"] = 0
+
+    return result
@@ -0,0 +1,143 @@
+import datetime
+import json
+import logging
+import platform
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import metrics
+from image_saver import ImageSaver
+from thermal import cpu_temperature
+
+
+PREFIX = "capture"
+
+
+def health(pir_thread):
+    """
+    Returns:
+        dict: The node's current state: CPU temperature, loop rate, last detection, saver
+        queue and PIR
+    """
+    snapshot = metrics.snapshot()
+
+    loop_period = snapshot["timers"].get("loop_period")
+    loop_rate = 1.0 / loop_period["mean"] if loop_period and loop_period["mean"] else 0.0
+
+    last_detection = snapshot["gauges"].get("last_detection_time")
+    saver_stats = ImageSaver().stats()
+
+    return {
+        "node": platform.node(),
+        "time": f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}",
+        "cpu_temp": cpu_temperature(),
+        "loop_rate": loop_rate,
+        "last_detection": (
+            f"{datetime.datetime.fromtimestamp(last_detection):%Y-%m-%d %H:%M:%S}"
+            if last_detection is not None
+            else None
+        ),
+        "saver_queue_depth": saver_stats["pending"],
+        "pir": pir_thread.pir_detected() if pir_thread is not None else None,
+    }
+
+
+def format_prometheus(snapshot, node_health):
+    """
+    Render a metrics snapshot and health document in the Prometheus text format.
+
+    Timers become summaries in seconds: the quantiles are for the current stats window, and _sum
+    and _count are the running totals, so they never go down when stats_file starts a new window.
+    Counters use their totals and gauges are passed through.
+
+    Returns:
+        string: The exposition text
+    """
+    lines = []
+
+    for name, timer in sorted(snapshot["timers"].items()):
+        metric = f"{PREFIX}_{name}_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+            lines.append(f'{metric}{{quantile="{quantile}"}} {timer[key]}')
+        lines.append(f"{metric}_sum {timer['total_sum']}")
+        lines.append(f"{metric}_count {timer['total_count']}")
+
+    for name, counter in sorted(snapshot["counters"].items()):
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {counter['total']}")
+
+    gauges = dict(snapshot["gauges"])
+    gauges["cpu_temp_celsius"] = node_health["cpu_temp"]
+    gauges["loop_rate_hz"] = node_health["loop_rate"]
+    gauges["saver_queue_depth"] = node_health["saver_queue_depth"]
+    if node_health["pir"] is not None:
+        gauges["pir"] = int(node_health["pir"])
+
+    for name, value in sorted(gauges.items()):
+        if value is None:
+            continue
+        metric = f"{PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    /metrics serves Prometheus text and /health a JSON health document.
+    """
+
+    pir_thread = None
+
+    def do_GET(self):
+        node_health = health(self.pir_thread)
+
+        if self.path == "/metrics":
+            body = format_prometheus(metrics.snapshot(), node_health)
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/health":
+            body = json.dumps(node_health)
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics server: {format % args}")
+
+
+def start_metrics_server(config, pir_thread=None):
+    """
+    Serve the metrics on a daemon thread.
+
+    Args:
+        config (dict): The whole configuration. Uses [metrics].
+        pir_thread (MonitorPIR): Reports the PIR state, if there is one
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    MetricsHandler.pir_thread = pir_thread
+
+    server = ThreadingHTTPServer(
+        (config['metrics']['host'], config['metrics']['port']), MetricsHandler
+    )
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+
+    logging.info(f"Serving metrics on {config['metrics']['host']}:{config['metrics']['port']}")
+
+    return server
@@ -1,21 +1,124 @@
 import logging
+import queue
 import threading
-import gpiod
 import time
 
-class MonitorPIR(threading.Thread):
+
+try:
+    import gpiod
+except ImportError:
+    # Not on a Pi. Only the fake backend can be used.
+    gpiod = None
+
+import metrics
+
+
+# An edge timestamp further than this from when it was read isn't on the monotonic clock
+MAX_EDGE_AGE = 60.0
+
+
+class GpiodBackend:
+    """
+    The PIR line through libgpiod (v1 API), requested for edge events on both edges.
+    """
 
     def __init__(self, config):
+        if gpiod is None:
+            raise RuntimeError("gpiod isn't installed. Turn off [pir] check_pir to run without a PIR.")
+
+        self._chip = gpiod.Chip(config["pir"]["chip"])
+        self._line = self._chip.get_line(config["pir"]["line"])
+        self._line.request(consumer="capture", type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+
+    def get_value(self):
+        return self._line.get_value()
+
+    def wait_edge(self, timeout):
+        """
+        Args:
+            timeout (float): Seconds to wait
+
+        Returns:
+            tuple: (rising, timestamp) for the next edge, or None if there wasn't one in time.
+            The timestamp is when the kernel saw the edge, on the time.monotonic() clock, so
+            the wake latency includes however long this thread took to be scheduled.
+        """
+        seconds = int(timeout)
+        if not self._line.event_wait(sec=seconds, nsec=int((timeout - seconds) * 1e9)):
+            return None
+
+        event = self._line.event_read()
+        read_time = time.monotonic()
+        timestamp = event.sec + event.nsec / 1e9
+
+        # Kernels before 5.7 stamp edges with CLOCK_REALTIME, which can't be compared with
+        # time.monotonic(). Fall back to when the edge was read.
+        if not 0.0 <= read_time - timestamp < MAX_EDGE_AGE:
+            timestamp = read_time
+
+        return event.type == gpiod.LineEvent.RISING_EDGE, timestamp
+
+    def close(self):
+        self._line.release()
+        self._chip.close()
+
+
+class FakeGPIOBackend:
+    """
+    A PIR that only changes when told to, for testing off the Pi.
+    """
+
+    def __init__(self, value=0):
+        self._value = value
+        self._edges = queue.Queue()
+
+    def set_value(self, value):
+        """
+        Drive the line. Makes an edge if the value changes.
+        """
+        if value != self._value:
+            self._value = value
+            self._edges.put((bool(value), time.monotonic()))
+
+    def get_value(self):
+        return self._value
+
+    def wait_edge(self, timeout):
+        try:
+            return self._edges.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+class MonitorPIR(threading.Thread):
+    """
+    Watches the PIR for edges instead of polling it.
+
+    Each edge updates the state straight away and sets every event registered with
+    add_wake_event(), so the capture loop can stop waiting and capture the next frame at once.
+
+    Args:
+        config (dict): The whole configuration. Uses [pir].
+        backend: Where the edges come from. A GpiodBackend if not given.
+    """
+
+    def __init__(self, config, backend=None):
         super(MonitorPIR, self).__init__()
         self._stop_event = threading.Event()
         self._config = config
 
-        if self._config["pir"]["check_pir"]:
-            self._chip = gpiod.Chip('gpiochip4')
-            self._line = self._chip.get_line(self._config["pir"]["line"])
-            self._line.request(consumer='button', type=gpiod.LINE_REQ_DIR_IN)
+        if backend is None and self._config["pir"]["check_pir"]:
+            backend = GpiodBackend(config)
+        self._backend = backend
+
+        self._wake_events = []
+        self._lock = threading.Lock()
 
-        self.__pir_detected = False
+        self.__pir_detected = bool(backend.get_value()) if backend is not None else False
+        self.__last_trigger = None
 
     def stop(self):
         self._stop_event.set()
@@ -23,32 +126,50 @@ class MonitorPIR(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
-    def _poll_pir(self, config):
+    def add_wake_event(self, event):
+        """
+        Args:
+            event (threading.Event): Set on every PIR edge
+        """
+        with self._lock:
+            self._wake_events.append(event)
+
+    def _watch_pir(self):
         logger = logging.getLogger()
 
         while not self._stop_event.is_set():
+            edge = self._backend.wait_edge(self._config["pir"]["dwell"])
+            if edge is None:
+                continue
 
-            if self._config["pir"]["check_pir"]:
-                value = self._line.get_value()
-                
-                if value == 0:
-                    self.__pir_detected = False
-                else:
-                    self.__pir_detected = True
+            rising, timestamp = edge
+            self.__pir_detected = rising
+            if rising:
+                self.__last_trigger = timestamp
+                metrics.count("pir_triggers")
 
-            logger.debug(f"Checking PIR: {'True' if self.__pir_detected else 'False'}")
+            logger.debug(f"PIR edge: {'rising' if rising else 'falling'}")
 
-            time.sleep(self._config["pir"]["dwell"])
+            with self._lock:
+                for event in self._wake_events:
+                    event.set()
 
-        if self._config["pir"]["check_pir"]:
-            self._line.release()
-            self._chip.close()
+        self._backend.close()
 
     def pir_detected(self):
         return self.__pir_detected
 
+    def last_trigger(self):
+        """
+        Returns:
+            float: time.monotonic() of the last rising edge, or None if there hasn't been one
+        """
+        return self.__last_trigger
+
     def start(self):
-        thread = threading.Thread(target=MonitorPIR._poll_pir, args=(self, self._config))
+        if self._backend is None:
+            return
+
+        thread = threading.Thread(target=MonitorPIR._watch_pir, args=(self,), name="pir")
         thread.daemon = True
         thread.start()
-
@@ -0,0 +1,112 @@
+import logging
+
+import numpy as np
+
+import metrics
+
+
+class MotionGate:
+    """
+    Cheap frame differencing in front of the neural detector.
+
+    Keeps a running background of the lores Y plane for each camera and only lets a frame through
+    to inference when enough pixels differ from it. A frame is also let through when inference
+    hasn't run for force_interval seconds, so a slow change (or something standing very still)
+    is still checked now and then.
+
+    How many frames are let through for each reason, and how many are skipped, are counted as
+    motion_gate_first_frame, motion_gate_motion, motion_gate_forced and motion_gate_skipped.
+
+    Args:
+        config (dict): The whole configuration. Uses [motion_gate] and the lores width from [tflite].
+    """
+
+    def __init__(self, config):
+        self._enable = config['motion_gate']['enable']
+        self._pixel_threshold = config['motion_gate']['pixel_threshold']
+        self._changed_percent = config['motion_gate']['changed_percent']
+        self._learning_rate = config['motion_gate']['learning_rate']
+        self._force_interval = config['motion_gate']['force_interval']
+        self._subsample = config['motion_gate']['subsample']
+        self._lores_width = config['tflite']['lores_width']
+
+        # Per camera running background, scratch buffer and time of the last inference
+        self._backgrounds = {}
+        self._scratch = {}
+        self._last_inference = {}
+
+    def should_detect(self, camera_num, grey, now, force=False):
+        """
+        Decide whether to run the detector on this frame.
+
+        Args:
+            camera_num (int): Camera the frame came from. Each camera has its own background.
+            grey (ndarray): The lores Y plane. May be wider than the image because of the stride.
+            now (datetime): Capture time of the frame
+            force (bool): Let the frame through regardless, e.g. because the PIR fired
+
+        Returns:
+            bool: True if the frame should go to the detector
+        """
+        if not self._enable:
+            return True
+
+        logger = logging.getLogger()
+
+        diff = self._update_background(camera_num, grey)
+        if diff is None:
+            return self._let_through(camera_num, now, "first_frame")
+
+        np.abs(diff, out=diff)
+        changed_percent = 100.0 * np.count_nonzero(diff > self._pixel_threshold) / diff.size
+
+        logger.debug(f"Motion gate camera {camera_num} changed: {changed_percent:.2f}%")
+
+        if changed_percent >= self._changed_percent:
+            return self._let_through(camera_num, now, "motion")
+
+        # The background may have been learned before inference ever ran for this camera
+        last_inference = self._last_inference.get(camera_num)
+        if force or last_inference is None or (now - last_inference).total_seconds() >= self._force_interval:
+            return self._let_through(camera_num, now, "forced")
+
+        metrics.count("motion_gate_skipped")
+        return False
+
+    def learn(self, camera_num, grey):
+        """
+        Fold a frame into the background without deciding anything, for frames that won't go to
+        the detector anyway, e.g. while idle mode has inference suspended. Keeps the background
+        current, so the first frame afterwards isn't compared with a scene from hours ago.
+        """
+        if self._enable:
+            self._update_background(camera_num, grey)
+
+    def _update_background(self, camera_num, grey):
+        """
+        Returns:
+            ndarray: The frame minus the background before the update, in a scratch buffer, or
+            None if this was the camera's first frame
+        """
+        step = self._subsample
+        sample = grey[::step, : self._lores_width : step]
+
+        background = self._backgrounds.get(camera_num)
+        if background is None:
+            self._backgrounds[camera_num] = sample.astype(np.float32)
+            self._scratch[camera_num] = np.empty(sample.shape, dtype=np.float32)
+            return None
+
+        # diff = sample - background, without allocating a new array each frame
+        diff = self._scratch[camera_num]
+        np.subtract(sample, background, out=diff)
+
+        # Fold the frame into the background: background += learning_rate * diff
+        background += self._learning_rate * diff
+
+        return diff
+
+    def _let_through(self, camera_num, now, reason):
+        metrics.count(f"motion_gate_{reason}")
+        self._last_inference[camera_num] = now
+        return True
@@ -0,0 +1,193 @@
+import numpy as np
+
+import metrics
+
+
+NEW = "new"
+REENTERED = "reentered"
+REFRESH = "refresh"
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Args:
+        boxes_a (ndarray): (n, 4) boxes as [left, bottom, right, top]
+        boxes_b (ndarray): (m, 4) boxes
+
+    Returns:
+        ndarray: (n, m) intersection over union of every pair
+    """
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+
+    def span(box, i, j):
+        return np.minimum(box[..., i], box[..., j]), np.maximum(box[..., i], box[..., j])
+
+    a_x0, a_x1 = span(a, 0, 2)
+    a_y0, a_y1 = span(a, 1, 3)
+    b_x0, b_x1 = span(b, 0, 2)
+    b_y0, b_y1 = span(b, 1, 3)
+
+    width = np.clip(np.minimum(a_x1, b_x1) - np.maximum(a_x0, b_x0), 0, None)
+    height = np.clip(np.minimum(a_y1, b_y1) - np.maximum(a_y0, b_y0), 0, None)
+    intersection = width * height
+
+    union = (a_x1 - a_x0) * (a_y1 - a_y0) + (b_x1 - b_x0) * (b_y1 - b_y0) - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+def centroid_distance(boxes_a, boxes_b):
+    """
+    Returns:
+        ndarray: (n, m) distance between the centres of every pair, in frame fractions
+    """
+    centres_a = np.stack(((boxes_a[:, 0] + boxes_a[:, 2]) / 2, (boxes_a[:, 1] + boxes_a[:, 3]) / 2), axis=1)
+    centres_b = np.stack(((boxes_b[:, 0] + boxes_b[:, 2]) / 2, (boxes_b[:, 1] + boxes_b[:, 3]) / 2), axis=1)
+    return np.linalg.norm(centres_a[:, None, :] - centres_b[None, :, :], axis=2)
+
+
+class Track:
+    __slots__ = ("track_id", "class_id", "box", "last_seen", "last_saved", "missed", "lost")
+
+    def __init__(self, track_id, class_id, box, now):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.box = box
+        self.last_seen = now
+        self.last_saved = now
+        self.missed = 0
+        self.lost = False
+
+
+class ObjectTracker:
+    """
+    Follows detected objects from frame to frame, so an animal that stays in view is saved
+    when it arrives rather than on every frame.
+
+    Detections are matched to the tracks of the same class greedily, by IoU, or failing that
+    by how close their centres are, which catches small objects that move further than their
+    own size. A track that misses max_missed detected frames in a row is lost. A lost track
+    that is matched again within reentry_window seconds keeps its id and counts as re-entered;
+    after that it is forgotten and the object gets a new track.
+
+    update() says which detections are worth saving: a new track, a re-entered track, or a
+    track that hasn't been saved for refresh_interval seconds.
+
+    Args:
+        config (dict): The whole configuration. Uses [tracker].
+    """
+
+    def __init__(self, config):
+        self.enabled = config['tracker']['enable']
+        self._iou_threshold = config['tracker']['iou_threshold']
+        self._max_distance = config['tracker']['max_distance']
+        self._max_missed = config['tracker']['max_missed']
+        self._reentry_window = config['tracker']['reentry_window']
+        self._refresh_interval = config['tracker']['refresh_interval']
+
+        self._tracks = {}
+        self._next_id = 1
+
+    def tracks(self, camera_num):
+        return self._tracks.get(camera_num, [])
+
+    def update(self, camera_num, boxes, class_ids, now):
+        """
+        Match one detected frame's objects to the camera's tracks. Only call this for frames
+        that went through the detector: a skipped frame says nothing about what is in view.
+
+        Args:
+            camera_num (int): Camera the frame came from. Each camera has its own tracks.
+            boxes (ndarray): (n, 4) boxes from the detector
+            class_ids (ndarray): (n,) class ids
+            now (datetime): Capture time of the frame
+
+        Returns:
+            tuple: The track id of each detection, and the save reason for each (NEW,
+            REENTERED, REFRESH or None)
+        """
+        tracks = self._tracks.setdefault(camera_num, [])
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        class_ids = np.asarray(class_ids)
+
+        matches = self._match(tracks, boxes, class_ids)
+
+        track_ids = []
+        reasons = []
+        matched_tracks = set()
+
+        for i in range(len(boxes)):
+            track = matches.get(i)
+
+            if track is None:
+                track = Track(self._next_id, int(class_ids[i]), boxes[i], now)
+                self._next_id += 1
+                tracks.append(track)
+                reason = NEW
+            else:
+                reason = REENTERED if track.lost else None
+                if reason is None and (now - track.last_saved).total_seconds() >= self._refresh_interval:
+                    reason = REFRESH
+
+                track.box = boxes[i]
+                track.last_seen = now
+                track.missed = 0
+                track.lost = False
+
+            if reason is not None:
+                track.last_saved = now
+                metrics.count(f"track_{reason}")
+
+            matched_tracks.add(track.track_id)
+            track_ids.append(track.track_id)
+            reasons.append(reason)
+
+        self._age(tracks, matched_tracks, now)
+
+        return track_ids, reasons
+
+    def _match(self, tracks, boxes, class_ids):
+        """
+        Returns:
+            dict: Detection index to its track
+        """
+        if not tracks or not len(boxes):
+            return {}
+
+        track_boxes = np.stack([track.box for track in tracks])
+        track_classes = np.array([track.class_id for track in tracks])
+        same_class = class_ids[:, None] == track_classes[None, :]
+
+        iou = np.where(same_class, iou_matrix(boxes, track_boxes), 0.0)
+        distance = np.where(same_class, centroid_distance(boxes, track_boxes), np.inf)
+
+        matches = {}
+        used_tracks = set()
+
+        # Best IoU pairs first, then whatever is left by centre distance
+        candidates = [
+            (-iou[i, j], i, j) for i, j in zip(*np.nonzero(iou >= self._iou_threshold))
+        ]
+        candidates += [
+            (1.0 + distance[i, j], i, j) for i, j in zip(*np.nonzero(distance <= self._max_distance))
+        ]
+
+        for score, i, j in sorted(candidates):
+            if i in matches or j in used_tracks:
+                continue
+            matches[i] = tracks[j]
+            used_tracks.add(j)
+
+        return matches
+
+    def _age(self, tracks, matched_tracks, now):
+        for track in list(tracks):
+            if track.track_id in matched_tracks:
+                continue
+
+            track.missed += 1
+            if track.missed >= self._max_missed:
+                track.lost = True
+
+            if track.lost and (now - track.last_seen).total_seconds() > self._reentry_window:
+                tracks.remove(track)
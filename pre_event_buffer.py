@@ -0,0 +1,136 @@
+import collections
+import logging
+import queue
+import threading
+
+import metrics
+from jpeg_encoder import make_encoder
+
+
+# Tells the encoder thread to exit
+_STOP = object()
+
+
+class PreEventBuffer:
+    """
+    Keeps the most recent main frames of each camera so a save can include what happened just
+    before the trigger.
+
+    Frames are JPEG encoded on insert, on a background thread, so a ring of 12 MP frames fits in
+    memory. If the encoder is still busy with the previous frame, the new one is dropped rather
+    than holding up detection. The ring for each camera is bounded by a frame count and the whole
+    buffer by a memory budget; the oldest frames are evicted first.
+
+    Args:
+        config (dict): The whole configuration. Uses [pre_event], and the encoder settings from
+            [saver] with the pre-event quality.
+    """
+
+    def __init__(self, config):
+        self.enabled = config['pre_event']['enable']
+        self._max_frames = config['pre_event']['max_frames']
+        self._memory_budget = config['pre_event']['memory_mb'] * 1024 * 1024
+        self._encoder = make_encoder(dict(config['saver'], quality=config['pre_event']['quality']))
+
+        self._lock = threading.Lock()
+        self._rings = {}
+        self._total_bytes = 0
+
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+
+        if self.enabled:
+            self._thread = threading.Thread(target=self._encode_frames, name="pre-event", daemon=True)
+            self._thread.start()
+
+    def wants_frame(self):
+        """
+        Check before copying a frame out of the camera for add().
+
+        Returns:
+            bool: True if the encoder has room for another frame. Otherwise the frame counts as
+            dropped.
+        """
+        if not self._queue.full():
+            return True
+
+        metrics.count("pre_event_dropped")
+        return False
+
+    def add(self, camera_num, main_array, capture_data):
+        """
+        Hand a frame to the encoder. Only call this after wants_frame() returned True, from the
+        same thread. The array must not be modified afterwards.
+        """
+        self._queue.put((camera_num, main_array, capture_data))
+
+    def drain(self, camera_num):
+        """
+        Take every frame held for a camera, oldest first, and empty its ring.
+
+        A frame still being encoded is waited for first. Otherwise it would miss this event and
+        land in the ring afterwards, as stale pre-roll for a later one. There is at most one, so
+        this waits for one encode at most.
+
+        Returns:
+            list: (jpeg_bytes, capture_data) tuples
+        """
+        self.flush()
+
+        with self._lock:
+            ring = self._rings.pop(camera_num, collections.deque())
+            self._total_bytes -= sum(len(jpeg) for jpeg, capture_data in ring)
+        return list(ring)
+
+    def memory_used(self):
+        with self._lock:
+            return self._total_bytes
+
+    def flush(self):
+        """
+        Wait for the frame being encoded, if any, to reach the ring.
+        """
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _encode_frames(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+
+                camera_num, main_array, capture_data = item
+                self._insert(camera_num, self._encoder.encode(main_array), capture_data)
+
+            except Exception as e:
+                logging.error(f"An error occurred encoding a pre-event frame: {e}")
+
+            finally:
+                self._queue.task_done()
+
+    def _insert(self, camera_num, jpeg, capture_data):
+        with self._lock:
+            ring = self._rings.setdefault(camera_num, collections.deque())
+            ring.append((jpeg, capture_data))
+            self._total_bytes += len(jpeg)
+
+            while len(ring) > self._max_frames:
+                self._evict(ring)
+
+            # Over budget: evict the oldest frame across all cameras
+            while self._total_bytes > self._memory_budget:
+                oldest = min(
+                    (ring for ring in self._rings.values() if ring),
+                    key=lambda ring: ring[0][1].capture_time,
+                )
+                self._evict(oldest)
+
+    def _evict(self, ring):
+        jpeg, capture_data = ring.popleft()
+        self._total_bytes -= len(jpeg)
@@ -1,20 +1,20 @@
 
 import datetime
 import logging
+import platform
 import threading
 import time
-import platform
 
 from gpiozero import CPUTemperature
 
+import metrics
 import running_average
 
+
 stats_file = None
 stats_file_name = None
-last_timestamp = datetime.datetime.now()
-num_samples = 0
-ra = running_average.RunningAverage()
-average_time = 0
+last_timestamp = None
+diff_average = running_average.RunningAverage()
 average_diff = 0
 
 
@@ -33,24 +33,49 @@ class StoppableThread(threading.Thread):
 
 
 def accumulate_stats(timestamp, diff):
-    global last_timestamp, average_time, average_diff
+    """
+    Used by the motion algorithms. The time since the previous call goes into the loop_period
+    timer. The diff is kept as its own average, since it isn't a time.
+    """
+    global last_timestamp, average_diff
+
+    if last_timestamp is not None:
+        metrics.record("loop_period", (timestamp - last_timestamp).total_seconds())
+    last_timestamp = timestamp
+
+    average_diff = diff_average.update(diff)
 
-    average_time = ra.update((timestamp - last_timestamp).total_seconds())
-    last_timestamp = last_timestamp
+def format_snapshot(snapshot):
+    """
+    Returns:
+        string: The timers, in milliseconds, and the window counters of a metrics snapshot
+    """
+    fields = []
 
-    average_diff = ra.update(diff)
+    for name, timer in sorted(snapshot["timers"].items()):
+        fields.append(
+            f"{name}: n={timer['count']} p50={timer['p50'] * 1000:.1f}ms "
+            f"p95={timer['p95'] * 1000:.1f}ms p99={timer['p99'] * 1000:.1f}ms "
+            f"max={timer['max'] * 1000:.1f}ms"
+        )
+
+    for name, counter in sorted(snapshot["counters"].items()):
+        fields.append(f"{name}: {counter['window']}")
+
+    return " ".join(fields)
 
 def output_stats(stats_file_name, interval):
-    """Writes CPU temperature to the stats file every hour until stop_event is set."""
+    """Writes CPU temperature and a snapshot of the metrics for the last interval to the stats file every interval."""
     global stats_file, status_file_name
 
     while True:
+        time.sleep(interval)
+        snapshot = metrics.snapshot(reset=True)
         stats_file = open(stats_file_name, "a+")
         recording_time = datetime.datetime.now()
         cpu = CPUTemperature()
-        stats_file.write(f"{recording_time:%Y-%m-%d %H:%M:%S} cpu_temp: {cpu.temperature} avg_time: {average_time} avg_diff: {average_diff}\n")
+        stats_file.write(f"{recording_time:%Y-%m-%d %H:%M:%S} cpu_temp: {cpu.temperature} avg_diff: {average_diff} {format_snapshot(snapshot)}\n")
         stats_file.close()
-        time.sleep(interval)
 
 def open_stat_file(stats_file_name):
     global stats_file
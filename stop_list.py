@@ -1,13 +1,33 @@
+import numpy as np
+
 
 class StopList:
 
     def __init__(self) -> None:
 
         self.stop_list = None
+        self._stop_set = frozenset()
 
     def set_stop_list(self, stop_list: list) -> None:
 
         self.stop_list = stop_list
+        self._stop_set = frozenset(stop_list)
 
     def is_in_stop_list(self, word: str) -> bool:
-        return word in self.stop_list
+        return word in self._stop_set
+
+    def class_mask(self, labels: dict) -> np.ndarray:
+        """
+        Compile the stop list into a mask indexed by class id.
+
+        Args:
+            labels (dict): Class id to label name
+
+        Returns:
+            ndarray: True for the class ids whose detections should be kept. There is one extra
+            entry at the end, always False, to index ids that aren't in labels.
+        """
+        mask = np.zeros(max(labels) + 2, dtype=bool)
+        for class_id, label in labels.items():
+            mask[class_id] = not self.is_in_stop_list(label)
+        return mask
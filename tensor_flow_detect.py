@@ -1,14 +1,25 @@
 import logging
 import pprint
+from contextlib import contextmanager
 
 import cv2
 import numpy as np
-import tflite_runtime.interpreter as tflite
-from picamera2 import MappedArray, Picamera2, Preview
-from libcamera import Transform
 
+
+try:
+    from libcamera import Transform
+    from picamera2 import MappedArray
+    from picamera2 import Picamera2
+    from picamera2 import Preview
+except ImportError:
+    # Not on a Pi. Frames can still come from a replay frame source.
+    Picamera2 = None
+
+from frame_preprocessor import FramePreprocessor
+from interpreter_manager import InterpreterManager
 from stop_list import StopList
 
+
 rectangles = []
 main_buffer_width = None
 main_buffer_height = None
@@ -76,7 +87,7 @@ class TensorFlowDetect:
         abstract_model (_type_): _description_
     """
 
-    def __init__(self, config, flip, preview):
+    def __init__(self, config, flip, preview, interpreter=None):
         global rectangles
         global main_buffer_width
         global main_buffer_height
@@ -90,9 +101,13 @@ class TensorFlowDetect:
         self._lores_height = config['lores_height']
         self._threshold = config['threshold']
         self._draw_rectangles = config['draw_rectangles']
+        self._buffer_count = config['buffer_count']
 
         self._flip = flip
         self._preview = preview
+
+        # The lores stride of each camera or frame source
+        self._strides = {}
         
         rectangles = []
         main_buffer_width = config['main_width']
@@ -101,6 +116,23 @@ class TensorFlowDetect:
         self._stop_list = StopList()
         self._stop_list.set_stop_list(config['stop_list'])
 
+        # Compile the stop list and thresholds into tables indexed by class id, so each frame's
+        # detections are filtered with a few array operations instead of a loop.
+        self._class_allowed = self._stop_list.class_mask(self._labels)
+        self._class_thresholds = self._compile_thresholds(config['threshold'], config['class_thresholds'])
+
+        # Load the model once. Every frame reuses the same interpreter.
+        self._interpreter = InterpreterManager(self._model_file_path, config, interpreter)
+        self._max_batch = config['max_batch']
+
+        if config['lores_native']:
+            # Ask the camera for lores frames at the model's input size so no resize is needed.
+            # The config is updated too, so everything else sees the real lores size.
+            self._lores_width = config['lores_width'] = self._interpreter.input_width
+            self._lores_height = config['lores_height'] = self._interpreter.input_height
+
+        self._preprocessor = FramePreprocessor(self._interpreter, self._lores_width, self._lores_height)
+
     def name(self):
         return self._model_file_path
     
@@ -116,6 +148,45 @@ class TensorFlowDetect:
     def class_name(self, class_id):
         return self._labels[class_id]
 
+    def labels(self):
+        """
+        Returns:
+            dict: Class id to label name
+        """
+        return self._labels
+
+    def _compile_thresholds(self, threshold, class_thresholds):
+        """
+        Build the per-class score threshold table.
+
+        Args:
+            threshold (float): Default threshold for every class
+            class_thresholds (dict): Label name to threshold, for classes that need their own
+
+        Returns:
+            ndarray: Threshold for each class id, the same length as the stop list mask
+        """
+        thresholds = np.full(len(self._class_allowed), threshold, dtype=np.float32)
+
+        for label, class_threshold in class_thresholds.items():
+            class_ids = [class_id for class_id, name in self._labels.items() if name == label]
+            if not class_ids:
+                logging.warning(f"Unknown label in class_thresholds: {label}")
+            thresholds[class_ids] = class_threshold
+
+        return thresholds
+
+    def empty_result(self):
+        """
+        Returns:
+            tuple: The boxes, scores and class ids of a frame with nothing detected
+        """
+        return (
+            np.empty((0, 4), dtype=np.float32),
+            np.empty(0, dtype=np.float32),
+            np.empty(0, dtype=np.intp),
+        )
+
     def start_camera(self, camera_num):
         """
         Start Picamera2 if using that.  This is optional if we're going to obtain the image
@@ -127,6 +198,9 @@ class TensorFlowDetect:
         Returns:
             _type_: _description_
         """
+        if Picamera2 is None:
+            raise RuntimeError("picamera2 is not installed. Use a replay frame source instead.")
+
         picam2 = Picamera2(camera_num)
         if self._preview:
             picam2.start_preview(Preview.QTGL)
@@ -141,13 +215,11 @@ class TensorFlowDetect:
             main={"size": (self._main_width, self._main_height)},
             lores={"size": (self._lores_width, self._lores_height), "format": "YUV420"},
             display="main",
+            buffer_count=self._buffer_count,
         )
 
         picam2.configure(config)
 
-        self._stride = picam2.stream_configuration("lores")["stride"]
-        # Stride = The length of each row of the image in bytes
-
         if self._draw_rectangles:
             picam2.post_callback = draw_rectangles_preview
 
@@ -161,14 +233,15 @@ class TensorFlowDetect:
         image from a file.
 
         Args:
-            picam2 (_type_): _description_
+            picam2 (FrameSource): The camera, or anything else that acts like one
 
         Returns:
-            _type_: _description_
+            ndarray: The Y plane, height rows of stride bytes
         """
 
+        stride = self._lores_stride(picam2)
         buffer = picam2.capture_buffer("lores")
-        grey = buffer[: self._stride * self._lores_height].reshape(self._lores_height, self._stride)
+        grey = buffer[: stride * self._lores_height].reshape(self._lores_height, stride)
 
         # YUv420 is a slightly special case because the first height rows give the Y channel, the
         # next height/4 rows contain the U channel and the final height/4 rows contain the V
@@ -176,6 +249,29 @@ class TensorFlowDetect:
 
         return grey
 
+    @contextmanager
+    def image_from_request(self, camera, request):
+        """
+        Map the Y plane of a captured request without copying it.
+
+        Args:
+            camera (FrameSource): The camera the request came from
+            request (FrameRequest): The captured frame
+
+        Yields:
+            ndarray: The Y plane, height rows of stride bytes. Only valid inside the with block.
+        """
+        stride = self._lores_stride(camera)
+        with request.lores_buffer() as buffer:
+            yield buffer.reshape(-1)[: stride * self._lores_height].reshape(self._lores_height, stride)
+
+    def _lores_stride(self, camera):
+        # Stride = The length of each row of the image in bytes
+        stride = self._strides.get(camera)
+        if stride is None:
+            stride = self._strides[camera] = camera.stream_configuration("lores")["stride"]
+        return stride
+
     def get_image_from_file(self, image_path):
         """
         Get the image from a file. Convert it to the proper format.
@@ -195,79 +291,103 @@ class TensorFlowDetect:
         return grey, img
 
     def detect_objects(self, image):
+        """
+        Run inference on a single frame.
+
+        Returns:
+            tuple: boxes, scores and class ids of the objects found
+        """
+        return self.detect_objects_batch([image])[0]
+
+    def detect_objects_batch(self, frames):
+        """
+        Run inference on several frames with a single invoke(). The input tensor is resized to
+        the batch size when it changes. If the model can't run a batch that size, the frames are
+        run one at a time from then on.
+
+        Args:
+            frames (list): Lores grey images, e.g. one from each camera or a burst
+
+        Returns:
+            list: A (boxes, scores, class ids) tuple of arrays for each frame, in the same order
+        """
         global rectangles
 
         logger = logging.getLogger()
 
-        logger.debug("detect_objects-")
-        logger.debug(f"image shape prior to modifying: {image.shape}")
-        interpreter = tflite.Interpreter(model_path=self._model_file_path, num_threads=4)
-        interpreter.allocate_tensors()
+        if len(frames) > self._max_batch:
+            return [
+                result
+                for i in range(0, len(frames), self._max_batch)
+                for result in self.detect_objects_batch(frames[i : i + self._max_batch])
+            ]
+
+        try:
+            self._interpreter.set_batch_size(len(frames))
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"Model does not support a batch of {len(frames)}, running frames singly: {e}")
+            self._max_batch = 1
+            return [self.detect_objects_batch([frame])[0] for frame in frames]
+
+        logger.debug(f"detect_objects- batch: {len(frames)}")
 
-        # TODO: Refactor this out to a separate method
-        input_details = interpreter.get_input_details()
-        output_details = interpreter.get_output_details()
-        height = input_details[0]["shape"][1]
-        width = input_details[0]["shape"][2]
-        floating_model = False
-        if input_details[0]["dtype"] == np.float32:
-            floating_model = True
-        # END OF REFACTOR
+        self.preprocess(frames)
+        self.run_inference()
+        results = self.postprocess(len(frames))
 
-        rgb = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        initial_h, initial_w, channels = rgb.shape
+        # The preview only shows the main stream of one camera, so draw the last frame's boxes.
+        rectangles = results[-1][0]
 
-        picture = cv2.resize(rgb, (width, height))
-        # I think that at this point, picture needs to be
-        logger.debug("picture shape: " + str(picture.shape))
+        return results
 
-        input_data = np.expand_dims(picture, axis=0)
-        if floating_model:
-            input_data = (np.float32(input_data) - 127.5) / 127.5
+    # The stages of detect_objects_batch. They are public so the benchmark can time them
+    # separately. The batch size must already be set.
 
-        logger.debug("input_data shape: " + str(input_data.shape))
+    def preprocess(self, frames):
+        self._preprocessor.fill_input(frames)
 
-        interpreter.set_tensor(input_details[0]["index"], input_data)
+    def run_inference(self):
+        self._interpreter.invoke()
 
-        interpreter.invoke()
+    def postprocess(self, num_frames):
+        logger = logging.getLogger()
 
-        detected_boxes = interpreter.get_tensor(output_details[0]["index"])
-        detected_classes = interpreter.get_tensor(output_details[1]["index"])
-        detected_scores = interpreter.get_tensor(output_details[2]["index"])
-        num_boxes = interpreter.get_tensor(output_details[3]["index"])
+        detected_boxes, detected_classes, detected_scores, num_boxes = self._interpreter.get_outputs()
 
         logger.debug(f"detected_boxes shape: {detected_boxes.shape}")
         logger.debug(f"detected_classes shape: {detected_classes.shape} {pprint.pformat(detected_classes)}")
         logger.debug(f"detected_scores shape: {detected_scores.shape} {pprint.pformat(detected_scores)}")
 
-        rectangles = []
-        scores = []
-        classes = []
-
-        for i in range(int(num_boxes)):
-            top, left, bottom, right = detected_boxes[0][i]
-            classId = int(detected_classes[0][i])
-            score = detected_scores[0][i]
-            if score > self._threshold:                
-                dont_do_it =  self._stop_list.is_in_stop_list(self._labels[classId])
-                logger.debug(f"label: {self._labels[classId]} dont_do_it: {dont_do_it}")
-                if not dont_do_it:
-                    xmin = left
-                    ymin = bottom
-                    xmax = right
-                    ymax = top
-                    box = [xmin, ymin, xmax, ymax]
-                    logger.debug(f"appending box: {box}")
-                    rectangles.append(box)
-                    scores.append(detected_scores[0][i])
-                    classes.append(self._labels[detected_classes[0][i]])
-                    # if self._labels:              # T
-                    #     rectangles[-1].append(self._labels[classId])
-
-        # logger.debug(f"Detected {str(algorithm_data)}")
+        return [
+            self._filter_detections(
+                detected_boxes[b], detected_classes[b], detected_scores[b], num_boxes[b]
+            )
+            for b in range(num_frames)
+        ]
+
+    def _filter_detections(self, detected_boxes, detected_classes, detected_scores, num_boxes):
+        """
+        Drop detections below their class threshold or in the stop list for one frame of the
+        batch.
 
+        Returns:
+            tuple: boxes (n, 4) as [xmin, ymin, xmax, ymax], scores (n,) and class ids (n,)
+        """
+        n = int(num_boxes)
+
+        # Ids the labels don't know about index the last entry, which is never allowed
+        class_ids = np.minimum(detected_classes[:n].astype(np.intp), len(self._class_allowed) - 1)
+        scores = detected_scores[:n]
+
+        keep = self._class_allowed[class_ids] & (scores > self._class_thresholds[class_ids])
+
+        # The model gives top, left, bottom, right.
         # Seems like rectangles are bottom-left then top-right
-        return rectangles, scores, classes
+        boxes = detected_boxes[:n][keep][:, [1, 2, 3, 0]]
+
+        logging.getLogger().debug(f"kept {np.count_nonzero(keep)} of {n} detections")
+
+        return boxes, scores[keep], class_ids[keep]
 
     def get_object_detection_data(self, algorithm_data):
         return f" data:{str(algorithm_data)}"
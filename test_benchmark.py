@@ -0,0 +1,29 @@
+from benchmark import compare_to_baseline
+from benchmark import summarize
+
+
+# To run this
+# pytest -v test_benchmark.py
+
+
+def test_summarize():
+    summary = summarize({"invoke": [0.01] * 99 + [0.1], "encode": []})
+
+    assert "encode" not in summary
+    assert summary["invoke"]["count"] == 100
+    assert abs(summary["invoke"]["p50_ms"] - 10.0) < 1e-6
+    assert summary["invoke"]["p99_ms"] > summary["invoke"]["p95_ms"]
+
+
+def test_compare_to_baseline():
+    baseline = {"invoke": {"p95_ms": 100.0}, "encode": {"p95_ms": 50.0}}
+    summary = {
+        "invoke": {"p95_ms": 115.0},
+        "encode": {"p95_ms": 70.0},
+        "write": {"p95_ms": 5.0},
+    }
+
+    regressions = compare_to_baseline(summary, baseline, 0.2)
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith("encode")
@@ -1,13 +1,32 @@
-import json
 import datetime
+import json
+
+import numpy as np
+import pytest
+
 from capture_data import CaptureData
 
+
 # To run this
 # pytest -v test_capture_data.py
 
+LABELS = {0: 'person', 17: 'deer'}
+
+
+def make_capture_data():
+    capture_data = CaptureData()
+    capture_data.pir_fired = True
+    capture_data.object_detected = True
+    capture_data.set_labels(LABELS)
+
+    capture_data.add_detection([10, 20, 30, 40], 0.95, 0)
+    capture_data.add_detection([11, 12, 13, 14], 0.85, 17)
+
+    return capture_data
+
 def test_capture_data_initialization():
     capture_data = CaptureData()
-    
+
     assert capture_data.capture_time is not None
     assert capture_data.pir_fired is None
     assert capture_data.object_detected is None
@@ -15,18 +34,14 @@ def test_capture_data_initialization():
     assert capture_data.scores == []
     assert capture_data.classes == []
 
-def test_capture_data_to_json():
+def test_capture_data_is_slotted():
     capture_data = CaptureData()
-    capture_data.pir_fired = True
-    capture_data.object_detected = True
 
-    capture_data.rectangles.append([10, 20, 30, 40])
-    capture_data.scores.append(0.95)
-    capture_data.classes.append('person')
+    with pytest.raises(AttributeError):
+        capture_data.typo = 1
 
-    capture_data.rectangles.append([11, 12, 13, 14])
-    capture_data.scores.append(0.85)
-    capture_data.classes.append('deer')
+def test_capture_data_to_json():
+    capture_data = make_capture_data()
 
     json_str = capture_data.to_json()
     data_dict = json.loads(json_str)
@@ -38,18 +53,65 @@ def test_capture_data_to_json():
     assert data_dict['scores'] == [0.95, 0.85]
     assert data_dict['classes'] == ['person', 'deer']
 
-def test_capture_data_to_short_string():
+def test_capture_data_set_detections():
     capture_data = CaptureData()
-    capture_data.pir_fired = True
-    capture_data.object_detected = True
+    capture_data.set_labels(LABELS)
+    capture_data.set_detections(
+        np.array([[1.5, 2, 3, 4]], dtype=np.float32),
+        np.array([0.7], dtype=np.float32),
+        np.array([17]),
+        [5],
+    )
+
+    assert capture_data.rectangles == [[1.5, 2, 3, 4]]
+    assert capture_data.scores == [0.7]
+    assert capture_data.classes == ['deer']
+    assert json.loads(capture_data.to_json())['track_ids'] == [5]
+
+def test_capture_data_bytes_round_trip():
+    capture_data = make_capture_data()
+    capture_data.capture_time = datetime.datetime(2024, 9, 21, 22, 50, 7, 123456)
+    capture_data.node_name = 'capture1'
+    capture_data.camera_num = 1
+
+    restored = CaptureData.from_bytes(capture_data.to_bytes())
 
-    capture_data.rectangles.append([10, 20, 30, 40])
-    capture_data.scores.append(0.95)
-    capture_data.classes.append('person')
+    for name in CaptureData.__slots__:
+        if name not in ('detections', '_labels'):
+            assert getattr(restored, name) == getattr(capture_data, name)
+    assert restored.detections.tobytes() == capture_data.detections.tobytes()
+    assert restored.to_json() == capture_data.to_json()
 
-    capture_data.rectangles.append([11, 12, 13, 14])
-    capture_data.scores.append(0.85)
-    capture_data.classes.append('deer')
+def test_capture_data_to_short_string():
+    capture_data = make_capture_data()
 
     str = capture_data.to_short_string()
-    assert str == "PIR - Object - Classes: ['person', 'deer']"
\ No newline at end of file
+    assert str == "PIR - Object - Classes: ['person', 'deer']"
+
+def test_capture_data_to_coco():
+    capture_data = CaptureData()
+    capture_data.set_labels(LABELS)
+    capture_data.add_detection([0.25, 0.75, 0.5, 0.25], 0.95, 17)
+
+    image, annotations = capture_data.to_coco(3, 'a.jpg', 400, 200, 10, {'deer': 2})
+
+    assert image['id'] == 3
+    assert (image['width'], image['height'], image['file_name']) == (400, 200, 'a.jpg')
+    assert annotations == [
+        {
+            'id': 10,
+            'image_id': 3,
+            'category_id': 2,
+            'bbox': [100.0, 50.0, 100.0, 100.0],
+            'area': 10000.0,
+            'iscrowd': 0,
+            'score': 0.95,
+        }
+    ]
+
+def test_capture_data_from_json():
+    capture_data = make_capture_data()
+
+    restored = CaptureData.from_json(capture_data.to_json())
+
+    assert restored.to_json() == capture_data.to_json()
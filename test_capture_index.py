@@ -0,0 +1,94 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import capture_index
+from capture_data import CaptureData
+from capture_index import CaptureIndex
+from capture_index import connect
+from capture_index import query
+
+
+# To run this
+# pytest -v test_capture_index.py
+
+LABELS = {0: "fox", 1: "deer"}
+
+
+def make_config(db_path):
+    return {"index": {"path": db_path, "batch_size": 3, "flush_interval": 0.1, "queue_depth": 100}}
+
+
+def make_capture_data(day, camera_num, detections):
+    capture_data = CaptureData()
+    capture_data.capture_time = datetime.datetime(2024, 9, day, 22, 0, 0)
+    capture_data.node_name = "capture1"
+    capture_data.camera_num = camera_num
+    capture_data.pir_fired = False
+    capture_data.object_detected = bool(detections)
+    capture_data.set_labels(LABELS)
+    for score, class_id in detections:
+        capture_data.add_detection([1, 2, 3, 4], score, class_id)
+    return capture_data
+
+
+def test_index_and_query(tmp_path):
+    db_path = str(tmp_path / "captures.db")
+    index = CaptureIndex(make_config(db_path))
+
+    index.add("a.jpg", 100, 64, 48, make_capture_data(10, 0, [(0.9, 0)]))
+    index.add("b.jpg", 100, 64, 48, make_capture_data(15, 0, [(0.4, 0), (0.8, 1)]))
+    index.add("c.jpg", 100, 64, 48, make_capture_data(16, 1, []))
+    index.add("d.jpg", 100, 64, 48, make_capture_data(20, 1, [(0.7, 0)]))
+    index.close()
+
+    connection = connect(db_path)
+
+    assert [capture["file_path"] for capture in query(connection)] == ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+    assert [capture["file_path"] for capture in query(connection, class_name="fox")] == ["a.jpg", "b.jpg", "d.jpg"]
+    assert [capture["file_path"] for capture in query(connection, class_name="fox", min_score=0.5)] == ["a.jpg", "d.jpg"]
+    assert [
+        capture["file_path"] for capture in query(connection, since="2024-09-14", until="2024-09-17")
+    ] == ["b.jpg", "c.jpg"]
+    assert [capture["file_path"] for capture in query(connection, camera=1)] == ["c.jpg", "d.jpg"]
+
+    (capture,) = query(connection, class_name="deer")
+    assert [detection["class"] for detection in capture["detections"]] == ["fox", "deer"]
+
+
+def test_reindexing_a_file_replaces_it(tmp_path):
+    db_path = str(tmp_path / "captures.db")
+    index = CaptureIndex(make_config(db_path))
+
+    index.add("a.jpg", 100, 64, 48, make_capture_data(10, 0, [(0.9, 0)]))
+    index.add("a.jpg", 200, 64, 48, make_capture_data(10, 0, [(0.8, 1)]))
+    index.close()
+
+    (capture,) = query(connect(db_path))
+    assert capture["file_size"] == 200
+    assert [detection["class"] for detection in capture["detections"]] == ["deer"]
+
+
+def test_unopenable_database_fails_at_startup(tmp_path):
+    with pytest.raises(sqlite3.Error):
+        CaptureIndex(make_config(str(tmp_path / "missing" / "captures.db")))
+
+
+def test_close_after_the_writer_died(tmp_path, monkeypatch):
+    def fail(connection, records):
+        raise TypeError("not a record")
+
+    monkeypatch.setattr(capture_index, "insert_records", fail)
+
+    config = make_config(str(tmp_path / "captures.db"))
+    config["index"]["queue_depth"] = 2
+    index = CaptureIndex(config)
+
+    index.add("a.jpg", 100, 64, 48, make_capture_data(10, 0, []))
+    index._thread.join(timeout=10)
+
+    # Fill the queue. Nothing takes from it any more, and close() mustn't wait for that.
+    for day in range(11, 15):
+        index.add("b.jpg", 100, 64, 48, make_capture_data(day, 0, []))
+    index.close()
@@ -0,0 +1,113 @@
+import datetime
+import json
+import os
+import time
+
+import piexif
+import piexif.helper
+from PIL import Image
+
+from capture_data import CaptureData
+from capture_index import CaptureIndex
+from coco_export import export
+
+
+# To run this
+# pytest -v test_coco_export.py
+
+
+def add_captures(db_path, days):
+    index = CaptureIndex({"index": {"path": db_path, "batch_size": 10, "flush_interval": 0.1, "queue_depth": 100}})
+
+    for day in days:
+        capture_data = CaptureData()
+        capture_data.capture_time = datetime.datetime(2024, 9, day, 22, 0, 0)
+        capture_data.set_labels({0: "fox", 1: "deer"})
+        capture_data.add_detection([0.1, 0.5, 0.3, 0.2], 0.9, day % 2)
+        index.add(f"/images/{day}.jpg", 100, 640, 480, capture_data)
+
+    index.close()
+
+
+def write_image(path, day):
+    capture_data = CaptureData()
+    capture_data.capture_time = datetime.datetime(2024, 9, day, 22, 0, 0)
+    exif = piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(capture_data.to_json())}})
+    Image.new("RGB", (64, 48)).save(path, exif=exif)
+
+
+def test_export_is_incremental(tmp_path):
+    db_path = str(tmp_path / "captures.db")
+    output_dir = str(tmp_path / "coco")
+
+    add_captures(db_path, [10, 11])
+    assert export(output_dir, db_path=db_path) == 2
+    assert export(output_dir, db_path=db_path) == 0
+
+    add_captures(db_path, [12])
+    assert export(output_dir, db_path=db_path) == 1
+
+    with open(tmp_path / "coco" / "dataset.json") as f:
+        dataset = json.load(f)
+
+    assert [image["file_name"] for image in dataset["images"]] == ["10.jpg", "11.jpg", "12.jpg"]
+    assert [image["id"] for image in dataset["images"]] == [1, 2, 3]
+    assert [annotation["id"] for annotation in dataset["annotations"]] == [1, 2, 3]
+    assert [annotation["category_id"] for annotation in dataset["annotations"]] == [1, 2, 1]
+    assert dataset["categories"] == [{"id": 1, "name": "fox"}, {"id": 2, "name": "deer"}]
+    assert dataset["annotations"][0]["bbox"] == [64.0, 96.0, 128.0, 144.0]
+
+
+def test_export_includes_captures_indexed_late(tmp_path):
+    db_path = str(tmp_path / "captures.db")
+    output_dir = str(tmp_path / "coco")
+
+    add_captures(db_path, [11])
+    assert export(output_dir, db_path=db_path) == 1
+
+    # Captured before the one already exported, but indexed after it
+    add_captures(db_path, [10])
+    assert export(output_dir, db_path=db_path) == 1
+    assert export(output_dir, db_path=db_path) == 0
+
+    with open(tmp_path / "coco" / "dataset.json") as f:
+        dataset = json.load(f)
+
+    assert [image["file_name"] for image in dataset["images"]] == ["11.jpg", "10.jpg"]
+
+
+def set_mtime(seconds_ago, *paths):
+    mtime = time.time() - seconds_ago
+    for path in paths:
+        os.utime(path, (mtime, mtime))
+
+
+def test_directory_export_is_incremental(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    output_dir = str(tmp_path / "coco")
+
+    # Modified at the same time
+    write_image(image_dir / "11.jpg", 11)
+    write_image(image_dir / "10.jpg", 10)
+    set_mtime(60, image_dir / "10.jpg", image_dir / "11.jpg")
+    assert export(output_dir, image_dir=str(image_dir)) == 2
+    assert export(output_dir, image_dir=str(image_dir)) == 0
+
+    # 13 may still be being written, so it waits for the next export
+    write_image(image_dir / "12.jpg", 12)
+    write_image(image_dir / "13.jpg", 13)
+    set_mtime(30, image_dir / "12.jpg")
+    assert export(output_dir, image_dir=str(image_dir)) == 1
+
+    set_mtime(20, image_dir / "13.jpg")
+    assert export(output_dir, image_dir=str(image_dir)) == 1
+    assert export(output_dir, image_dir=str(image_dir)) == 0
+
+    with open(tmp_path / "coco" / "dataset.json") as f:
+        dataset = json.load(f)
+    with open(tmp_path / "coco" / "export_state.json") as f:
+        state = json.load(f)
+
+    assert [image["file_name"] for image in dataset["images"]] == ["10.jpg", "11.jpg", "12.jpg", "13.jpg"]
+    assert state["last_file_name"] == "13.jpg"
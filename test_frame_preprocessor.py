@@ -0,0 +1,51 @@
+import numpy as np
+
+from frame_preprocessor import FramePreprocessor
+
+
+# To run this
+# pytest -v test_frame_preprocessor.py
+
+
+class FakeInterpreter:
+    def __init__(self, dtype, batch_size=1):
+        self.input_height = 300
+        self.input_width = 300
+        self.floating_model = dtype == np.float32
+        self.tensor = np.zeros((batch_size, 300, 300, 3), dtype=dtype)
+
+    def input_tensor(self):
+        return self.tensor
+
+
+def test_resizes_into_input_tensor_ignoring_stride():
+    interpreter = FakeInterpreter(np.uint8)
+    preprocessor = FramePreprocessor(interpreter, 320, 240)
+
+    grey = np.full((240, 384), 80, dtype=np.uint8)
+    grey[:, 320:] = 255  # padding beyond the image width
+    preprocessor.fill_input([grey])
+
+    assert np.all(interpreter.tensor == 80)
+
+
+def test_native_size_and_batch():
+    interpreter = FakeInterpreter(np.uint8, batch_size=2)
+    preprocessor = FramePreprocessor(interpreter, 300, 300)
+
+    first = np.arange(300 * 320, dtype=np.uint32).astype(np.uint8).reshape(300, 320)
+    second = np.full((300, 320), 7, dtype=np.uint8)
+    preprocessor.fill_input([first, second])
+
+    for channel in range(3):
+        assert np.array_equal(interpreter.tensor[0, :, :, channel], first[:, :300])
+    assert np.all(interpreter.tensor[1] == 7)
+
+
+def test_floating_model_is_normalized():
+    interpreter = FakeInterpreter(np.float32)
+    preprocessor = FramePreprocessor(interpreter, 320, 240)
+
+    preprocessor.fill_input([np.full((240, 320), 255, dtype=np.uint8)])
+
+    assert np.allclose(interpreter.tensor, 1.0)
@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+import pytest
+
+from frame_source import FrameSourceExhausted
+from frame_source import ReplayFrameSource
+
+
+# To run this
+# pytest -v test_frame_source.py
+
+
+def make_config(path, loop=False):
+    return {
+        "replay": {"path": str(path), "pacing": "fast", "fps": 2.0, "loop": loop},
+        "tflite": {"lores_width": 320, "lores_height": 240, "main_width": 640, "main_height": 360},
+    }
+
+
+def write_images(path, count):
+    for i in range(count):
+        image = np.full((360, 640, 3), 40 * (i + 1), dtype=np.uint8)
+        cv2.imwrite(str(path / f"bravo-{i}.jpg"), image)
+
+
+def test_replay_directory_streams(tmp_path):
+    write_images(tmp_path, 2)
+    source = ReplayFrameSource(make_config(tmp_path))
+    source.start()
+
+    stride = source.stream_configuration("lores")["stride"]
+    buffer = source.capture_buffer("lores")
+    grey = buffer[: stride * 240].reshape(240, stride)
+
+    assert grey.shape == (240, 320)
+    # Limited range YUV, like the camera gives: 16 + 40 * 219 / 255
+    assert abs(int(grey.mean()) - 50) <= 2
+    assert source.capture_array("lores").shape == (360, 320)
+
+    main = source.capture_array("main")
+    assert main.shape == (360, 640, 4)
+    assert np.all(main[:, :, 3] == 255)
+
+
+def test_replay_directory_runs_out(tmp_path):
+    write_images(tmp_path, 2)
+    source = ReplayFrameSource(make_config(tmp_path))
+    source.start()
+
+    source.capture_buffer("lores")
+    source.capture_buffer("lores")
+    with pytest.raises(FrameSourceExhausted):
+        source.capture_buffer("lores")
+
+
+def test_replay_directory_loops(tmp_path):
+    write_images(tmp_path, 2)
+    source = ReplayFrameSource(make_config(tmp_path, loop=True))
+    source.start()
+
+    means = [int(source.capture_buffer("lores")[: 320 * 240].mean()) for _ in range(3)]
+    assert abs(means[2] - means[0]) <= 1
+
+
+def test_replay_request_streams_match(tmp_path):
+    write_images(tmp_path, 2)
+    source = ReplayFrameSource(make_config(tmp_path))
+    source.start()
+
+    source.capture_request().release()
+    request = source.capture_request()
+    with request.lores_buffer() as lores:
+        lores_mean = int(lores[:240].mean())
+    main = request.make_array("main")
+    request.release()
+
+    # The second image: 16 + 80 * 219 / 255 in the lores, 80 in the main
+    assert abs(lores_mean - 85) <= 2
+    assert abs(int(main[:, :, 0].mean()) - 80) <= 2
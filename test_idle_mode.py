@@ -0,0 +1,70 @@
+import datetime
+
+import metrics
+from idle_mode import IdleMode
+
+
+# To run this
+# pytest -v test_idle_mode.py
+
+START = datetime.datetime(2024, 9, 21, 22, 0, 0)
+
+
+def make_idle_mode(sanity_interval=600, check_pir=True):
+    config = {
+        "idle_mode": {"enable": True, "hold_time": 120, "sanity_interval": sanity_interval},
+        "pir": {"check_pir": check_pir},
+    }
+    return IdleMode(config)
+
+
+def at(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+def test_goes_idle_after_hold_time_and_wakes_on_pir():
+    idle_mode = make_idle_mode(sanity_interval=0)
+
+    assert idle_mode.should_detect(0, at(0), False)
+    assert idle_mode.should_detect(0, at(100), False)
+    assert idle_mode.mode() == "active"
+
+    assert not idle_mode.should_detect(0, at(130), False)
+    assert not idle_mode.should_detect(0, at(5000), False)
+    assert idle_mode.mode() == "idle"
+
+    assert idle_mode.should_detect(0, at(5001), True)
+    assert idle_mode.should_detect(0, at(5100), False)
+    assert idle_mode.mode() == "active"
+
+
+def test_sanity_checks_while_idle():
+    idle_mode = make_idle_mode(sanity_interval=600)
+
+    idle_mode.should_detect(0, at(0), False)
+    results = [idle_mode.should_detect(0, at(seconds), False) for seconds in range(130, 2000, 10)]
+
+    # The last inference was at 0, so the sanity checks are at 600, 1200 and 1800
+    assert results.count(True) == 3
+
+
+def test_time_in_mode_is_recorded():
+    before = metrics.snapshot()["counters"]
+    idle_mode = make_idle_mode(sanity_interval=0)
+
+    for seconds in range(0, 301, 10):
+        idle_mode.should_detect(0, at(seconds), False)
+
+    counters = metrics.snapshot()["counters"]
+
+    def added(name):
+        return counters[name]["total"] - before.get(name, {"total": 0})["total"]
+
+    assert added("idle_mode_to_idle") == 1
+    assert added("idle_mode_active_seconds") + added("idle_mode_idle_seconds") == 300
+
+
+def test_disabled_without_pir():
+    idle_mode = make_idle_mode(sanity_interval=0, check_pir=False)
+
+    assert all(idle_mode.should_detect(0, at(seconds), False) for seconds in range(0, 10000, 500))
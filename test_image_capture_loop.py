@@ -0,0 +1,109 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import tomllib
+
+from image_capture_loop import ImageCaptureLoop
+from image_saver import ImageSaver
+
+
+# To run this
+# pytest -v test_image_capture_loop.py
+
+WIDTH = 64
+HEIGHT = 48
+
+# The replay is dark apart from this frame, which the stub detector finds a fox in
+BRIGHT_FRAME = 7
+NUM_FRAMES = 14
+
+
+class StubDetector:
+    """
+    Finds a fox in any frame that is mostly bright, instantly and the same every time.
+    """
+
+    def labels(self):
+        return {0: "fox"}
+
+    def empty_result(self):
+        return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.intp)
+
+    @contextmanager
+    def image_from_request(self, camera, request):
+        with request.lores_buffer() as buffer:
+            yield buffer[:HEIGHT]
+
+    def detect_objects_batch(self, frames):
+        return [
+            (np.array([[0.1, 0.9, 0.5, 0.5]], dtype=np.float32), np.array([0.9], dtype=np.float32), np.array([0]))
+            if grey.mean() > 128
+            else self.empty_result()
+            for grey in frames
+        ]
+
+
+def make_video(path):
+    video = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 10, (WIDTH, HEIGHT))
+    for i in range(NUM_FRAMES):
+        video.write(np.full((HEIGHT, WIDTH, 3), 240 if i == BRIGHT_FRAME else 20, dtype=np.uint8))
+    video.release()
+
+
+def make_config(tmp_path):
+    with open("config.toml", "rb") as f:
+        config = tomllib.load(f)
+
+    config["capture"].update(output_dir=f"{tmp_path / 'images'}/", source="replay", cameras=[0], flip=False)
+    config["preview"]["enable"] = False
+    config["pir"]["check_pir"] = False
+    config["replay"].update(path=str(tmp_path / "replay.avi"), pacing="fast", loop=False)
+    config["scheduler"].update(fps=0, active_fps=0, idle_fps=0)
+    config["tflite"].update(lores_width=WIDTH, lores_height=HEIGHT, main_width=WIDTH, main_height=HEIGHT)
+    config["motion_gate"]["enable"] = False
+    config["tracker"]["enable"] = False
+    config["index"]["enable"] = False
+    config["pre_event"].update(enable=True, max_frames=3)
+    config["saver"].update(write_behind=True, dedup=True)
+
+    return config
+
+
+def test_replay_end_to_end(tmp_path):
+    make_video(tmp_path / "replay.avi")
+    os.mkdir(tmp_path / "images")
+    config = make_config(tmp_path)
+
+    ImageSaver().set_config(config)
+    loop = ImageCaptureLoop(config, algorithm=StubDetector())
+
+    # Runs until the replay runs out, then drains the pipeline and stops
+    thread = threading.Thread(target=loop.start, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+
+    # The first frame is a timed save, as nothing has been saved yet, and the bright one a
+    # detection. Each starts a burst of the next 3 frames, which aren't skipped as duplicates
+    # even though they are the same dark scene.
+    names = sorted(os.listdir(tmp_path / "images"))
+    main = [name for name in names if name.endswith("Main_.jpg")]
+    pre = [name for name in names if name.endswith("Pre__.jpg")]
+
+    assert len(main) == 8
+    assert sum("-MP" in name or "-Mp" in name for name in main) == 1
+
+    # Frames between the two bursts were held for pre-roll and saved with the detection. The
+    # encoder drops frames while it is busy, so there may be fewer than max_frames.
+    assert 1 <= len(pre) <= 3
+    detection_name = next(name for name in main if "-Mp" in name)
+    assert all(name < detection_name for name in pre)
+
+    assert ImageSaver().stats()["pending"] == 0
+    assert not ImageSaver().write_behind()
+
+    # Stopping released the replay
+    assert loop._camera_list[0]._video is None
@@ -0,0 +1,229 @@
+import datetime
+import json
+import os
+
+import cv2
+import numpy as np
+import piexif
+import piexif.helper
+
+import capture_index
+from capture_data import CaptureData
+from image_saver import BURST
+from image_saver import DETECTION
+from image_saver import TIMED
+from image_saver import ImageSaver
+from image_saver import dhash
+
+
+# To run this
+# pytest -v test_image_saver.py
+
+
+def make_config(output_dir, write_behind, metadata="exif", index_path=None, dedup=False):
+    return {
+        "capture": {"output_dir": f"{output_dir}/", "save_images": True},
+        "tflite": {"lores_width": 64},
+        "index": {
+            "enable": index_path is not None,
+            "path": index_path,
+            "batch_size": 10,
+            "flush_interval": 0.1,
+            "queue_depth": 10,
+        },
+        "saver": {
+            "write_behind": write_behind,
+            "workers": 2,
+            "queue_depth": 2,
+            "encoder": "pil",
+            "quality": 75,
+            "subsampling": "4:2:0",
+            "downscale": 1,
+            "metadata": metadata,
+            "dedup": dedup,
+            "dedup_distance": 4,
+            "dedup_history": 2,
+        },
+    }
+
+
+def make_capture_data(second, object_detected=True):
+    capture_data = CaptureData()
+    capture_data.capture_time = datetime.datetime(2024, 9, 21, 22, 50, second)
+    capture_data.pir_fired = False
+    capture_data.camera_num = 0
+    capture_data.object_detected = object_detected
+    return capture_data
+
+
+def test_write_behind_saves_and_counts(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, True))
+
+    main_array = np.zeros((48, 64, 4), dtype=np.uint8)
+    for second in range(5):
+        image_saver.save_array(None, main_array, make_capture_data(second))
+
+    assert image_saver.flush(timeout=10)
+    image_saver.close()
+
+    stats = image_saver.stats()
+    assert stats["pending"] == 0
+    assert len(os.listdir(tmp_path)) == 5
+    assert not image_saver.write_behind()
+
+
+def test_failed_save_is_counted(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path / "missing", False))
+
+    before = image_saver.stats()
+    image_saver.save_array(None, np.zeros((48, 64, 4), dtype=np.uint8), make_capture_data(0))
+    after = image_saver.stats()
+
+    assert after["failed"] == before["failed"] + 1
+    assert after["queued"] == before["queued"] + 1
+
+
+def test_save_encoded_adds_exif(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False))
+
+    capture_data = make_capture_data(0)
+    jpeg = image_saver.encode(np.zeros((48, 64, 4), dtype=np.uint8), image_saver.format_exif(capture_data))
+    image_saver.save_encoded(jpeg, capture_data)
+
+    (file_name,) = os.listdir(tmp_path)
+    assert file_name.endswith("-Pre__.jpg")
+
+    exif = piexif.load(str(tmp_path / file_name))
+    assert exif["0th"][piexif.ImageIFD.Make] == b"Camera Module 3"
+
+
+def test_exif_matches_piexif_dump(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False))
+
+    capture_data = make_capture_data(7)
+    capture_data.add_detection([10, 20, 30, 40], 0.95, 1)
+    capture_data.set_labels({1: "fox"})
+
+    expected = piexif.dump(
+        {
+            "0th": {
+                piexif.ImageIFD.Make: "Camera Module 3",
+                piexif.ImageIFD.Model: capture_data.to_short_string().encode(),
+            },
+            "Exif": {
+                piexif.ExifIFD.DateTimeOriginal: capture_data.capture_time_str(),
+                piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(capture_data.to_json()),
+            },
+            "GPS": {},
+            "1st": {},
+        }
+    )
+
+    exif = piexif.load(image_saver.format_exif(capture_data))
+    expected = piexif.load(expected)
+
+    # Only where the Exif IFD is placed may differ
+    del exif["0th"][piexif.ImageIFD.ExifTag]
+    del expected["0th"][piexif.ImageIFD.ExifTag]
+    assert exif == expected
+
+
+def test_sidecar_metadata(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False, metadata="sidecar"))
+
+    image_saver.save_array(None, np.zeros((48, 64, 4), dtype=np.uint8), make_capture_data(0))
+
+    (json_name,) = [name for name in os.listdir(tmp_path) if name.endswith(".json")]
+    with open(tmp_path / json_name) as f:
+        assert json.load(f)["object_detected"] is True
+
+    assert piexif.load(str(tmp_path / json_name.replace(".json", ".jpg")))["Exif"] == {}
+
+
+def test_saves_are_indexed(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False, index_path=str(tmp_path / "captures.db")))
+
+    capture_data = make_capture_data(0)
+    capture_data.add_detection([10, 20, 30, 40], 0.95, 1)
+    capture_data.set_labels({1: "fox"})
+    image_saver.save_array(None, np.zeros((48, 64, 4), dtype=np.uint8), capture_data)
+    image_saver.close()
+
+    (capture,) = capture_index.query(capture_index.connect(str(tmp_path / "captures.db")), class_name="fox")
+    assert (capture["width"], capture["height"]) == (64, 48)
+    assert capture["detections"] == [{"class": "fox", "score": 0.95, "box": [10, 20, 30, 40]}]
+
+
+def make_lores(seed):
+    # A YUV420 frame with a 64 pixel wide, 48 pixel high Y plane and 8 bytes of stride padding
+    lores = np.random.default_rng(seed).integers(0, 256, (72, 72), dtype=np.uint8)
+    return cv2.GaussianBlur(lores, (9, 9), 0)
+
+
+def test_dhash():
+    grey = make_lores(0)[:48, :64]
+
+    assert dhash(grey) == dhash(grey)
+    assert bin(dhash(grey) ^ dhash(np.clip(grey.astype(int) + 3, 0, 255).astype(np.uint8))).count("1") <= 4
+    assert bin(dhash(grey) ^ dhash(make_lores(1)[:48, :64])).count("1") > 4
+
+
+def test_near_duplicates_are_skipped(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False, dedup=True))
+
+    main_array = np.zeros((48, 64, 4), dtype=np.uint8)
+    lores = make_lores(0)
+
+    # The first timed save, a duplicate of it, and a different scene
+    image_saver.save_array(lores, main_array, make_capture_data(0, object_detected=False), TIMED)
+    image_saver.save_array(lores.copy(), main_array, make_capture_data(1, object_detected=False), TIMED)
+    image_saver.save_array(make_lores(1), main_array, make_capture_data(2, object_detected=False), TIMED)
+
+    # Detections are always saved
+    image_saver.save_array(lores.copy(), main_array, make_capture_data(3), DETECTION)
+
+    saved = sorted(os.listdir(tmp_path))
+    assert len(saved) == 3
+    assert not any("22-50-01" in name for name in saved)
+
+
+def test_burst_after_a_detection_is_never_skipped(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, False, dedup=True))
+
+    main_array = np.zeros((48, 64, 4), dtype=np.uint8)
+    lores = make_lores(0)
+
+    image_saver.save_array(lores, main_array, make_capture_data(0), DETECTION)
+    for second in range(1, 4):
+        image_saver.save_array(lores.copy(), main_array, make_capture_data(second, object_detected=False), BURST)
+
+    assert len(os.listdir(tmp_path)) == 4
+
+
+def test_frames_in_the_same_second_get_their_own_files(tmp_path):
+    image_saver = ImageSaver()
+    image_saver.set_config(make_config(tmp_path, True))
+
+    main_array = np.zeros((48, 64, 4), dtype=np.uint8)
+    jpeg = image_saver.encode(main_array, None)
+    for i in range(9):
+        capture_data = make_capture_data(0)
+        capture_data.capture_time += datetime.timedelta(milliseconds=100 * i)
+        if i < 3:
+            # Pre-event frames
+            image_saver.save_encoded(jpeg, capture_data)
+        else:
+            image_saver.save_array(None, main_array, capture_data, BURST)
+
+    image_saver.close()
+
+    assert image_saver.stats()["pending"] == 0
+    assert len(os.listdir(tmp_path)) == 9
@@ -3,6 +3,13 @@
 """
 Tests Models with images.  Used to debug and test the other classes.
 
+Also re-scores an archive of saved images after a model change. The directories are walked
+lazily and the images are spread over a pool of processes, each with its own detector. Every
+result is appended to a checkpoint file as soon as it is ready, so an interrupted run picks up
+where it stopped when it is started again with the same checkpoint.
+
+    python test_images.py /home/admin/usbshare1/2_copy --workers 4 --checkpoint rescore.jsonl
+
 """
 
 # The following line gets over the fact that setuptools isn't part of python 3.12. Tflite seems to require this.
@@ -10,17 +17,19 @@ Tests Models with images.  Used to debug and test the other classes.
 # import setuptools.dist
 
 import argparse
+import concurrent.futures
+import json
 import logging
 import os
-from pprint import pprint
 
 import cv2
+import tomllib
+
 
-from tensor_flow_detect import TensorFlowDetect
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
-IMG_DIR = "/home/admin/usbshare1/2_copy"
-# IMG_DIR = "/home/admin/usbshare1/2_subset"
-IMG_PATH = "/home/admin/usbshare1/2_copy/bravo-2024-09-21 22.50.39.00747-c0-M-n-Main_.jpg"
+# The RunModel of each worker process
+_worker_runner = None
 
 class RunModel:
     def __init__(self, model, option_preview=False, output_dir=None):
@@ -52,16 +61,17 @@ class RunModel:
         logger.info(f"Processing image: {image_path}")
         lores, main = self.__model.get_image_from_file(image_path)
 
-        algorithm_data = {}
-        rectangles, scores, classes = self.__model.detect_objects(lores, algorithm_data)
-        self.__model.print_algorithm_data(algorithm_data, len(rectangles) > 0)
+        boxes, scores, class_ids = self.__model.detect_objects(lores)
+        rectangles = boxes.tolist()
+        scores = scores.tolist()
+        classes = class_ids.tolist()
 
         img_width, img_height = main.shape[1], main.shape[0]
         logger.debug(f"Image width: {img_width} height: {img_height}")
 
         for i in range(0, len(rectangles)):
             rectangle_with_scores = rectangles[i] + [scores[i]]
-            found_objects.append(rectangle_with_scores)
+            found_objects.append(rectangle_with_scores + [self.__model.class_name(classes[i])])
 
             # Potentially make drawing the rectangles on the image an option
 
@@ -102,20 +112,143 @@ class RunModel:
 
         return found_objects
 
-    def process_directory(self):
-        total_count = 0
-        hit_count = 0
+    def process_directories(self, directories, checkpoint_path=None):
+        """
+        Score every image in the directories on this process, e.g. to preview them.
+        """
+        done = load_checkpoint(checkpoint_path)
+
+        with open_checkpoint(checkpoint_path) as checkpoint:
+            for image_path in iter_image_paths(directories, done):
+                write_result(checkpoint, score_image(self, image_path))
+
+        print_summary(checkpoint_path)
+
+
+def make_detector(config):
+    # Imported here so this module loads, e.g. under pytest, where tflite isn't installed.
+    from tensor_flow_detect import TensorFlowDetect
+
+    return TensorFlowDetect(config['tflite'], False, False)
+
+
+def iter_image_paths(directories, done):
+    """
+    Yields:
+        string: Each image in the directories that isn't in done, without listing a whole
+        directory up front
+    """
+    for directory in directories:
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.path not in done:
+                yield entry.path
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    Yields:
+        dict: Each result in the checkpoint, in the order they were written
+    """
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return
+
+    with open(checkpoint_path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted run may be cut short
+                continue
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Returns:
+        set: The images already scored. Images that failed are scored again.
+    """
+    return {result["file"] for result in read_checkpoint(checkpoint_path) if "error" not in result}
+
+
+def open_checkpoint(checkpoint_path):
+    return open(checkpoint_path if checkpoint_path is not None else os.devnull, "a")
+
+
+def write_result(checkpoint, result):
+    checkpoint.write(json.dumps(result) + "\n")
+    checkpoint.flush()
+
 
-        for filename in os.listdir(IMG_DIR):
-            total_count += 1
+def score_image(runner, image_path):
+    """
+    Returns:
+        dict: The image and what was found in it, or the error if it couldn't be scored
+    """
+    try:
+        return {"file": image_path, "objects": runner.process_image(image_path)}
+    except Exception as e:
+        logging.error(f"Couldn't score {image_path}: {e}")
+        return {"file": image_path, "error": str(e)}
 
-            img_path = os.path.join(IMG_DIR, filename)
-            found_objcts = self.process_image(img_path)
 
-            if len(found_objcts) > 0:
-                hit_count += 1
+def _init_worker(config, output_dir):
+    global _worker_runner
+    _worker_runner = RunModel(make_detector(config), False, output_dir)
 
-        print(f"{self.__model.name()}: num_files {total_count} with_objects {hit_count}")
+
+def _score_in_worker(image_path):
+    return score_image(_worker_runner, image_path)
+
+
+def rescore(config, directories, checkpoint_path, workers, output_dir=None):
+    """
+    Score every image in the directories on a pool of processes, skipping those already in the
+    checkpoint. At most a few images per worker are in flight, so memory doesn't depend on how
+    many images there are.
+
+    Returns:
+        int: The number of images scored by this run
+    """
+    done = load_checkpoint(checkpoint_path)
+    logging.info(f"{len(done)} images already scored")
+
+    in_flight_limit = workers * 4
+    count = 0
+
+    with open_checkpoint(checkpoint_path) as checkpoint:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(config, output_dir)
+        ) as executor:
+            in_flight = set()
+
+            for image_path in iter_image_paths(directories, done):
+                in_flight.add(executor.submit(_score_in_worker, image_path))
+
+                if len(in_flight) >= in_flight_limit:
+                    finished, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in finished:
+                        write_result(checkpoint, future.result())
+                        count += 1
+
+            for future in concurrent.futures.as_completed(in_flight):
+                write_result(checkpoint, future.result())
+                count += 1
+
+    return count
+
+
+def print_summary(checkpoint_path):
+    if checkpoint_path is None:
+        return
+
+    # An image that failed and was scored again on a later run counts once, by its last result
+    results = {result["file"]: result for result in read_checkpoint(checkpoint_path)}
+
+    hit_count = sum(1 for result in results.values() if "error" not in result and result["objects"])
+    error_count = sum(1 for result in results.values() if "error" in result)
+
+    print(f"num_files {len(results)} with_objects {hit_count} errors {error_count}")
 
 
 if __name__ == "__main__":
@@ -126,9 +259,12 @@ if __name__ == "__main__":
     prog="Process", description="Runs model on images."
 )
 
-    parser.add_argument("-p", "--preview", action="store_true")
+    parser.add_argument("directories", nargs="+", help="Directories of images to score")
+    parser.add_argument("-p", "--preview", action="store_true", help="Show each image. Runs on a single process")
     parser.add_argument("-d", "--debug", action="store_true")
     parser.add_argument("-o", "--output", type=str, help="Directory to save output images")
+    parser.add_argument("-c", "--checkpoint", type=str, help="Results file. An existing one is resumed")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
 
     args = parser.parse_args()
     if args.preview:
@@ -141,16 +277,29 @@ if __name__ == "__main__":
         logger.setLevel(logging.DEBUG)
         logger.debug("Debugging enabled")
 
+    output_dir = None
     if args.output:
         output_dir = args.output
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-    # runner = RunModel(MobileObjectLocalizer()).process_directory()
-    runner = RunModel(TensorFlowDetect(320, 240, 1152, 648, option_preview, 0.2), option_preview, output_dir).process_directory()
-    # runner = RunModel(YOLOv5()).process_directory()
-
-    print("Completed.")
+    with open("config.toml", "rb") as f:
+        config = tomllib.load(f)
 
+    # Score one frame at a time, and with several workers, one interpreter thread each so they
+    # don't fight over the cores.
+    config['tflite']['max_batch'] = 1
+    config['tflite']['warmup_runs'] = 0
+    if args.workers > 1:
+        config['tflite']['num_threads'] = 1
 
+    if option_preview or args.workers <= 1:
+        # runner = RunModel(MobileObjectLocalizer()).process_directory()
+        RunModel(make_detector(config), option_preview, output_dir).process_directories(args.directories, args.checkpoint)
+        # runner = RunModel(YOLOv5()).process_directory()
+    else:
+        count = rescore(config, args.directories, args.checkpoint, args.workers, output_dir)
+        logging.info(f"Scored {count} images")
+        print_summary(args.checkpoint)
 
+    print("Completed.")
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from interpreter_manager import InterpreterManager
+from tensor_flow_detect import TensorFlowDetect
+
+
+# To run this
+# pytest -v test_interpreter_manager.py
+
+
+class FakeInterpreter:
+    """
+    Stands in for a TFLite interpreter. Like a model ending in TFLite_Detection_PostProcess, a
+    batch larger than max_batch allocates but fails in invoke().
+    """
+
+    def __init__(self, max_batch=1):
+        self.max_batch = max_batch
+        self.shape = [1, 300, 300, 3]
+        self.invocations = 0
+
+    def allocate_tensors(self):
+        self.input = np.zeros(self.shape, dtype=np.uint8)
+
+    def get_input_details(self):
+        return [{"index": 0, "shape": np.array(self.shape), "dtype": np.uint8}]
+
+    def get_output_details(self):
+        return [{"index": i} for i in range(1, 5)]
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = list(shape)
+
+    def set_tensor(self, index, value):
+        self.input[...] = value
+
+    def tensor(self, index):
+        return lambda: self.input
+
+    def invoke(self):
+        if self.shape[0] > self.max_batch:
+            raise RuntimeError("tensorflow/lite/kernels/detection_postprocess.cc Node number 1 failed to invoke")
+        self.invocations += 1
+
+    def get_tensor(self, index):
+        # One person in every frame: boxes, classes, scores and count
+        batch = self.shape[0]
+        return {
+            1: np.tile(np.array([0.1, 0.2, 0.3, 0.4], dtype=np.float32), (batch, 1, 1)),
+            2: np.zeros((batch, 1), dtype=np.float32),
+            3: np.full((batch, 1), 0.9, dtype=np.float32),
+            4: np.ones(batch, dtype=np.float32),
+        }[index]
+
+
+def make_manager(interpreter):
+    config = {"num_threads": 1, "delegate": "", "delegate_options": {}, "warmup_runs": 2}
+    return InterpreterManager("model.tflite", config, interpreter=interpreter)
+
+
+def make_detector(interpreter, max_batch):
+    config = {
+        "lores_width": 320,
+        "lores_height": 240,
+        "main_width": 640,
+        "main_height": 480,
+        "buffer_count": 4,
+        "threshold": 0.25,
+        "draw_rectangles": False,
+        "num_threads": 1,
+        "delegate": "",
+        "delegate_options": {},
+        "warmup_runs": 0,
+        "max_batch": max_batch,
+        "lores_native": False,
+        "stop_list": [],
+        "class_thresholds": {},
+    }
+    return TensorFlowDetect(config, False, False, interpreter)
+
+
+def test_warm_up():
+    interpreter = FakeInterpreter()
+    manager = make_manager(interpreter)
+
+    assert interpreter.invocations == 2
+    assert manager.input_shape() == (1, 300, 300, 3)
+
+
+def test_set_batch_size():
+    interpreter = FakeInterpreter(max_batch=4)
+    manager = make_manager(interpreter)
+
+    manager.set_batch_size(4)
+
+    assert manager.batch_size == 4
+    assert manager.input_shape() == (4, 300, 300, 3)
+
+
+def test_batch_that_fails_to_invoke_is_rejected():
+    interpreter = FakeInterpreter(max_batch=1)
+    manager = make_manager(interpreter)
+
+    with pytest.raises(RuntimeError):
+        manager.set_batch_size(2)
+
+    # Still usable at the old size
+    assert manager.batch_size == 1
+    assert manager.input_shape() == (1, 300, 300, 3)
+    manager.invoke()
+
+
+def test_detector_runs_frames_singly_when_batching_fails():
+    detector = make_detector(FakeInterpreter(max_batch=1), max_batch=4)
+    frames = [np.zeros((240, 384), dtype=np.uint8) for _ in range(3)]
+
+    results = detector.detect_objects_batch(frames)
+
+    assert len(results) == 3
+    for boxes, scores, class_ids in results:
+        assert class_ids.tolist() == [0]
+        assert scores.tolist() == [pytest.approx(0.9)]
+
+    # Later batches go straight to one frame at a time
+    assert len(detector.detect_objects_batch(frames[:2])) == 2
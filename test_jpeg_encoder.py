@@ -0,0 +1,53 @@
+import io
+
+import numpy as np
+import piexif
+import pytest
+from PIL import Image
+
+from jpeg_encoder import make_encoder
+
+
+# To run this
+# pytest -v test_jpeg_encoder.py
+
+
+def make_config(encoder, downscale=1, subsampling="4:2:0"):
+    return {"encoder": encoder, "quality": 90, "subsampling": subsampling, "downscale": downscale}
+
+
+def make_frame():
+    # XBGR8888 from the camera: [R, G, B, 255] pixels, left half red, right half blue
+    frame = np.full((64, 96, 4), 255, dtype=np.uint8)
+    frame[:, :, :3] = 0
+    frame[:, :48, 0] = 200
+    frame[:, 48:, 2] = 200
+    return frame
+
+
+@pytest.mark.parametrize("encoder", ["pil", "opencv"])
+def test_encodes_rgbx(encoder):
+    jpeg = make_encoder(make_config(encoder)).encode(make_frame())
+
+    image = np.asarray(Image.open(io.BytesIO(jpeg)).convert("RGB")).astype(int)
+
+    assert image.shape == (64, 96, 3)
+    assert abs(image[32, 10] - [200, 0, 0]).max() < 20
+    assert abs(image[32, 80] - [0, 0, 200]).max() < 20
+
+
+@pytest.mark.parametrize("encoder", ["pil", "opencv"])
+def test_downscale_and_exif(encoder):
+    exif_bytes = piexif.dump({"0th": {piexif.ImageIFD.Make: "Camera Module 3"}})
+
+    jpeg = make_encoder(make_config(encoder, downscale=2)).encode(make_frame(), exif_bytes)
+
+    assert Image.open(io.BytesIO(jpeg)).size == (48, 32)
+    assert piexif.load(jpeg)["0th"][piexif.ImageIFD.Make] == b"Camera Module 3"
+
+
+def test_unknown_encoder_and_subsampling():
+    with pytest.raises(ValueError):
+        make_encoder(make_config("gif"))
+    with pytest.raises(ValueError):
+        make_encoder(make_config("pil", subsampling="4:1:1"))
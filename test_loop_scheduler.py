@@ -0,0 +1,78 @@
+import pytest
+
+import metrics
+from loop_scheduler import LoopScheduler
+
+
+# To run this
+# pytest -v test_loop_scheduler.py
+
+
+def make_scheduler(temperatures=None, camera_num=0):
+    config = {
+        "scheduler": {
+            "fps": 2.0,
+            "active_fps": 4.0,
+            "active_window": 30,
+            "idle_fps": 1.0,
+            "idle_after": 600,
+            "thermal_soft_limit": 70.0,
+            "thermal_hard_limit": 80.0,
+            "thermal_min_fps": 0.5,
+            "thermal_check_interval": 0,
+        }
+    }
+    temperatures = iter(temperatures or [])
+    scheduler = LoopScheduler(config, camera_num, temperature=lambda: next(temperatures, None))
+    # Last activity long enough ago for the normal rate
+    scheduler.notify_activity(now=-100.0)
+    return scheduler
+
+
+def test_deadline_absorbs_work_time():
+    scheduler = make_scheduler()
+
+    assert scheduler.next_wait(now=0.0) == pytest.approx(0.5)
+    # The frame took 0.2s to capture, so only 0.3s is left
+    assert scheduler.next_wait(now=0.7) == pytest.approx(0.3)
+
+
+def test_overrun_restarts_the_schedule():
+    scheduler = make_scheduler()
+
+    scheduler.next_wait(now=0.0)
+    assert scheduler.next_wait(now=2.0) == 0.0
+    assert scheduler.next_wait(now=2.0) == pytest.approx(0.5)
+
+
+def test_modes():
+    scheduler = make_scheduler()
+    scheduler.notify_activity(now=-1000.0)
+
+    assert scheduler.mode(0.0) == "idle"
+    assert scheduler.target_fps(0.0) == 1.0
+
+    scheduler.notify_activity(now=0.0)
+    assert scheduler.target_fps(10.0) == 4.0
+    assert scheduler.target_fps(100.0) == 2.0
+    assert scheduler.target_fps(700.0) == 1.0
+
+
+def test_thermal_throttling():
+    scheduler = make_scheduler(temperatures=[60.0, 75.0, 90.0])
+    scheduler.notify_activity(now=0.0)
+
+    assert scheduler.target_fps(1.0) == 4.0
+    assert scheduler.target_fps(2.0) == pytest.approx(2.25)
+    assert scheduler.target_fps(3.0) == 0.5
+
+
+def test_target_fps_gauge_per_camera():
+    make_scheduler(camera_num=0).next_wait(now=0.0)
+    second = make_scheduler(camera_num=1)
+    second.notify_activity(now=0.0)
+    second.next_wait(now=0.0)
+
+    gauges = metrics.snapshot()["gauges"]
+    assert gauges["target_fps_0"] == 2.0
+    assert gauges["target_fps_1"] == 4.0
@@ -0,0 +1,56 @@
+import metrics
+from metrics import LatencyHistogram
+
+
+# To run this
+# pytest -v test_metrics.py
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for _ in range(90):
+        histogram.record(0.010)
+    for _ in range(10):
+        histogram.record(0.200)
+
+    # Percentiles are bucket upper bounds, which are about 26% apart
+    assert 0.010 <= histogram.percentile(50) < 0.013
+    assert 0.200 <= histogram.percentile(95) < 0.26
+    assert histogram.percentile(99) == histogram.percentile(95)
+    assert histogram.max == 0.200
+
+
+def test_histogram_overflow_and_empty():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) == 0.0
+
+    histogram.record(500.0)
+    assert histogram.percentile(99) == 500.0
+
+
+def test_snapshot_windows():
+    metrics.count("test_saves", 3)
+    metrics.record("test_save", 0.05)
+
+    first = metrics.snapshot(reset=True)
+    assert first["counters"]["test_saves"] == {"window": 3, "total": 3}
+    assert first["timers"]["test_save"]["count"] == 1
+
+    metrics.count("test_saves")
+    second = metrics.snapshot(reset=True)
+    assert second["counters"]["test_saves"] == {"window": 1, "total": 4}
+    assert second["timers"]["test_save"]["count"] == 0
+    assert second["timers"]["test_save"]["total_count"] == 1
+    assert second["timers"]["test_save"]["total_sum"] == 0.05
+
+
+def test_timer():
+    with metrics.timer("test_timer"):
+        pass
+    assert metrics.snapshot()["timers"]["test_timer"]["count"] == 1
+
+
+def test_gauge():
+    metrics.set_gauge("test_gauge", 1.5)
+    metrics.set_gauge("test_gauge", 2.5)
+    assert metrics.snapshot(reset=True)["gauges"]["test_gauge"] == 2.5
@@ -0,0 +1,36 @@
+import metrics_server
+
+
+# To run this
+# pytest -v test_metrics_server.py
+
+
+def test_format_prometheus():
+    snapshot = {
+        "timers": {
+            "inference": {
+                "count": 4,
+                "mean": 0.05,
+                "p50": 0.04,
+                "p95": 0.08,
+                "p99": 0.1,
+                "max": 0.1,
+                "total_count": 40,
+                "total_sum": 2.5,
+            }
+        },
+        "counters": {"saves": {"window": 2, "total": 7}},
+        "gauges": {"last_detection_time": 1700000000.0},
+    }
+    node_health = {"cpu_temp": None, "loop_rate": 2.0, "saver_queue_depth": 1, "pir": True}
+
+    text = metrics_server.format_prometheus(snapshot, node_health)
+    lines = text.splitlines()
+
+    assert 'capture_inference_seconds{quantile="0.95"} 0.08' in lines
+    assert "capture_inference_seconds_count 40" in lines
+    assert "capture_inference_seconds_sum 2.5" in lines
+    assert "capture_saves_total 7" in lines
+    assert "capture_loop_rate_hz 2.0" in lines
+    assert "capture_pir 1" in lines
+    assert not any(line.startswith("capture_cpu_temp") for line in lines)
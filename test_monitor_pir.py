@@ -0,0 +1,55 @@
+import threading
+import time
+
+from monitor_pir import FakeGPIOBackend
+from monitor_pir import MonitorPIR
+
+
+# To run this
+# pytest -v test_monitor_pir.py
+
+
+def make_monitor(backend):
+    config = {"pir": {"check_pir": True, "chip": "gpiochip4", "line": 4, "dwell": 0.05}}
+    monitor = MonitorPIR(config, backend=backend)
+    monitor.start()
+    return monitor
+
+
+def test_edge_wakes_waiter():
+    backend = FakeGPIOBackend()
+    monitor = make_monitor(backend)
+    wake = threading.Event()
+    monitor.add_wake_event(wake)
+
+    assert not monitor.pir_detected()
+    assert monitor.last_trigger() is None
+
+    before = time.monotonic()
+    backend.set_value(1)
+
+    # Much sooner than a polling interval plus a loop delay
+    assert wake.wait(timeout=1)
+    assert monitor.pir_detected()
+    assert monitor.last_trigger() >= before
+
+    wake.clear()
+    backend.set_value(0)
+    assert wake.wait(timeout=1)
+    assert not monitor.pir_detected()
+
+    monitor.stop()
+
+
+def test_no_edge_no_wake():
+    backend = FakeGPIOBackend(value=1)
+    monitor = make_monitor(backend)
+    wake = threading.Event()
+    monitor.add_wake_event(wake)
+
+    # Starts with the line's level, but that isn't an edge
+    assert monitor.pir_detected()
+    backend.set_value(1)
+    assert not wake.wait(timeout=0.2)
+
+    monitor.stop()
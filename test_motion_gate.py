@@ -0,0 +1,121 @@
+import datetime
+
+import numpy as np
+
+import metrics
+from motion_gate import MotionGate
+
+
+# To run this
+# pytest -v test_motion_gate.py
+
+START = datetime.datetime(2024, 9, 21, 22, 0, 0)
+
+
+def counted(name):
+    return metrics.snapshot()["counters"].get(f"motion_gate_{name}", {"total": 0})["total"]
+
+
+def make_gate(enable=True, force_interval=60):
+    config = {
+        "motion_gate": {
+            "enable": enable,
+            "pixel_threshold": 25,
+            "changed_percent": 1.0,
+            "learning_rate": 0.05,
+            "force_interval": force_interval,
+            "subsample": 2,
+        },
+        "tflite": {"lores_width": 320},
+    }
+    return MotionGate(config)
+
+
+def still_frame():
+    # 384 is a typical lores stride for a 320 wide image
+    return np.full((240, 384), 100, dtype=np.uint8)
+
+
+def test_first_frame_goes_to_detector():
+    gate = make_gate()
+    before = counted("first_frame")
+    assert gate.should_detect(0, still_frame(), START)
+    assert counted("first_frame") - before == 1
+
+
+def test_still_scene_is_skipped():
+    gate = make_gate()
+    before = counted("skipped")
+    gate.should_detect(0, still_frame(), START)
+
+    for i in range(1, 10):
+        assert not gate.should_detect(0, still_frame(), START + datetime.timedelta(seconds=i))
+
+    assert counted("skipped") - before == 9
+
+
+def test_motion_goes_to_detector():
+    gate = make_gate()
+    before = counted("motion")
+    gate.should_detect(0, still_frame(), START)
+
+    frame = still_frame()
+    frame[100:160, 100:180] = 250
+    assert gate.should_detect(0, frame, START + datetime.timedelta(seconds=1))
+    assert counted("motion") - before == 1
+
+
+def test_changes_outside_the_image_are_ignored():
+    gate = make_gate()
+    gate.should_detect(0, still_frame(), START)
+
+    frame = still_frame()
+    frame[:, 320:] = 250
+    assert not gate.should_detect(0, frame, START + datetime.timedelta(seconds=1))
+
+
+def test_forced_after_interval():
+    gate = make_gate(force_interval=10)
+    before = counted("forced")
+    gate.should_detect(0, still_frame(), START)
+
+    assert not gate.should_detect(0, still_frame(), START + datetime.timedelta(seconds=5))
+    assert gate.should_detect(0, still_frame(), START + datetime.timedelta(seconds=10))
+    assert gate.should_detect(0, still_frame(), START + datetime.timedelta(seconds=11), force=True)
+    assert counted("forced") - before == 2
+
+
+def test_learned_frames_keep_the_background_current():
+    gate = make_gate()
+    gate.should_detect(0, still_frame(), START)
+
+    # The light changes while the frames aren't being checked, e.g. in idle mode
+    darker = np.full((240, 384), 40, dtype=np.uint8)
+    for _ in range(200):
+        gate.learn(0, darker)
+
+    assert not gate.should_detect(0, darker, START + datetime.timedelta(seconds=1))
+
+
+def test_learned_background_before_any_inference():
+    gate = make_gate()
+    before = counted("forced")
+    gate.learn(0, still_frame())
+
+    assert gate.should_detect(0, still_frame(), START)
+    assert counted("forced") - before == 1
+
+
+def test_cameras_have_separate_backgrounds():
+    gate = make_gate()
+    before = counted("first_frame")
+    gate.should_detect(0, still_frame(), START)
+
+    assert gate.should_detect(1, np.zeros((240, 384), dtype=np.uint8), START)
+    assert counted("first_frame") - before == 2
+
+
+def test_disabled_gate_lets_everything_through():
+    gate = make_gate(enable=False)
+    assert gate.should_detect(0, still_frame(), START)
+    assert gate.should_detect(0, still_frame(), START)
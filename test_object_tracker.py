@@ -0,0 +1,113 @@
+import datetime
+
+import numpy as np
+
+from object_tracker import NEW
+from object_tracker import REENTERED
+from object_tracker import REFRESH
+from object_tracker import ObjectTracker
+from object_tracker import iou_matrix
+
+
+# To run this
+# pytest -v test_object_tracker.py
+
+START = datetime.datetime(2024, 9, 21, 22, 0, 0)
+DEER = 17
+FOX = 18
+
+
+def make_tracker():
+    config = {
+        "tracker": {
+            "enable": True,
+            "iou_threshold": 0.3,
+            "max_distance": 0.1,
+            "max_missed": 2,
+            "reentry_window": 60,
+            "refresh_interval": 30,
+        }
+    }
+    return ObjectTracker(config)
+
+
+def at(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+def box(x, y, size=0.2):
+    return [x, y + size, x + size, y]
+
+
+def test_iou_matrix():
+    iou = iou_matrix(np.array([box(0, 0)]), np.array([box(0, 0), box(0.1, 0), box(0.5, 0.5)]))
+
+    np.testing.assert_allclose(iou, [[1.0, 1 / 3, 0.0]], atol=1e-6)
+
+
+def test_stationary_object_is_saved_once_then_refreshed():
+    tracker = make_tracker()
+
+    reasons = [tracker.update(0, [box(0.4, 0.4)], [DEER], at(seconds))[1][0] for seconds in range(0, 61, 5)]
+
+    assert reasons[0] == NEW
+    assert reasons.count(REFRESH) == 2
+    assert reasons.count(None) == len(reasons) - 3
+
+
+def test_moving_object_keeps_its_track():
+    tracker = make_tracker()
+
+    track_ids = [tracker.update(0, [box(0.1 + 0.05 * i, 0.4, 0.05)], [FOX], at(i))[0][0] for i in range(10)]
+
+    assert len(set(track_ids)) == 1
+
+
+def test_new_arrival_is_saved_alongside_a_tracked_one():
+    tracker = make_tracker()
+    tracker.update(0, [box(0.1, 0.1)], [DEER], at(0))
+
+    track_ids, reasons = tracker.update(0, [box(0.1, 0.1), box(0.6, 0.6)], [DEER, DEER], at(1))
+
+    assert reasons == [None, NEW]
+    assert track_ids[0] != track_ids[1]
+
+
+def test_track_is_lost_after_max_missed_frames():
+    tracker = make_tracker()
+    tracker.update(0, [box(0.1, 0.1)], [DEER], at(0))
+
+    # One miss short of max_missed, the track carries on
+    tracker.update(0, [], [], at(1))
+    assert tracker.update(0, [box(0.1, 0.1)], [DEER], at(2))[1] == [None]
+
+    # max_missed misses in a row lose it
+    tracker.update(0, [], [], at(3))
+    tracker.update(0, [], [], at(4))
+    assert tracker.update(0, [box(0.1, 0.1)], [DEER], at(5))[1] == [REENTERED]
+
+
+def test_reentered_and_forgotten():
+    tracker = make_tracker()
+    (track_id,), _ = tracker.update(0, [box(0.1, 0.1)], [DEER], at(0))
+
+    for seconds in range(1, 4):
+        tracker.update(0, [], [], at(seconds))
+
+    assert tracker.update(0, [box(0.1, 0.1)], [DEER], at(10)) == ([track_id], [REENTERED])
+
+    for seconds in range(11, 80, 10):
+        tracker.update(0, [], [], at(seconds))
+
+    assert tracker.tracks(0) == []
+    (new_id,), reasons = tracker.update(0, [box(0.1, 0.1)], [DEER], at(100))
+    assert reasons == [NEW]
+    assert new_id != track_id
+
+
+def test_classes_and_cameras_are_separate():
+    tracker = make_tracker()
+    tracker.update(0, [box(0.1, 0.1)], [DEER], at(0))
+
+    assert tracker.update(0, [box(0.1, 0.1)], [FOX], at(1))[1] == [NEW]
+    assert tracker.update(1, [box(0.1, 0.1)], [DEER], at(1))[1] == [NEW]
@@ -0,0 +1,82 @@
+import datetime
+
+import numpy as np
+
+from capture_data import CaptureData
+from pre_event_buffer import PreEventBuffer
+
+
+# To run this
+# pytest -v test_pre_event_buffer.py
+
+START = datetime.datetime(2024, 9, 21, 22, 0, 0)
+
+
+def make_buffer(max_frames=3, memory_mb=64):
+    config = {
+        "pre_event": {"enable": True, "max_frames": max_frames, "memory_mb": memory_mb, "quality": 75},
+        "saver": {"encoder": "pil", "quality": 90, "subsampling": "4:2:0", "downscale": 1},
+    }
+    return PreEventBuffer(config)
+
+
+def add_frames(buffer, camera_num, count, size=(48, 64)):
+    rng = np.random.default_rng(camera_num)
+    for i in range(count):
+        capture_data = CaptureData()
+        capture_data.capture_time = START + datetime.timedelta(seconds=i)
+        capture_data.camera_num = camera_num
+
+        assert buffer.wants_frame()
+        buffer.add(camera_num, rng.integers(0, 256, size + (4,), dtype=np.uint8), capture_data)
+        buffer.flush()
+
+
+def test_keeps_most_recent_frames_oldest_first():
+    buffer = make_buffer(max_frames=3)
+    add_frames(buffer, 0, 5)
+
+    frames = buffer.drain(0)
+    buffer.close()
+
+    assert [capture_data.capture_time.second for jpeg, capture_data in frames] == [2, 3, 4]
+    assert all(jpeg.startswith(b"\xff\xd8") for jpeg, capture_data in frames)
+    assert buffer.drain(0) == []
+    assert buffer.memory_used() == 0
+
+
+def test_drain_waits_for_the_frame_being_encoded():
+    buffer = make_buffer()
+    capture_data = CaptureData()
+    capture_data.camera_num = 0
+
+    # Big enough that encoding it is still going on when drain() is called
+    assert buffer.wants_frame()
+    buffer.add(0, np.random.default_rng(0).integers(0, 256, (1024, 1024, 4), dtype=np.uint8), capture_data)
+
+    assert len(buffer.drain(0)) == 1
+    buffer.close()
+    assert buffer.memory_used() == 0
+
+
+def test_cameras_have_separate_rings():
+    buffer = make_buffer()
+    add_frames(buffer, 0, 2)
+    add_frames(buffer, 1, 1)
+
+    assert len(buffer.drain(1)) == 1
+    assert len(buffer.drain(0)) == 2
+    buffer.close()
+
+
+def test_memory_budget_evicts_oldest():
+    # Noise barely compresses, so each 256x256 frame is well over 64KB
+    buffer = make_buffer(max_frames=10, memory_mb=0.1)
+    add_frames(buffer, 0, 4, size=(256, 256))
+
+    assert buffer.memory_used() <= 0.1 * 1024 * 1024
+    frames = buffer.drain(0)
+    buffer.close()
+
+    assert 0 < len(frames) < 4
+    assert frames[-1][1].capture_time.second == 3
@@ -2,8 +2,10 @@
 # pytest -v test_stop_list.py
 
 import pytest
+
 from stop_list import StopList
 
+
 def test_stop_list_initialization():
     stop_list = StopList()
     assert stop_list.stop_list is None
@@ -26,3 +28,9 @@ def test_not_in_stop_list():
     word = 'go'
     assert stop_list.is_in_stop_list(word) == False
 
+
+def test_class_mask():
+    stop_list = StopList()
+    stop_list.set_stop_list(['car', 'bench'])
+    mask = stop_list.class_mask({0: 'person', 2: 'car', 3: 'deer', 5: 'bench'})
+    assert mask.tolist() == [True, False, False, True, False, False, False]
@@ -0,0 +1,15 @@
+import logging
+
+from gpiozero import CPUTemperature
+
+
+def cpu_temperature():
+    """
+    Returns:
+        float: The CPU temperature in Celsius, or None if it can't be read, e.g. off the Pi
+    """
+    try:
+        return CPUTemperature().temperature
+    except Exception as e:
+        logging.debug(f"Can't read the CPU temperature: {e}")
+        return None